@@ -0,0 +1,207 @@
+"""calibration table of em_stitch.worker.cost_estimate
+
+    python benchmarks/bench_calibrate.py
+    python benchmarks/bench_calibrate.py --output calibration.json \
+        --lens_grids 4 8 16 --nvertices 250 1000 4000 \
+        --montage_sizes 100 1000 10000
+
+Synthetic lens correction sections (grid x grid tiles, solved with each
+nvertex) and montage sections (about n tiles, solved with the first
+template and with all --templates) are generated in --work_dir and
+kept there between runs. Each solve runs as a job in a fresh
+interpreter, which records the counts the estimator reads, the wall
+time of the module's run(), the peak resident memory of the process
+and, for lens correction, the nonzeros of K = A^T W A + reg and of its
+LU factors from the dumped linear system. The records are written to
+--output, by default the table shipped with em_stitch. Record it on
+the machines the jobs run on.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy.sparse.linalg import splu
+
+from em_stitch.lens_correction.solve_replay import (
+        linear_system_name, load_system)
+from em_stitch.lens_correction.synthetic import GenerateSyntheticLensData
+from em_stitch.montage.montage_solver import get_metafile_path
+from em_stitch.utils.instrumentation import max_rss_mb
+from em_stitch.worker import cost_estimate
+from em_stitch.worker.job_worker import get_module_class
+
+from bench_montage_scaling import section, template_dir
+from conftest import montage_ransac_thresh, ransac_thresh, regularization
+
+
+def lens_section(work_dir, grid, seed):
+    """synthetic lens correction section of grid x grid tiles"""
+    data_dir = os.path.join(work_dir, "lens_%dx%d_%d" % (grid, grid, seed))
+    if not os.path.isdir(data_dir):
+        GenerateSyntheticLensData(input_data={
+            "output_dir": data_dir,
+            "n_rows": grid,
+            "n_cols": grid,
+            "seed": seed,
+            "outlier_fraction": 0.05,
+            "log_level": "WARNING"}, args=[]).run()
+    return data_dir
+
+
+def run_worker(job):
+    """run one calibration job and measure it, in this process"""
+    args = job["args"]
+    if job["module"] == "lens_correction":
+        record = cost_estimate.lens_counts(args["data_dir"])
+        record["nvertex"] = args["nvertex"]
+    else:
+        record = cost_estimate.montage_counts(
+            get_metafile_path(args["data_dir"]))
+        record["n_templates"] = len(args["solver_templates"])
+        record["n_point_pair_solves"] = (
+            record["n_point_pairs"] * record["n_templates"])
+
+    # smooth_density draws from the global numpy RNG
+    np.random.seed(0)
+    mod = get_module_class(job["module"])(input_data=args, args=[])
+    t0 = time.perf_counter()
+    mod.run()
+    record["wall_time"] = time.perf_counter() - t0
+    record["peak_memory_mb"] = max_rss_mb()
+
+    if job["module"] == "lens_correction":
+        system = load_system(
+            os.path.join(args["output_dir"], linear_system_name))
+        A = system["A"]
+        K = (A.transpose().dot(system["weights"]).dot(A) +
+             system["reg"]).tocsc()
+        lu = splu(K)
+        record["nnz_K"] = int(K.nnz)
+        record["nnz_factor"] = int(lu.L.nnz + lu.U.nnz)
+    return record
+
+
+def measure(module, args):
+    """run a job in a fresh interpreter
+
+    Returns
+    -------
+    record : dict or None
+        counts and measurements, None if the job failed (e.g. a mesh
+        too fine for the point pairs of a small section)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        args = dict(args, output_dir=tmp, log_level="WARNING")
+        job = os.path.join(tmp, "job.json")
+        result = os.path.join(tmp, "record.json")
+        with open(job, "w") as f:
+            json.dump({"module": module, "args": args}, f)
+        p = subprocess.run(
+            [sys.executable, os.path.abspath(__file__),
+             "--worker", job, result],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        if p.returncode != 0:
+            print("  skipped, %s" % p.stderr.strip().splitlines()[-1])
+            return None
+        with open(result, "r") as f:
+            return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--output", default=cost_estimate.default_calibration,
+        help="calibration json")
+    parser.add_argument(
+        "--lens_grids", type=int, nargs="+", default=[3, 5, 8],
+        help="lens correction sections of grid x grid tiles")
+    parser.add_argument(
+        "--nvertices", type=int, nargs="+", default=[250, 500, 1000],
+        help="nvertex of the lens correction solves")
+    parser.add_argument(
+        "--montage_sizes", type=int, nargs="+", default=[100, 400, 1600],
+        help="approximate number of tiles of the montage sections")
+    parser.add_argument(
+        "--templates", nargs="+",
+        default=["affine_template.json", "polynomial_template.json"],
+        help="montage solver templates, relative to --template_dir")
+    parser.add_argument("--template_dir", default=template_dir)
+    parser.add_argument(
+        "--work_dir", default=os.path.join(
+            tempfile.gettempdir(), "em_stitch_calibration"),
+        help="where the synthetic sections are kept between runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--worker", nargs=2, metavar=("JOB", "RECORD"),
+        help=argparse.SUPPRESS)
+    a = parser.parse_args()
+
+    if a.worker:
+        with open(a.worker[0], "r") as f:
+            record = run_worker(json.load(f))
+        with open(a.worker[1], "w") as f:
+            json.dump(record, f)
+        return
+
+    table = {
+        "version": cost_estimate.calibration_version,
+        "machine": {
+            "node": platform.node(),
+            "cpu": platform.processor() or platform.machine(),
+            "system": platform.system()},
+        "lens_correction": [],
+        "montage": []}
+
+    for grid in a.lens_grids:
+        data_dir = lens_section(a.work_dir, grid, a.seed)
+        for nvertex in a.nvertices:
+            r = measure("lens_correction", {
+                "data_dir": data_dir,
+                "nvertex": nvertex,
+                "ransac_thresh": ransac_thresh,
+                "regularization": regularization,
+                "dump_linear_system": True})
+            if r is None:
+                continue
+            table["lens_correction"].append(r)
+            print("lens %dx%d nvertex %5d: %8d point pairs %7.2f s "
+                  "%7.1f MB" % (
+                      grid, grid, nvertex, r["n_point_pairs"],
+                      r["wall_time"], r["peak_memory_mb"]))
+
+    for n in a.montage_sizes:
+        data_dir, _ = section(a.work_dir, n, a.seed, 0.05)
+        for k in sorted({1, len(a.templates)}):
+            templates = a.templates[:k]
+            r = measure("montage", {
+                "data_dir": data_dir,
+                "ref_transform": None,
+                "ransacReprojThreshold": montage_ransac_thresh,
+                "solver_template_dir": a.template_dir,
+                "solver_templates": templates})
+            if r is None:
+                continue
+            table["montage"].append(r)
+            print("montage %6d tiles %d templates: %8d point pairs "
+                  "%7.2f s %7.1f MB" % (
+                      r["n_tiles"], len(templates), r["n_point_pairs"],
+                      r["wall_time"], r["peak_memory_mb"]))
+
+    with open(a.output, "w") as f:
+        json.dump(table, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print("wrote %d lens correction and %d montage records to %s" % (
+        len(table["lens_correction"]), len(table["montage"]), a.output))
+
+
+if __name__ == "__main__":
+    main()
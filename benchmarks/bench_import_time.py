@@ -0,0 +1,66 @@
+"""report import cost of the em_stitch entry points using
+python -X importtime, each in a fresh interpreter
+
+    python benchmarks/bench_import_time.py --top 15
+    python benchmarks/bench_import_time.py em_stitch.montage.montage_solver
+"""
+import argparse
+import collections
+import re
+import subprocess
+import sys
+
+entry_points = [
+    "em_stitch.lens_correction.lens_correction_solver",
+    "em_stitch.lens_correction.mesh_and_solve_transform",
+    "em_stitch.montage.montage_solver",
+    "em_stitch.montage.montage_batch",
+    "em_stitch.viz.set_update_upload",
+    "em_stitch.plots.montage_plots",
+    "em_stitch.plots.view_matches",
+    "em_stitch.plots.lens_quiver_plots",
+]
+
+_line = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def import_times(module):
+    """self and cumulative import time in microseconds for every
+    module imported by a fresh interpreter importing module"""
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = collections.OrderedDict()
+    for line in p.stderr.splitlines():
+        m = _line.match(line)
+        if m:
+            times[m.group(4)] = (int(m.group(1)), int(m.group(2)))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("modules", nargs="*", default=entry_points)
+    parser.add_argument(
+        "--top", type=int, default=10,
+        help="number of top-level packages to list per entry point")
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="take the fastest of this many runs")
+    a = parser.parse_args()
+
+    for module in a.modules:
+        runs = [import_times(module) for _ in range(a.repeat)]
+        best = min(runs, key=lambda t: t[module][1])
+        print("%s: %.1f ms" % (module, best[module][1] / 1e3))
+
+        # attribute self time to top-level packages
+        packages = collections.Counter()
+        for name, (self_us, _) in best.items():
+            packages[name.split(".")[0]] += self_us
+        for name, self_us in packages.most_common(a.top):
+            print("    %-24s %8.1f ms" % (name, self_us / 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""pytest-benchmark suite of the lens correction hot paths
+
+    pip install pytest-benchmark
+    pytest benchmarks/bench_lens.py
+    pytest benchmarks/bench_lens.py -k "barycentrics or create_A" \
+        --benchmark-autosave
+    pytest benchmarks/bench_lens.py --benchmark-compare
+
+Sizes are parameterized by the number of mesh vertices (nvertex) and
+by the factor by which the point matches of the lens_example data are
+scaled up (see conftest.py). The whole solver is run on synthetic
+data from em_stitch.lens_correction.synthetic. The file is not named
+test_*.py, so the benchmarks only run when asked for.
+
+The solve backends of em_stitch.lens_correction.solve_replay are
+compared on the example system, and on the .npz linear systems in
+$EM_STITCH_SOLVE_CORPUS, e.g. dumped by production runs with
+dump_linear_system:
+
+    EM_STITCH_SOLVE_CORPUS=/data/solves pytest benchmarks/bench_lens.py \
+        -k replay
+"""
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from em_stitch.lens_correction import mesh_and_solve_transform as mst
+from em_stitch.lens_correction.lens_correction_solver import (
+        LensCorrectionSolver)
+from em_stitch.lens_correction.solve_replay import (
+        dump_system, linear_system_name, load_system, replay)
+from em_stitch.lens_correction.synthetic import (
+        GenerateSyntheticLensData, distortion_error, load_expected_transform)
+from em_stitch.lens_correction.utils import maps_from_tform
+
+from conftest import ransac_thresh, regularization
+
+nvertices = [250, 1000, 4000]
+factors = [1, 4, 16]
+replay_backends = ['factorized', 'spsolve', 'cg']
+solve_corpus = sorted(glob.glob(os.path.join(
+    os.environ['EM_STITCH_SOLVE_CORPUS'], '*.npz'))) if (
+        'EM_STITCH_SOLVE_CORPUS' in os.environ) else []
+
+
+def _seeded(func):
+    # smooth_density draws from the global numpy RNG
+    def wrapper(*args, **kwargs):
+        np.random.seed(0)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@pytest.mark.parametrize('factor', factors)
+def test_condense_coords(bench, scaled_matches, factor):
+    matches = scaled_matches(factor)
+    coords = bench(mst.condense_coords, matches)
+    assert coords.shape[0] == 2 * sum(
+        len(m['matches']['p'][0]) for m in matches)
+
+
+@pytest.mark.parametrize('legacy', [False, True], ids=['bbox', 'legacy'])
+@pytest.mark.parametrize('factor', factors)
+def test_smooth_density(
+        bench, lens_example, scaled_matches, factor, legacy):
+    coords = mst.condense_coords(scaled_matches(factor))
+    smoothed = bench(
+        _seeded(mst.smooth_density), coords,
+        lens_example['width'], lens_example['height'], 10,
+        legacy_smooth_density=legacy)
+    assert 0 < smoothed.shape[0] <= coords.shape[0]
+
+
+@pytest.mark.parametrize('nvertex', nvertices)
+def test_find_delaunay_with_max_vertices(bench, lens_example, nvertex):
+    mesh, _ = bench(
+        mst.find_delaunay_with_max_vertices, lens_example['bbox'], nvertex)
+    assert mesh.points.shape[0] <= nvertex
+
+
+@pytest.mark.parametrize('nvertex', nvertices)
+def test_force_vertices_with_npoints(
+        bench, lens_example, scaled_matches, nvertex):
+    np.random.seed(0)
+    coords = mst.smooth_density(
+        mst.condense_coords(scaled_matches(1)),
+        lens_example['width'], lens_example['height'], 10)
+    _, area_par = mst.find_delaunay_with_max_vertices(
+        lens_example['bbox'], nvertex)
+    mesh, _ = bench(
+        mst.force_vertices_with_npoints,
+        area_par, lens_example['bbox'], coords, 3)
+    assert mst.count_points_near_vertices(mesh, coords).min() >= 3
+
+
+@pytest.mark.parametrize('legacy', [False, True], ids=['native', 'legacy'])
+@pytest.mark.parametrize('factor', factors)
+@pytest.mark.parametrize('nvertex', nvertices)
+def test_compute_barycentrics(
+        bench, meshes, scaled_matches, nvertex, factor, legacy):
+    if legacy and (factor > 4):
+        pytest.skip("legacy barycentrics are too slow at this size")
+    mesh, _ = meshes(nvertex)
+    coords = mst.condense_coords(scaled_matches(factor))
+    bcoords, _ = bench(
+        mst.compute_barycentrics, coords, mesh, legacy_barycentrics=legacy)
+    assert np.allclose(bcoords.sum(axis=1), 1.0)
+
+
+@pytest.mark.parametrize('bincount', [True, False], ids=['bincount', 'loop'])
+@pytest.mark.parametrize('factor', factors)
+@pytest.mark.parametrize('nvertex', nvertices)
+def test_count_points_near_vertices(
+        bench, meshes, scaled_matches, nvertex, factor, bincount):
+    mesh, _ = meshes(nvertex)
+    coords = mst.condense_coords(scaled_matches(factor))
+    pt_count = bench(
+        mst.count_points_near_vertices, mesh, coords,
+        count_bincount=bincount)
+    assert pt_count.size == mesh.npoints
+
+
+@pytest.mark.parametrize('factor', factors)
+@pytest.mark.parametrize('nvertex', nvertices)
+def test_create_A(
+        bench, lens_example, meshes, scaled_matches, nvertex, factor):
+    mesh, _ = meshes(nvertex)
+    matches = scaled_matches(factor)
+    A, _, _, lens_dof_start = bench(
+        mst.create_A, matches, lens_example['tilespecs'], mesh)
+    assert A.shape == (
+        sum(len(m['matches']['p'][0]) for m in matches),
+        lens_dof_start + mesh.npoints)
+
+
+@pytest.mark.parametrize('factor', factors)
+@pytest.mark.parametrize('nvertex', nvertices)
+def test_solve(bench, systems, nvertex, factor):
+    s = systems(nvertex, factor)
+    solution, errx, erry = bench(
+        mst.solve, s['A'], s['weights'], s['reg'], s['x0'], s['b'])
+    assert np.allclose(solution[0], s['solution'][0])
+
+
+@pytest.mark.parametrize('backend', replay_backends)
+@pytest.mark.parametrize(
+    'source', ['example'] + solve_corpus,
+    ids=lambda source: os.path.basename(source))
+def test_solve_replay(bench, tmpdir, meshes, systems, source, backend):
+    if source == 'example':
+        s = systems(1000, 4)
+        source = dump_system(
+            str(tmpdir.join(linear_system_name)), s['A'], s['weights'],
+            s['reg'], s['x0'], s['b'], meshes(1000)[0], s['lens_dof_start'])
+    system = load_system(source)
+    solution, errx, erry = bench(replay, system, backend)
+    assert errx.size == system['A'].shape[0]
+
+
+@pytest.mark.parametrize('nvertex', nvertices)
+def test_create_thinplatespline_tf(bench, meshes, systems, nvertex):
+    mesh, _ = meshes(nvertex)
+    s = systems(nvertex, 1)
+    tf = bench.pedantic(
+        mst.create_thinplatespline_tf,
+        args=(mesh, s['solution'], s['lens_dof_start']),
+        rounds=3)
+    assert tf.srcPts.shape[1] <= mesh.npoints
+
+
+@pytest.mark.parametrize('res', [64, 32, 16])
+def test_maps_from_tform(bench, lens_example, lens_transform, res):
+    map1, map2, mask = bench.pedantic(
+        maps_from_tform,
+        args=(lens_transform, lens_example['width'], lens_example['height']),
+        kwargs={'res': res},
+        rounds=3)
+    assert mask.shape == (lens_example['height'], lens_example['width'])
+
+
+@pytest.mark.parametrize('grid', [3, 10])
+def test_lens_correction_solver(bench, tmpdir_factory, grid):
+    """the whole solver on synthetic data, grid x grid tiles. Larger
+    datasets can be written with
+    python -m em_stitch.lens_correction.synthetic"""
+    data_dir = str(tmpdir_factory.mktemp('synthetic_lens'))
+    gen = GenerateSyntheticLensData(input_data={
+        'output_dir': data_dir, 'n_rows': grid, 'n_cols': grid,
+        'outlier_fraction': 0.05, 'log_level': 'WARNING'}, args=[])
+    gen.run()
+    solver_args = {
+        'data_dir': data_dir, 'output_dir': data_dir,
+        'ransac_thresh': ransac_thresh, 'nvertex': 1000,
+        'regularization': regularization, 'log_level': 'WARNING'}
+
+    def run():
+        np.random.seed(0)
+        lcs = LensCorrectionSolver(input_data=dict(solver_args), args=[])
+        lcs.run()
+        return lcs
+    lcs = bench.pedantic(run, rounds=1)
+
+    expected, _ = load_expected_transform(
+        gen.results['expected_transform'])
+    error = distortion_error(
+        expected, lcs.solver.new_ref_transform,
+        gen.args['tile_width'], gen.args['tile_height'])
+    bench.extra_info.update(
+        n_point_pairs=gen.results['n_point_pairs'],
+        distortion_error=error['mean'])
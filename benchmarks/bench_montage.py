@@ -0,0 +1,84 @@
+"""pytest-benchmark suite of the montage hot paths
+
+    pytest benchmarks/bench_montage.py
+    pytest benchmarks/bench_montage.py -k "filter or solve" \
+        --benchmark-autosave
+
+Sizes are the number of tiles of synthetic sections from
+em_stitch.montage.synthetic (see conftest.py). The scaling to larger
+sections is measured by bench_montage_scaling.py.
+"""
+import os
+
+import pytest
+
+from em_stitch.montage import meta_to_collection
+from em_stitch.montage.montage_solver import (
+        do_solve, make_raw_tilespecs, make_resolved, montage_filter_matches)
+from em_stitch.utils.metafile import Metafile
+
+from conftest import montage_ransac_thresh, test_files_dir
+
+sizes = [100, 1000]
+templates = ['affine_template.json', 'polynomial_template.json']
+
+
+def parse_metafile(path):
+    return Metafile(path).json
+
+
+@pytest.mark.parametrize('n_tiles', sizes)
+def test_parse_metafile(bench, montage_sections, n_tiles):
+    section = montage_sections(n_tiles)
+    j = bench(parse_metafile, section['metafile'].path)
+    assert len(j[1]['data']) == len(section['rawspecs'])
+
+
+@pytest.mark.parametrize('n_tiles', sizes)
+def test_meta_to_collection(bench, montage_sections, n_tiles):
+    section = montage_sections(n_tiles)
+    matches = bench(
+        meta_to_collection.main, [section['data_dir']],
+        metafile=section['metafile'])
+    assert len(matches) == len(section['matches'])
+
+
+@pytest.mark.parametrize('n_tiles', sizes)
+def test_montage_filter_matches(bench, montage_sections, n_tiles):
+    matches = montage_sections(n_tiles)['matches']
+    bench(montage_filter_matches, matches, montage_ransac_thresh)
+    assert all(len(m['matches']['w']) for m in matches)
+
+
+@pytest.mark.parametrize('n_tiles', sizes)
+def test_make_raw_tilespecs(bench, tmpdir, montage_sections, n_tiles):
+    section = montage_sections(n_tiles)
+    rawspecs, z = bench(
+        make_raw_tilespecs, section['metafile'], str(tmpdir),
+        section['group_id'], False)
+    assert len(rawspecs) == len(section['rawspecs'])
+
+
+@pytest.mark.parametrize('n_tiles', sizes)
+def test_make_resolved(bench, tmpdir, montage_sections, n_tiles):
+    section = montage_sections(n_tiles)
+    resolved = bench(
+        make_resolved, section['rawspecs'], section['tform'], str(tmpdir),
+        False)
+    assert os.path.isfile(resolved)
+
+
+@pytest.mark.parametrize('template', templates)
+@pytest.mark.parametrize('n_tiles', sizes)
+def test_solve(bench, montage_sections, n_tiles, template):
+    section = montage_sections(n_tiles)
+    args = {
+        'input_stack': {'input_file': section['input_stack']},
+        'output_stack': {'compress_output': False},
+        'pointmatch': {'input_file': section['collection']},
+        'first_section': section['z'],
+        'last_section': section['z']}
+    result = bench.pedantic(
+        do_solve, args=(os.path.join(test_files_dir, template), args, 0),
+        rounds=3)
+    assert result['template'] == template
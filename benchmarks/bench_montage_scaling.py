@@ -0,0 +1,165 @@
+"""per-stage scaling of the montage pipeline on synthetic sections
+
+    python benchmarks/bench_montage_scaling.py
+    python benchmarks/bench_montage_scaling.py --sizes 10 100 1000 \
+        --templates affine_template.json --json scaling.json --plot s.png
+
+For each size a section of about that many tiles is generated with
+em_stitch.montage.synthetic (kept in --work_dir, so later runs reuse
+it) and the stages of MontageSolver are timed on it: parsing the
+metafile, meta_to_collection, montage_filter_matches,
+make_raw_tilespecs, make_resolved and each solve template. The
+report lists the seconds per stage and size, and the exponent k of
+time ~ n_tiles**k between consecutive sizes.
+"""
+import argparse
+import json
+import math
+import os
+import tempfile
+import time
+
+from em_stitch.montage import meta_to_collection
+from em_stitch.montage.montage_solver import (
+        do_solve, get_transform, make_raw_tilespecs, make_resolved,
+        montage_filter_matches)
+from em_stitch.montage.synthetic import GenerateSyntheticMontageData
+from em_stitch.utils import jsongz
+from em_stitch.utils.metafile import Metafile
+
+template_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "integration_tests", "test_files")
+
+
+def section(work_dir, n, seed, outlier_fraction):
+    """synthetic section of about n tiles, generated once"""
+    n_rows = max(1, int(math.sqrt(n)))
+    n_cols = max(2, int(round(float(n) / n_rows)))
+    data_dir = os.path.join(
+        work_dir, "montage_%dx%d_%d" % (n_rows, n_cols, seed))
+    gen = GenerateSyntheticMontageData(input_data={
+        "output_dir": data_dir,
+        "n_rows": n_rows,
+        "n_cols": n_cols,
+        "seed": seed,
+        "outlier_fraction": outlier_fraction,
+        "log_level": "WARNING"}, args=[])
+    if not os.path.isfile(os.path.join(
+            data_dir, "_metadata_synthetic_%d.json" % seed)):
+        gen.run()
+    return data_dir, n_rows * n_cols
+
+
+def timed(times, stage, func, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - t0
+    times[stage] = min(times.get(stage, elapsed), elapsed)
+    return result
+
+
+def run_stages(data_dir, out_dir, templates, thresh, times):
+    metafile_path = os.path.join(
+        data_dir,
+        [f for f in os.listdir(data_dir) if f.startswith("_metadata")][0])
+    metafile = Metafile(metafile_path)
+    timed(times, "parse_metafile", lambda: metafile.json)
+    matches = timed(
+        times, "meta_to_collection",
+        meta_to_collection.main, [data_dir], metafile=metafile)
+    timed(times, "montage_filter_matches",
+          montage_filter_matches, matches, thresh)
+    collection = jsongz.dump(
+        matches, os.path.join(out_dir, "collection.json"), compress=False)
+    group_id = matches[0]["pGroupId"]
+    rawspecs, z = timed(
+        times, "make_raw_tilespecs",
+        make_raw_tilespecs, metafile, out_dir, group_id, False)
+    tform = get_transform(metafile, None, None, "metafile")
+    input_stack = timed(
+        times, "make_resolved",
+        make_resolved, rawspecs, tform, out_dir, False)
+    args = {
+        "input_stack": {"input_file": input_stack},
+        "output_stack": {"compress_output": False},
+        "pointmatch": {"input_file": collection},
+        "first_section": z,
+        "last_section": z}
+    for i, template in enumerate(templates):
+        timed(times, "solve_%s" % os.path.splitext(
+            os.path.basename(template))[0],
+              do_solve, template, args, i)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000],
+        help="approximate number of tiles of each section")
+    parser.add_argument(
+        "--templates", nargs="+",
+        default=["affine_template.json", "polynomial_template.json"],
+        help="solver templates, relative to --template_dir")
+    parser.add_argument("--template_dir", default=template_dir)
+    parser.add_argument(
+        "--work_dir", default=os.path.join(
+            tempfile.gettempdir(), "em_stitch_montage_scaling"),
+        help="where the synthetic sections are kept between runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--outlier_fraction", type=float, default=0.05)
+    parser.add_argument("--thresh", type=float, default=10.0)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", help="also write the results here")
+    parser.add_argument(
+        "--plot", help="also plot the scaling curves to this image")
+    a = parser.parse_args()
+
+    templates = [os.path.join(a.template_dir, t) for t in a.templates]
+    results = []
+    for n in a.sizes:
+        data_dir, n_tiles = section(
+            a.work_dir, n, a.seed, a.outlier_fraction)
+        times = {}
+        for _ in range(a.repeat):
+            with tempfile.TemporaryDirectory() as out_dir:
+                run_stages(data_dir, out_dir, templates, a.thresh, times)
+        results.append({"n_tiles": n_tiles, "times": times})
+        print("%6d tiles: %.2f s" % (n_tiles, sum(times.values())))
+
+    stages = list(results[0]["times"])
+    print("\n%-24s" % "stage" +
+          "".join("%12d" % r["n_tiles"] for r in results))
+    for stage in stages:
+        print("%-24s" % stage +
+              "".join("%12.4f" % r["times"][stage] for r in results))
+    print("\nexponent k of time ~ n_tiles**k")
+    for stage in stages:
+        ks = []
+        for r0, r1 in zip(results[:-1], results[1:]):
+            ks.append(
+                math.log(r1["times"][stage] / r0["times"][stage]) /
+                math.log(float(r1["n_tiles"]) / r0["n_tiles"]))
+        print("%-24s" % stage + "".join("%12.2f" % k for k in ks))
+
+    if a.json:
+        with open(a.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if a.plot:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots()
+        n_tiles = [r["n_tiles"] for r in results]
+        for stage in stages:
+            ax.loglog(n_tiles, [r["times"][stage] for r in results],
+                      "o-", label=stage)
+        ax.set_xlabel("tiles")
+        ax.set_ylabel("seconds")
+        ax.legend(fontsize="small")
+        fig.savefig(a.plot)
+
+
+if __name__ == "__main__":
+    main()
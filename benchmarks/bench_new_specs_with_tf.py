@@ -0,0 +1,65 @@
+"""compare time and peak memory of the shallow (default) and deepcopy
+paths of new_specs_with_tf
+
+    python benchmarks/bench_new_specs_with_tf.py --ntiles 5000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import renderapi
+
+from em_stitch.lens_correction.mesh_and_solve_transform import (
+        new_specs_with_tf)
+
+
+def make_tilespecs(ntiles, nlevels):
+    tspecs = []
+    for i in range(ntiles):
+        ip = renderapi.image_pyramid.ImagePyramid({
+            str(lvl): renderapi.image_pyramid.MipMap(
+                imageUrl="file:///data/mipmaps/%d/tile_%06d.tif" % (lvl, i))
+            for lvl in range(nlevels)})
+        tspecs.append(renderapi.tilespec.TileSpec(
+            tileId="tile_%06d" % i, z=1, width=3840, height=3840,
+            minint=0, maxint=255, imagePyramid=ip,
+            tforms=[renderapi.transform.AffineModel(
+                B0=float(i % 100) * 3500.0, B1=float(i // 100) * 3500.0)]))
+    return tspecs
+
+
+def measure(tspecs, ref, tforms, deep):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    newspecs = new_specs_with_tf(ref, tspecs, tforms, deep=deep)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del newspecs
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ntiles", type=int, default=2000)
+    parser.add_argument("--nlevels", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    a = parser.parse_args()
+
+    tspecs = make_tilespecs(a.ntiles, a.nlevels)
+    ref = renderapi.transform.ThinPlateSplineTransform()
+    ref.transformId = "lens_correction"
+    tforms = [renderapi.transform.AffineModel(B0=float(i))
+              for i in range(a.ntiles)]
+
+    for deep in [True, False]:
+        res = np.array([
+            measure(tspecs, ref, tforms, deep) for _ in range(a.repeat)])
+        print("%-8s %8.4f s  peak %8.2f MB" % (
+            "deepcopy" if deep else "shallow",
+            res[:, 0].min(), res[:, 1].min() / 2**20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""fixtures for the benchmarks in bench_lens.py and bench_montage.py
+
+The lens inputs are derived from integration_tests/test_files/lens_example
+and scaled up synthetically, the montage inputs are synthetic sections,
+always from fixed seeds so that runs on different machines or commits
+time the same work.
+
+The benchmarks take the bench fixture, which wraps pytest-benchmark's
+benchmark. With --benchmark-memory the benchmarked function is called
+once more after timing, under tracemalloc, and the peak of the allocations
+during that call is stored as extra_info['peak_memory_mb'] (numpy
+reports its buffers to tracemalloc). regression.py uses it.
+"""
+import copy
+import os
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from em_stitch.lens_correction.lens_correction_solver import (
+        make_collection_json, one_file, tilespec_input_from_metafile)
+from em_stitch.lens_correction import mesh_and_solve_transform as mst
+from em_stitch.montage import meta_to_collection
+from em_stitch.montage.montage_solver import (
+        get_transform, make_raw_tilespecs, make_resolved,
+        montage_filter_matches)
+from em_stitch.montage.synthetic import GenerateSyntheticMontageData
+from em_stitch.utils import jsongz
+from em_stitch.utils.generate_EM_tilespecs_from_metafile import (
+        GenerateEMTileSpecsModule)
+from em_stitch.utils.metafile import Metafile
+
+test_files_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'integration_tests', 'test_files')
+lens_example_dir = os.path.join(test_files_dir, 'lens_example')
+
+# parameters of integration_tests/test_files/lens_solver_example.json
+ransac_thresh = 10
+regularization = {
+    'default_lambda': 1.0,
+    'lens_lambda': 1.0,
+    'translation_factor': 1e-3}
+
+# parameters of integration_tests/test_files/montage_solver_example.json
+montage_ransac_thresh = 10
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--benchmark-memory', action='store_true', default=False,
+        help='also record the peak traced memory of each benchmark')
+
+
+def scale_matches(matches, factor, width, height, sigma=2.0, seed=0):
+    """synthetic scale-up of a match collection
+
+    Parameters
+    ----------
+    matches : list of dict
+        render point matches
+    factor : int
+        number of copies of each point pair
+    width : int
+        tile width, jittered points are clipped to it
+    height : int
+        tile height
+    sigma : float
+        standard deviation [px] of the gaussian jitter of the copies
+    seed : int
+        seed of the jitter
+
+    Returns
+    -------
+    scaled : list of dict
+        matches with factor times as many point pairs, between the
+        same tiles
+    """
+    rng = np.random.RandomState(seed)
+    upper = np.array([[width - 1], [height - 1]])
+    scaled = []
+    for m in matches:
+        s = copy.deepcopy(m)
+        for pq in ['p', 'q']:
+            pts = np.tile(
+                np.array(m['matches'][pq], dtype='float64'), factor)
+            pts[:, pts.shape[1] // factor:] += rng.normal(
+                0, sigma, (2, pts.shape[1] - pts.shape[1] // factor))
+            s['matches'][pq] = np.clip(pts, 0, upper).tolist()
+        s['matches']['w'] = np.tile(
+            np.array(m['matches']['w']), factor).tolist()
+        scaled.append(s)
+    return scaled
+
+
+class PeakMemoryBenchmark(object):
+    """wraps the pytest-benchmark fixture, calling the benchmarked
+    function once more after timing to record its peak traced memory
+    in extra_info
+
+    Parameters
+    ----------
+    benchmark : pytest_benchmark.fixture.BenchmarkFixture
+        the benchmark fixture of the test
+    memory : bool
+        record the peak memory, else only time
+    """
+    def __init__(self, benchmark, memory):
+        self.benchmark = benchmark
+        self.memory = memory
+
+    def __getattr__(self, name):
+        return getattr(self.benchmark, name)
+
+    def _measure(self, function, args, kwargs):
+        tracing = tracemalloc.is_tracing()
+        if tracing and not hasattr(tracemalloc, 'reset_peak'):
+            # before Python 3.9 the peak is only reset by a restart
+            tracemalloc.stop()
+            tracemalloc.start()
+        elif not tracing:
+            tracemalloc.start()
+        try:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            function(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        self.benchmark.extra_info['peak_memory_mb'] = (
+            (peak - current) / 2.0**20)
+
+    def __call__(self, function_to_benchmark, *args, **kwargs):
+        result = self.benchmark(function_to_benchmark, *args, **kwargs)
+        if self.memory:
+            self._measure(function_to_benchmark, args, kwargs)
+        return result
+
+    def pedantic(self, target, args=(), kwargs=None, setup=None, **options):
+        result = self.benchmark.pedantic(
+            target, args=args, kwargs=kwargs, setup=setup, **options)
+        if self.memory:
+            if setup is not None:
+                args, kwargs = setup() or (args, kwargs)
+            self._measure(target, args, kwargs or {})
+        return result
+
+
+@pytest.fixture
+def bench(benchmark, request):
+    """the benchmark fixture, see :class:`PeakMemoryBenchmark`"""
+    return PeakMemoryBenchmark(
+        benchmark, request.config.getoption('--benchmark-memory'))
+
+
+@pytest.fixture(scope='session')
+def lens_example():
+    """tilespecs and filtered matches of the lens_example data
+
+    Returns
+    -------
+    data : dict
+        'tilespecs' (list of renderapi.tilespec.TileSpec), 'matches'
+        (filtered, zero weight matches removed), 'width', 'height'
+        and 'bbox' (the PSLG of the unmasked tile)
+    """
+    metafile = one_file(lens_example_dir, '_metadata*.json')
+    template = one_file(lens_example_dir, '_template*.json')
+    with tempfile.TemporaryDirectory() as output_dir:
+        tspecin = tilespec_input_from_metafile(
+            metafile, None, output_dir, 'WARNING', False)
+        gentspecs = GenerateEMTileSpecsModule(input_data=tspecin, args=[])
+        gentspecs.run()
+        tilespecs = gentspecs.render_tspecs
+        collection, _ = make_collection_json(
+            template, output_dir, ransac_thresh, False)
+        matches = jsongz.load(collection)
+    mst.remove_weighted_matches(matches, weight=0.0)
+    width, height = tilespecs[0].width, tilespecs[0].height
+    return {
+        'tilespecs': tilespecs,
+        'matches': matches,
+        'width': width,
+        'height': height,
+        'bbox': mst.create_PSLG(width, height, None)}
+
+
+@pytest.fixture(scope='session')
+def scaled_matches(lens_example):
+    """factor: scaled matches, computed once per session"""
+    scaled = {}
+
+    def get(factor):
+        if factor not in scaled:
+            scaled[factor] = scale_matches(
+                lens_example['matches'], factor,
+                lens_example['width'], lens_example['height'])
+        return scaled[factor]
+    return get
+
+
+@pytest.fixture(scope='session')
+def meshes(lens_example):
+    """nvertex: (mesh, area_par), as from _create_mesh with the
+    smoothing seeded"""
+    cache = {}
+
+    def get(nvertex):
+        if nvertex not in cache:
+            np.random.seed(0)
+            coords = mst.smooth_density(
+                mst.condense_coords(lens_example['matches']),
+                lens_example['width'], lens_example['height'], 10)
+            mesh, area_par = mst.find_delaunay_with_max_vertices(
+                lens_example['bbox'], nvertex)
+            cache[nvertex] = mst.force_vertices_with_npoints(
+                area_par, lens_example['bbox'], coords, 3)
+        return cache[nvertex]
+    return get
+
+
+@pytest.fixture(scope='session')
+def systems(lens_example, meshes, scaled_matches):
+    """(nvertex, factor): inputs of solve() and its solution"""
+    cache = {}
+
+    def get(nvertex, factor):
+        if (nvertex, factor) not in cache:
+            tilespecs = lens_example['tilespecs']
+            mesh, _ = meshes(nvertex)
+            A, weights, b, lens_dof_start = mst.create_A(
+                scaled_matches(factor), tilespecs, mesh)
+            x0 = mst.create_x0(A.shape[1], tilespecs)
+            reg = mst.create_regularization(
+                A.shape[1], len(tilespecs),
+                regularization['default_lambda'],
+                regularization['translation_factor'],
+                regularization['lens_lambda'])
+            solution, _, _ = mst.solve(A, weights, reg, x0, b)
+            cache[(nvertex, factor)] = {
+                'A': A, 'weights': weights, 'b': b, 'x0': x0, 'reg': reg,
+                'lens_dof_start': lens_dof_start, 'solution': solution}
+        return cache[(nvertex, factor)]
+    return get
+
+
+@pytest.fixture(scope='session')
+def lens_transform(meshes, systems):
+    """the lens correction of the example data with 1000 vertices"""
+    system = systems(1000, 1)
+    return mst.create_thinplatespline_tf(
+        meshes(1000)[0], system['solution'], system['lens_dof_start'])
+
+
+@pytest.fixture(scope='session')
+def montage_sections(tmpdir_factory):
+    """n_tiles: a synthetic section of about n_tiles tiles and the
+    inputs of each montage stage, as MontageSolver makes them"""
+    cache = {}
+
+    def get(n_tiles):
+        if n_tiles not in cache:
+            n_rows = int(np.sqrt(n_tiles))
+            data_dir = str(tmpdir_factory.mktemp('montage_%d' % n_tiles))
+            gen = GenerateSyntheticMontageData(input_data={
+                'output_dir': data_dir,
+                'n_rows': n_rows,
+                'n_cols': n_tiles // n_rows,
+                'outlier_fraction': 0.05,
+                'log_level': 'WARNING'}, args=[])
+            gen.run()
+            metafile = Metafile(gen.results['metafile'])
+            matches = meta_to_collection.main([data_dir], metafile=metafile)
+            montage_filter_matches(matches, montage_ransac_thresh)
+            group_id = matches[0]['pGroupId']
+            rawspecs, z = make_raw_tilespecs(
+                metafile, data_dir, group_id, False)
+            tform = get_transform(metafile, None, None, 'metafile')
+            cache[n_tiles] = {
+                'data_dir': data_dir,
+                'metafile': metafile,
+                'matches': matches,
+                'collection': jsongz.dump(
+                    matches, os.path.join(data_dir, 'collection.json'),
+                    compress=False),
+                'group_id': group_id,
+                'rawspecs': rawspecs,
+                'z': z,
+                'tform': tform,
+                'input_stack': make_resolved(
+                    rawspecs, tform, data_dir, False)}
+        return cache[n_tiles]
+    return get
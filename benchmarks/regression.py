@@ -0,0 +1,296 @@
+"""performance regression gate over the pytest-benchmark suites
+
+    python benchmarks/regression.py record benchmarks/baselines/ci.json
+    python benchmarks/regression.py check benchmarks/baselines/ci.json \
+        --tolerance 0.25 --report regression.txt
+
+record runs bench_lens.py and bench_montage.py with --benchmark-memory
+(without the slow legacy implementations by default) and writes the
+median time and peak traced memory of each benchmark to a baseline
+json, together with the versions of the dependencies in
+requirements.txt. check runs the same benchmarks and compares them to
+the baseline. A benchmark regresses when its median is more than
+--tolerance slower than the baseline (and by more than --min_delta
+seconds) or its peak memory grows by more than --memory_tolerance
+(and --min_memory_delta MB). A benchmark of the baseline that did not
+run also fails the check, so that deleting or renaming a slow
+benchmark does not pass it, unless --allow_missing is given.
+check exits with status 1 if any benchmark regresses, so it can gate
+a deployment.
+
+Both the baseline and the report list the benchmarks in a fixed order
+with rounded values, so that they can be kept in version control and
+diffed. The report starts with the dependencies whose versions differ
+from the baseline, the usual cause of silent slowdowns. Baselines only
+compare on the machine they were recorded on.
+
+An existing pytest-benchmark json (of a run with --benchmark-memory)
+is used instead of running the benchmarks with --input. Options not
+listed below are passed on to pytest.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+try:
+    from importlib.metadata import version as _version
+except ImportError:
+    import pkg_resources
+
+    def _version(name):
+        return pkg_resources.get_distribution(name).version
+
+baseline_version = 1
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+requirements = os.path.join(
+    os.path.dirname(benchmarks_dir), 'requirements.txt')
+default_files = ['bench_lens.py', 'bench_montage.py']
+default_select = 'not legacy and not loop'
+
+
+def dependency_versions(path=requirements):
+    """installed version of each requirement, None if not installed"""
+    versions = {'python': '%d.%d.%d' % sys.version_info[:3]}
+    with open(path, 'r') as f:
+        names = [re.split(r'[<>=!~;\[ ]', line.strip())[0] for line in f]
+    for name in filter(None, names):
+        try:
+            versions[name] = _version(name)
+        except Exception:
+            versions[name] = None
+    return versions
+
+
+def run_benchmarks(files, select, pytest_args):
+    """run the benchmarks in a fresh interpreter
+
+    Returns
+    -------
+    results : dict
+        the pytest-benchmark json of the run
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'benchmarks.json')
+        cmd = [sys.executable, '-m', 'pytest', '-p', 'no:cacheprovider',
+               '--benchmark-memory', '--benchmark-json', output]
+        if select:
+            cmd += ['-k', select]
+        cmd += [os.path.join(benchmarks_dir, f) for f in files]
+        subprocess.run(cmd + pytest_args, check=True)
+        with open(output, 'r') as f:
+            return json.load(f)
+
+
+def _round(x, digits=4):
+    return None if x is None else float('%.*g' % (digits, x))
+
+
+def summarize(results):
+    """baseline of a pytest-benchmark json
+
+    Parameters
+    ----------
+    results : dict
+        pytest-benchmark json
+
+    Returns
+    -------
+    summary : dict
+        'version', 'commit', 'machine', 'dependencies' and, by
+        benchmark name, its 'median' and 'iqr' [s], 'rounds' and
+        'peak_memory_mb'
+    """
+    machine = results['machine_info']
+    summary = {
+        'version': baseline_version,
+        'commit': results.get('commit_info', {}).get('id'),
+        'machine': {
+            'node': machine.get('node'),
+            'cpu': machine.get('cpu', {}).get('brand_raw'),
+            'system': machine.get('system')},
+        'dependencies': dependency_versions(),
+        'benchmarks': {}}
+    for b in results['benchmarks']:
+        name = b['fullname'].split('/')[-1]
+        summary['benchmarks'][name] = {
+            'median': _round(b['stats']['median']),
+            'iqr': _round(b['stats']['iqr']),
+            'rounds': b['stats']['rounds'],
+            'peak_memory_mb': _round(
+                b.get('extra_info', {}).get('peak_memory_mb'))}
+    return summary
+
+
+def compare(baseline, current, tolerance, memory_tolerance, min_delta,
+            min_memory_delta):
+    """compare the benchmarks of two summaries
+
+    Returns
+    -------
+    rows : list of dict
+        by benchmark name, the baseline and current 'median' and
+        'peak_memory_mb' and a 'status' of 'ok', 'faster', 'slower',
+        'memory', 'new' or 'missing', see :func:`regressions`
+    """
+    rows = []
+    names = set(baseline['benchmarks']) | set(current['benchmarks'])
+    for name in sorted(names):
+        base = baseline['benchmarks'].get(name)
+        cur = current['benchmarks'].get(name)
+        row = {'name': name, 'base': base, 'current': cur, 'status': 'ok'}
+        if base is None:
+            row['status'] = 'new'
+        elif cur is None:
+            row['status'] = 'missing'
+        else:
+            delta = cur['median'] - base['median']
+            mem0 = base.get('peak_memory_mb')
+            mem1 = cur.get('peak_memory_mb')
+            if (delta > tolerance * base['median']) and (delta > min_delta):
+                row['status'] = 'slower'
+            elif ((mem0 is not None) and (mem1 is not None) and
+                    (mem1 - mem0 > memory_tolerance * mem0) and
+                    (mem1 - mem0 > min_memory_delta)):
+                row['status'] = 'memory'
+            elif (-delta > tolerance * base['median']) and (
+                    -delta > min_delta):
+                row['status'] = 'faster'
+        rows.append(row)
+    return rows
+
+
+def regressions(rows, allow_missing=False):
+    """rows of compare() that fail the check: 'slower', 'memory' and,
+    unless allow_missing, 'missing'"""
+    failing = ('slower', 'memory')
+    if not allow_missing:
+        failing += ('missing',)
+    return [r for r in rows if r['status'] in failing]
+
+
+def format_report(baseline, current, rows, allow_missing=False):
+    """plain text report, one line per benchmark"""
+    lines = ['baseline commit %s, current commit %s' % (
+        baseline.get('commit'), current.get('commit'))]
+    deps = sorted(
+        set(baseline['dependencies']) | set(current['dependencies']))
+    changed = [
+        '  %s %s -> %s' % (
+            d, baseline['dependencies'].get(d),
+            current['dependencies'].get(d))
+        for d in deps
+        if baseline['dependencies'].get(d) !=
+        current['dependencies'].get(d)]
+    lines.append('changed dependencies:%s' % ('' if changed else ' none'))
+    lines += changed
+    lines.append('')
+
+    def fmt(x, f):
+        return '-' if x is None else f % x
+
+    width = max([len(r['name']) for r in rows] + [9])
+    lines.append('%-*s %10s %10s %7s %10s %10s  %s' % (
+        width, 'benchmark', 'base [s]', 'new [s]', 'ratio',
+        'base [MB]', 'new [MB]', 'status'))
+    for r in rows:
+        base = r['base'] or {}
+        cur = r['current'] or {}
+        ratio = None
+        if base and cur:
+            ratio = cur['median'] / base['median']
+        lines.append('%-*s %10s %10s %7s %10s %10s  %s' % (
+            width, r['name'],
+            fmt(base.get('median'), '%.4g'), fmt(cur.get('median'), '%.4g'),
+            fmt(ratio, '%.2f'),
+            fmt(base.get('peak_memory_mb'), '%.1f'),
+            fmt(cur.get('peak_memory_mb'), '%.1f'),
+            r['status']))
+    lines.append('')
+    lines.append('%d benchmarks, %d regressions' % (
+        len(rows), len(regressions(rows, allow_missing))))
+    return '\n'.join(lines) + '\n'
+
+
+def write_json(obj, path):
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['record', 'check'])
+    parser.add_argument('baseline', help='baseline json')
+    parser.add_argument(
+        '--files', nargs='+', default=default_files,
+        help='benchmark files, relative to benchmarks/')
+    parser.add_argument(
+        '--select', default=default_select,
+        help='pytest -k expression selecting the benchmarks')
+    parser.add_argument(
+        '--input', help='use this pytest-benchmark json, do not run')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='allowed relative increase of the median time')
+    parser.add_argument(
+        '--memory_tolerance', type=float, default=0.1,
+        help='allowed relative increase of the peak memory')
+    parser.add_argument(
+        '--min_delta', type=float, default=1e-3,
+        help='time differences below this [s] are never regressions')
+    parser.add_argument(
+        '--min_memory_delta', type=float, default=1.0,
+        help='memory increases below this [MB] are never regressions')
+    parser.add_argument(
+        '--allow_missing', action='store_true',
+        help='baseline benchmarks that did not run are not regressions')
+    parser.add_argument('--report', help='also write the report here')
+    parser.add_argument(
+        '--output', help='check: also write the new summary here')
+    # anything else, e.g. --benchmark-min-rounds=10, goes to pytest
+    a, pytest_args = parser.parse_known_args()
+
+    if a.input:
+        with open(a.input, 'r') as f:
+            results = json.load(f)
+    else:
+        results = run_benchmarks(a.files, a.select, pytest_args)
+    current = summarize(results)
+
+    if a.command == 'record':
+        dirname = os.path.dirname(os.path.abspath(a.baseline))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        write_json(current, a.baseline)
+        print('recorded %d benchmarks in %s' % (
+            len(current['benchmarks']), a.baseline))
+        return 0
+
+    with open(a.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('version') != baseline_version:
+        raise ValueError(
+            'baseline %s has version %s, expected %d, record it again' % (
+                a.baseline, baseline.get('version'), baseline_version))
+    rows = compare(
+        baseline, current, a.tolerance, a.memory_tolerance, a.min_delta,
+        a.min_memory_delta)
+    report = format_report(baseline, current, rows, a.allow_missing)
+    sys.stdout.write(report)
+    if a.report:
+        with open(a.report, 'w') as f:
+            f.write(report)
+    if a.output:
+        write_json(current, a.output)
+    return 1 if regressions(rows, a.allow_missing) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,21 @@
 import glob
-import json
 import logging
 import os
+import tempfile
 import warnings
 
-import cv2
 import numpy as np
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
-import renderapi
 
 from .schemas import LensCorrectionSchema
-from ..utils.generate_EM_tilespecs_from_metafile import (
-    GenerateEMTileSpecsModule)
+from ..utils import jsongz
 from ..utils import utils as common_utils
-from .mesh_and_solve_transform import MeshAndSolveTransform
+from ..utils.metafile import as_metafile
+from ..utils.instrumentation import Timings
+from ..utils.profiling import profiled
+from ..utils.stage_cache import stages_from_args
+from ..utils.transform_sidecar import load_lens_transform
 from . import utils
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -81,8 +81,8 @@ def tilespec_input_from_metafile(
 
     Parameters
     ----------
-    metafile : str
-        Path to the metafile.
+    metafile : str or em_stitch.utils.metafile.Metafile
+        Path to the metafile, or the parsed metafile.
     mask_file : str
         Path to the mask file.
     output_dir : str
@@ -97,17 +97,16 @@ def tilespec_input_from_metafile(
     Dict[str, Union[str, int, bool]]
         A dictionary containing the generated tilespec input data.
     """
-    result = {}
-    result['metafile'] = metafile
-
-    with open(metafile, 'r') as f:
-        jmeta = json.load(f)
+    metafile = as_metafile(metafile)
+    metadata = metafile.metadata
 
+    result = {}
+    result['metafile'] = metafile.path
     result['z'] = np.random.randint(0, 1000)
     result['minimum_intensity'] = 0
-    bpp = jmeta[0]['metadata']['camera_info']['camera_bpp']
+    bpp = metadata['camera_info']['camera_bpp']
     result['maximum_intensity'] = int(np.power(2, bpp) - 1)
-    result['sectionId'] = jmeta[0]['metadata']['grid']
+    result['sectionId'] = metadata['grid']
     result['maskUrl'] = mask_file
     result['output_path'] = os.path.join(output_dir, 'raw_tilespecs.json')
     result['log_level'] = log_level
@@ -155,6 +154,8 @@ def filter_match_collection(
     counts = []
     new_matches = []
 
+    common_utils.reset_cv2_rng()
+
     for i, m in enumerate(matches):
         input_n = len(m["matches"]["p"][0])
 
@@ -210,8 +211,7 @@ def make_collection_json(
     Tuple[str, List[Dict[str, int]]]
         A tuple containing the path to the collection file and a list of counts.
     """
-    with open(template_file, 'r') as f:
-        template_match_md = json.load(f)
+    template_match_md = jsongz.load(template_file)
 
     input_matches = template_match_md["collection"]
 
@@ -233,7 +233,14 @@ class LensCorrectionSolver(ArgSchemaParser):
         super(LensCorrectionSolver, self).__init__(*args, **kwargs)
         self.jtform = None
 
+    @profiled
     def run(self):
+        # heavy, so not imported with the module
+        import cv2
+        from ..utils.generate_EM_tilespecs_from_metafile import (
+            GenerateEMTileSpecsModule)
+        from .mesh_and_solve_transform import MeshAndSolveTransform
+
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(self.args['log_level'])
         utils.logger.setLevel(self.args['log_level'])
@@ -241,25 +248,73 @@ class LensCorrectionSolver(ArgSchemaParser):
         self.output_dir = self.args.get('output_dir', self.args['data_dir'])
         self.logger.info("destination directory:\n  %s" % self.output_dir)
 
-        tspecin = tilespec_input_from_metafile(
-                self.metafile,
-                self.args['mask_file'],
-                self.output_dir,
-                self.args['log_level'],
-                self.args['compress_output'])
-        gentspecs = GenerateEMTileSpecsModule(input_data=tspecin, args=[])
-        gentspecs.run()
-
-        assert os.path.isfile(gentspecs.args['output_path'])
+        self.solver = None
+        # stages reused from the manifest of an interrupted run in
+        # output_dir, or from the stage cache
+        self.stages = stages_from_args(self.args, self.output_dir)
+        timings = Timings()
+
+        # raw tilespecs
+        with timings.span('tilespecs') as span:
+            tilespecs_key = self.stages.key(
+                    'lens_tilespecs',
+                    files={
+                        'metafile_sha256': self.metafile,
+                        'mask_sha256': self.args['mask_file']},
+                    metafile=os.path.abspath(self.metafile),
+                    mask_file=self.args['mask_file'],
+                    compress=self.args['compress_output'])
+            record = self.stages.get(tilespecs_key)
+            if record is not None:
+                span.annotate(reused=record['source'])
+                tilespec_path = record['files']['raw_tilespecs']
+                tilespecs = jsongz.load(tilespec_path)
+            else:
+                metafile = as_metafile(self.metafile)
+                tspecin = tilespec_input_from_metafile(
+                        metafile,
+                        self.args['mask_file'],
+                        self.output_dir,
+                        self.args['log_level'],
+                        self.args['compress_output'])
+                gentspecs = GenerateEMTileSpecsModule(
+                        input_data=tspecin, args=[], metafile=metafile)
+                gentspecs.run()
+                tilespecs = gentspecs.tilespecs
+                tilespec_path = gentspecs.args['output_path']
+                self.stages.put(
+                        tilespecs_key,
+                        files={'raw_tilespecs': tilespec_path})
+            span.annotate(n_tiles=len(tilespecs))
+
+        assert os.path.isfile(tilespec_path)
         self.logger.info(
-                "raw tilespecs written:\n  %s" % gentspecs.args['output_path'])
-
-        collection_path, self.filter_counts = make_collection_json(
-                self.matchfile,
-                self.output_dir,
-                self.args['ransac_thresh'],
-                self.args['compress_output'],
-                self.args['ignore_match_indices'])
+                "raw tilespecs written:\n  %s" % tilespec_path)
+
+        # filtered matches
+        with timings.span('filter_matches') as span:
+            matches_key = self.stages.key(
+                    'lens_matches',
+                    files={'template_sha256': self.matchfile},
+                    ransac_thresh=self.args['ransac_thresh'],
+                    ignore_match_indices=self.args['ignore_match_indices'],
+                    compress=self.args['compress_output'])
+            record = self.stages.get(matches_key)
+            if record is not None:
+                span.annotate(reused=record['source'])
+                self.filter_counts = record['data']
+                collection_path = record['files']['collection']
+            else:
+                collection_path, self.filter_counts = make_collection_json(
+                        self.matchfile,
+                        self.output_dir,
+                        self.args['ransac_thresh'],
+                        self.args['compress_output'],
+                        self.args['ignore_match_indices'])
+                self.stages.put(
+                        matches_key,
+                        data=self.filter_counts,
+                        files={'collection': collection_path})
 
         self.n_from_gpu = np.array(
                 [i['n_from_gpu'] for i in self.filter_counts]).sum()
@@ -273,40 +328,104 @@ class LensCorrectionSolver(ArgSchemaParser):
         self.logger.info(
                 "filtered collection written:\n  %s" % collection_path)
 
+        # meshing and solving
         solver_args = {
                 'nvertex': self.args['nvertex'],
                 'regularization': self.args['regularization'],
                 'good_solve': self.args['good_solve'],
-                'tilespecs': gentspecs.tilespecs,
+                'tilespecs': tilespecs,
                 'match_file': collection_path,
                 'output_dir': self.output_dir,
                 'outfile': 'resolvedtiles.json.gz',
                 'compress_output': self.args['compress_output'],
                 'log_level': self.args['log_level'],
-                'timestamp': self.args['timestamp']}
-
-        self.solver = MeshAndSolveTransform(input_data=solver_args, args=[])
-        self.solver.run()
-
-        with open(self.solver.args['output_json'], 'r') as f:
-            j = json.load(f)
-        resolved_path = j['resolved_tiles']
-
-        resolvedtiles = renderapi.resolvedtiles.ResolvedTiles(
-                json=jsongz.load(resolved_path))
-
-        self.jtform = resolvedtiles.transforms[0].to_dict()
-
-        self.map1, self.map2, self.mask = utils.maps_from_tform(
-                renderapi.transform.ThinPlateSplineTransform(
-                    json=self.jtform),
-                resolvedtiles.tilespecs[0].width,
-                resolvedtiles.tilespecs[0].height,
-                res=32)
+                'timestamp': self.args['timestamp'],
+                'transform_sidecar': self.args['transform_sidecar'],
+                'dump_linear_system': self.args['dump_linear_system'],
+                'diagnostics': self.args['diagnostics']}
+
+        with timings.span('mesh_and_solve') as span:
+            solve_key = self.stages.key(
+                    'lens_solve',
+                    tilespecs=tilespecs_key,
+                    matches=matches_key,
+                    **{k: v for k, v in solver_args.items()
+                       if k not in [
+                           'tilespecs', 'match_file', 'output_dir',
+                           'log_level', 'dump_linear_system']})
+            record = self.stages.get(solve_key)
+            if record is not None:
+                span.annotate(reused=record['source'])
+                self.jtform = record['data']['transform']
+                # the solver's output_json is overwritten with the
+                # results of this module below, so it is not a stage file
+                output_json = os.path.join(
+                        self.output_dir, record['data']['output_json'])
+                j = record['data']['output']
+                # spans of the run that did this stage
+                j.pop('timings', None)
+                j['resolved_tiles'] = record['files'].get('resolved_tiles')
+                j['transform_sidecar'] = record['files'].get(
+                        'transform_sidecar')
+            else:
+                self.solver = MeshAndSolveTransform(
+                        input_data=solver_args, args=[])
+                self.solver.run()
+                output_json = self.solver.args['output_json']
+                j = jsongz.load(output_json)
+                solver_timings = j.pop('timings')
+
+                # the solver's results are still in memory, no need to read
+                # back the resolved tiles it wrote
+                self.jtform = self.solver.new_ref_transform.to_dict()
+                self.stages.put(
+                        solve_key,
+                        data={
+                            'transform': self.jtform,
+                            'output': dict(j),
+                            'output_json': os.path.basename(output_json)},
+                        files={
+                            'resolved_tiles': j['resolved_tiles'],
+                            'transform_sidecar': j['transform_sidecar']})
+        if self.solver is not None:
+            timings.update(solver_timings, prefix='mesh_and_solve')
+
+        # undistortion maps, only cached. They are not an output, and
+        # cheap next to the stages above
+        cache = self.stages.cache
+        with timings.span('maps') as span:
+            record = None
+            if cache is not None:
+                maps_key = cache.key('lens_maps', solve=solve_key, res=32)
+                record = cache.get(maps_key)
+            if record is not None:
+                span.annotate(reused='cache')
+                with np.load(record['files']['maps']) as maps:
+                    self.map1, self.map2, self.mask = (
+                        maps['map1'], maps['map2'], maps['mask'])
+            else:
+                if self.solver is not None:
+                    tform = self.solver.new_ref_transform
+                else:
+                    tform = load_lens_transform(j['resolved_tiles'])
+                self.map1, self.map2, self.mask = utils.maps_from_tform(
+                        tform,
+                        tilespecs[0]['width'],
+                        tilespecs[0]['height'],
+                        res=32)
+                if cache is not None:
+                    with tempfile.TemporaryDirectory(
+                            dir=cache.cache_dir) as tmp_dir:
+                        maps_path = os.path.join(tmp_dir, 'maps.npz')
+                        np.savez(
+                            maps_path,
+                            map1=self.map1, map2=self.map2, mask=self.mask)
+                        cache.put(maps_key, files={'maps': maps_path})
 
         maskname = os.path.join(self.output_dir, 'mask.png')
-        cv2.imwrite(maskname, self.mask)
-        self.logger.info("wrote:\n  %s" % maskname)
+        with timings.span('write_mask'):
+            cv2.imwrite(maskname, self.mask)
+            self.logger.info("wrote:\n  %s" % maskname)
 
         res = {}
         res['input'] = {}
@@ -314,14 +433,21 @@ class LensCorrectionSolver(ArgSchemaParser):
         res['input']['metafile'] = os.path.abspath(self.metafile)
         res['output'] = {}
         res['output']['resolved_tiles'] = j.pop('resolved_tiles')
+        res['output']['transform_sidecar'] = j.pop('transform_sidecar')
+        linear_system = j.pop('linear_system', None)
+        # only listed when written, not when the solve was reused
+        if (linear_system is not None) and (self.solver is not None):
+            res['output']['linear_system'] = linear_system
         res['output']['mask'] = os.path.abspath(maskname)
         res['output']['collection'] = os.path.abspath(collection_path)
+        if 'diagnostics' in j:
+            res['diagnostics'] = j.pop('diagnostics')
         res['residual stats'] = j
+        res['timings'] = timings.to_dict()
 
-        self.args['output_json'] = self.solver.args['output_json']
+        self.args['output_json'] = output_json
 
-        with open(self.args['output_json'], 'w') as f:
-            json.dump(res, f, indent=2)
+        jsongz.dump(res, self.args['output_json'], indent=2)
 
     def check_for_files(self):
         self.metafile = one_file(self.args['data_dir'], '_metadata*')
@@ -1,43 +1,66 @@
 import copy
 import datetime
+import functools
 import logging
 import os
 
 from six.moves import urllib
 
-import cv2
 import numpy as np
-import scipy.optimize
 import scipy.sparse as sparse
 from scipy.sparse import csr_matrix
-from scipy.sparse.linalg import factorized
 from scipy.spatial import Delaunay
-import triangle
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
 import renderapi
 
 from .schemas import MeshLensCorrectionSchema
 from .utils import remove_weighted_matches
+from ..utils import jsongz
+from ..utils.instrumentation import Timings
+from ..utils.profiling import profiled
+from ..utils.transform_sidecar import write_sidecar
 
-try:
-    # pandas unique is faster than numpy, use where appropriate
-    import pandas
-    _uniq = pandas.unique
-except ImportError:
-    import numpy
-    _uniq = numpy.unique
+# cv2, triangle, scipy.optimize, scipy.sparse.linalg and pandas are
+# slow to import and only needed by some of the functions below, so
+# they are imported where they are used.
+
+
+@functools.lru_cache(maxsize=None)
+def _get_uniq():
+    try:
+        # pandas unique is faster than numpy, use where appropriate
+        import pandas
+        return pandas.unique
+    except ImportError:
+        return np.unique
+
+
+def _uniq(values):
+    return _get_uniq()(values)
 
 
 logger = logging.getLogger()
 default_logger = logger
 
+# written to output_dir when a solve with diagnostics fails
+diagnostics_name = 'solve_diagnostics.json'
+
 
 class MeshLensCorrectionException(Exception):
     """Exception raised when there is a
     problem creating a mesh lens correction
+
+    Parameters
+    ----------
+    message : str
+        error message
+    diagnostics : dict
+        :func:`solve_diagnostics` of a failed solve, if computed
     """
+    def __init__(self, message, diagnostics=None):
+        super(MeshLensCorrectionException, self).__init__(message)
+        self.diagnostics = diagnostics
 
 
 def condense_coords(matches):
@@ -89,7 +112,7 @@ def smooth_density_legacy(coords, tile_width, tile_height, n):
         Nx2 numpy array of smoothed subset of input coords
     """
     # n: area divided into nxn
-    min_count = np.Inf
+    min_count = np.inf
     for i in range(n):
         r = np.arange(
                 (i*tile_width/n),
@@ -256,6 +279,8 @@ def approx_snap_contour(contour, width, height, epsilon=20, snap_dist=5):
     approx : numpy.ndarray
         Polygon approximating the contour
     """
+    import cv2
+
     # approximate contour within epsilon pixels,
     # so it isn't too fine in the corner
     # and snap to edges
@@ -302,6 +327,8 @@ def create_PSLG(tile_width, tile_height, maskUrl):
                 [2, 3],
                 [3, 0]])
     else:
+        import cv2
+
         mpath = urllib.parse.unquote(
                     urllib.parse.urlparse(maskUrl).path)
         im = cv2.imread(mpath, 0)
@@ -345,6 +372,8 @@ def calculate_mesh(a, bbox, target, get_t=False):
         Delaunay triangulation if get_t is True, otherwise the number of
         vertices in the triangulation subtracted from the target
     """
+    import triangle
+
     t = triangle.triangulate(bbox, 'pqa%0.1f' % a)
     if get_t:
         # scipy.Delaunay has nice find_simplex method,
@@ -418,6 +447,8 @@ def find_delaunay_with_max_vertices(bbox, nvertex):
     a : float
         area constraint used in the optimized triangulation
     """
+    import scipy.optimize
+
     # find bracketing values
     a1 = a2 = 1e6
     t1 = calculate_mesh(a1, bbox, nvertex)
@@ -649,12 +680,18 @@ def create_thinplatespline_tf(
     return transform
 
 
-def new_specs_with_tf(ref_transform, tilespecs, transforms):
+def new_specs_with_tf(ref_transform, tilespecs, transforms, deep=False):
     """create a copy of each tilespec in tilespecs with the first transform
     being a reference to ref_transform and the second based on transforms
     provided in transforms.
     This likely expects a single transformation in the input tilespecs.
 
+    By default the copies are shallow: the image pyramid, layout and
+    other metadata are shared with the input tilespecs and only the
+    transform list is new.  Neither the input nor the output tilespecs
+    should be modified in place other than through their transform
+    lists.
+
     Parameters
     ----------
     ref_transform : renderapi.transform.Transform
@@ -666,6 +703,8 @@ def new_specs_with_tf(ref_transform, tilespecs, transforms):
     transforms : list of renderapi.transform.Transform
         list of transforms of same length as tilespecs to apply as transform\
         at index 1 of each tilespec
+    deep : bool
+        deepcopy each tilespec instead of sharing its unchanged parts
 
     Returns
     -------
@@ -674,7 +713,11 @@ def new_specs_with_tf(ref_transform, tilespecs, transforms):
     """
     newspecs = []
     for i in range(len(tilespecs)):
-        newspecs.append(copy.deepcopy(tilespecs[i]))
+        if deep:
+            newspecs.append(copy.deepcopy(tilespecs[i]))
+        else:
+            newspecs.append(copy.copy(tilespecs[i]))
+            newspecs[-1].tforms = list(tilespecs[i].tforms)
         newspecs[-1].tforms.insert(0,
                                    renderapi.transform.ReferenceTransform(
                                     refId=ref_transform.transformId))
@@ -719,6 +762,8 @@ def solve(A, weights, reg, x0, b, precomputed_ATW=None, precomputed_ATWA=None,
     ATW = (A.transpose().dot(weights)
            if precomputed_ATW is None else precomputed_ATW)
     if precomputed_K_factorized is None:
+        from scipy.sparse.linalg import factorized
+
         K = (ATW.dot(A) if precomputed_ATWA is None
              else precomputed_ATWA) + reg
         K_factorized = factorized(K)
@@ -738,6 +783,30 @@ def solve(A, weights, reg, x0, b, precomputed_ATW=None, precomputed_ATWA=None,
     return solution, errx, erry
 
 
+def solve_is_good(errx, erry, good_solve_dict):
+    """whether the residuals of a solve meet the good_solve criteria
+
+    Parameters
+    ----------
+    errx : numpy.ndarray
+        x residuals
+    erry : numpy.ndarray
+        y residuals
+    good_solve_dict : dict
+        with 'error_mean' and 'error_std' [pixels]
+
+    Returns
+    -------
+    good : bool
+        True if the mean and std of both are below the limits
+    """
+    return all([
+            errx.mean() < good_solve_dict['error_mean'],
+            erry.mean() < good_solve_dict['error_mean'],
+            errx.std() < good_solve_dict['error_std'],
+            erry.std() < good_solve_dict['error_std']])
+
+
 def report_solution(errx, erry, transforms, criteria):
     """compile results, statistics, and messages for reporting information
     about lens correction solves
@@ -791,6 +860,100 @@ def report_solution(errx, erry, transforms, criteria):
     return translation, jresult, message
 
 
+def solve_diagnostics(A, weights, reg, lens_dof_start, errx, erry,
+                      tileIds=None, tol=1e-3):
+    """size, fill-in and conditioning of a solve, and its residuals by
+    tile pair
+
+    The tile pair of each row of A is read from its tile columns, +1
+    for p and -1 for q, as laid out by :func:`create_A`.
+
+    Parameters
+    ----------
+    A : :class:`scipy.sparse.csr`
+        the matrix, N (equations) x M (degrees of freedom)
+    weights : :class:`scipy.sparse.csr_matrix`
+        N x N diagonal matrix containing weights
+    reg : :class:`scipy.sparse.csr_matrix`
+        M x M diagonal matrix containing regularizations
+    lens_dof_start : int
+        first lens column of A, the number of tiles
+    errx : numpy.ndarray
+        x residuals
+    erry : numpy.ndarray
+        y residuals
+    tileIds : list of str
+        tileId of each tile column, tile indices are reported if None
+    tol : float
+        relative tolerance of the Lanczos eigenvalue estimates
+
+    Returns
+    -------
+    diagnostics : dict
+        'A' and 'K' (= A^T W A + reg) shape and nnz, 'fill_in' (nnz of
+        the LU factors of K over nnz of K), 'eigenvalues' (largest and
+        smallest of K), 'condition_number', 'points_per_vertex' (min,
+        median, max rows touching each mesh vertex) and 'tile_pairs',
+        the residual rms of each tile pair, worst first
+    """
+    from scipy.sparse.linalg import LinearOperator, eigsh, splu
+
+    K = (A.transpose().dot(weights).dot(A) + reg).tocsc()
+    lu = splu(K)
+    # a few Lanczos steps on K and on its inverse
+    lmax = eigsh(
+        K, k=1, which='LA', tol=tol, return_eigenvectors=False)[0]
+    Kinv = LinearOperator(K.shape, matvec=lu.solve, dtype='float64')
+    lmin = 1.0 / eigsh(
+        Kinv, k=1, which='LA', tol=tol, return_eigenvectors=False)[0]
+
+    vertex_rows = np.bincount(
+        A.indices, minlength=A.shape[1])[lens_dof_start:]
+
+    # tile pair of each row
+    nrows = A.shape[0]
+    row = np.repeat(np.arange(nrows), np.diff(A.indptr))
+    tile = A.indices < lens_dof_start
+    p = np.zeros(nrows, dtype='int64')
+    q = np.zeros(nrows, dtype='int64')
+    sel = tile & (A.data > 0)
+    p[row[sel]] = A.indices[sel]
+    sel = tile & (A.data < 0)
+    q[row[sel]] = A.indices[sel]
+
+    used = weights.diagonal() > 0
+    keys, inverse, counts = np.unique(
+        p[used] * lens_dof_start + q[used],
+        return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    msx = np.bincount(inverse, weights=errx[used]**2) / counts
+    msy = np.bincount(inverse, weights=erry[used]**2) / counts
+    rms = np.sqrt(msx + msy)
+    names = tileIds if tileIds is not None else range(lens_dof_start)
+    names = np.array(names)
+    pairs = []
+    for i in np.argsort(-rms):
+        pairs.append({
+            'pId': names[keys[i] // lens_dof_start].item(),
+            'qId': names[keys[i] % lens_dof_start].item(),
+            'n': int(counts[i]),
+            'rms_x': float(np.round(np.sqrt(msx[i]), 3)),
+            'rms_y': float(np.round(np.sqrt(msy[i]), 3)),
+            'rms': float(np.round(rms[i], 3))})
+
+    return {
+        'A': {'shape': list(A.shape), 'nnz': int(A.nnz)},
+        'K': {'shape': list(K.shape), 'nnz': int(K.nnz)},
+        'fill_in': float(lu.L.nnz + lu.U.nnz) / K.nnz,
+        'eigenvalues': {'max': float(lmax), 'min': float(lmin)},
+        'condition_number': float(lmax / lmin),
+        'points_per_vertex': {
+            'min': int(vertex_rows.min()),
+            'median': float(np.median(vertex_rows)),
+            'max': int(vertex_rows.max())},
+        'tile_pairs': pairs}
+
+
 def create_x0(nrows, tilespecs):
     """create initialization array x0
 
@@ -1042,7 +1205,8 @@ def _solve_resolvedtiles(
         resolvedtiles, matches, nvertex, regularization_lambda,
         regularization_translation_factor, regularization_lens_lambda,
         good_solve_dict,
-        logger=default_logger, **kwargs):
+        logger=default_logger, linear_system_path=None, diagnostics=False,
+        **kwargs):
     """generate lens correction from resolvedtiles and pointmatches
 
     Parameters
@@ -1063,6 +1227,11 @@ def _solve_resolvedtiles(
         dictionary to define when a solve fails
     logger : logging.Logger
         logger to use in reporting
+    linear_system_path : str
+        if not None, the linear system and mesh are written here before
+        solving, see :mod:`em_stitch.lens_correction.solve_replay`
+    diagnostics : bool
+        add the :func:`solve_diagnostics` of the solve to jresult
     Returns
     -------
     resolved : renderapi.resolvedtiles.ResolvedTiles
@@ -1070,14 +1239,18 @@ def _solve_resolvedtiles(
     new_ref_transform : renderapi.transform.leaf.ThinPlateSplineTransform
         derived lens correction transform
     jresult : dict
-        dictionary of solve information
+        dictionary of solve information, with the time and memory of
+        each step under 'timings'
     """
+    timings = Timings()
 
     # FIXME this is done twice -- think through
     tilespecs = resolvedtiles.tilespecs
     example_tspec = tilespecs[0]
 
-    mesh = _create_mesh(resolvedtiles, matches, nvertex, **kwargs)
+    with timings.span('mesh') as span:
+        mesh = _create_mesh(resolvedtiles, matches, nvertex, **kwargs)
+        span.annotate(n_vertices=int(mesh.points.shape[0]))
 
     nend = mesh.points.shape[0]
 
@@ -1091,21 +1264,37 @@ def _solve_resolvedtiles(
                 "mesh coarser than intended")
 
     # prepare the linear algebra and solve
-    A, weights, b, lens_dof_start = create_A(
-        matches, tilespecs, mesh)
-
-    x0 = create_x0(
-        A.shape[1], tilespecs)
-
-    reg = create_regularization(
-        A.shape[1],
-        len(tilespecs),
-        regularization_lambda,
-        regularization_translation_factor,
-        regularization_lens_lambda)
-
-    solution, errx, erry = solve(
-        A, weights, reg, x0, b)
+    with timings.span('create_A') as span:
+        A, weights, b, lens_dof_start = create_A(
+            matches, tilespecs, mesh)
+
+        x0 = create_x0(
+            A.shape[1], tilespecs)
+
+        reg = create_regularization(
+            A.shape[1],
+            len(tilespecs),
+            regularization_lambda,
+            regularization_translation_factor,
+            regularization_lens_lambda)
+        span.annotate(
+            n_rows=int(A.shape[0]), n_cols=int(A.shape[1]),
+            nnz=int(A.nnz))
+
+    if linear_system_path is not None:
+        from .solve_replay import dump_system
+        with timings.span('dump_linear_system'):
+            dump_system(
+                linear_system_path, A, weights, reg, x0, b, mesh,
+                lens_dof_start,
+                good_solve=good_solve_dict,
+                tileIds=[t.tileId for t in tilespecs])
+        logger.info(
+            "wrote linear system:\n  %s" % linear_system_path)
+
+    with timings.span('solve'):
+        solution, errx, erry = solve(
+            A, weights, reg, x0, b)
 
     transforms = create_transforms(
         len(tilespecs), solution)
@@ -1115,19 +1304,37 @@ def _solve_resolvedtiles(
 
     logger.info(solve_message)
 
+    jresult['linear_system'] = linear_system_path
+
+    summary = ''
+    if diagnostics:
+        with timings.span('diagnostics'):
+            jresult['diagnostics'] = solve_diagnostics(
+                A, weights, reg, lens_dof_start, errx, erry,
+                tileIds=[t.tileId for t in tilespecs])
+        d = jresult['diagnostics']
+        summary = (
+            "\n  condition number %0.3g, fill-in %0.1f, "
+            "worst tile pairs (rms px): %s" % (
+                d['condition_number'], d['fill_in'],
+                ', '.join(
+                    "%s-%s %0.2f" % (p['pId'], p['qId'], p['rms'])
+                    for p in d['tile_pairs'][:3])))
+        logger.info(summary)
+
     # check quality of solution
-    if not all([
-            errx.mean() < good_solve_dict['error_mean'],
-            erry.mean() < good_solve_dict['error_mean'],
-            errx.std() < good_solve_dict['error_std'],
-            erry.std() < good_solve_dict['error_std']]):
+    if not solve_is_good(errx, erry, good_solve_dict):
         raise MeshLensCorrectionException(
-                "Solve not good: %s" % solve_message)
+                "Solve not good: %s%s" % (solve_message, summary),
+                diagnostics=jresult.get('diagnostics'))
 
     logger.debug(solve_message)
 
-    new_ref_transform = create_thinplatespline_tf(
-        mesh, solution, lens_dof_start, logger)
+    with timings.span('thinplatespline') as span:
+        new_ref_transform = create_thinplatespline_tf(
+            mesh, solution, lens_dof_start, logger)
+        span.annotate(
+            n_control_points=int(new_ref_transform.srcPts.shape[1]))
 
     bbox = example_tspec.bbox_transformed(tf_limit=0)
     tbbox = new_ref_transform.tform(bbox)
@@ -1138,8 +1345,9 @@ def _solve_resolvedtiles(
                 tbbox[i, 0], tbbox[i, 1])
         logger.info(bstr)
 
-    new_tilespecs = new_specs_with_tf(
-        new_ref_transform, tilespecs, transforms)
+    with timings.span('new_specs'):
+        new_tilespecs = new_specs_with_tf(
+            new_ref_transform, tilespecs, transforms)
 
     stage_affine = estimate_stage_affine(tilespecs, new_tilespecs)
     sastr = (
@@ -1153,6 +1361,7 @@ def _solve_resolvedtiles(
     resolved = renderapi.resolvedtiles.ResolvedTiles(
             tilespecs=new_tilespecs,
             transformList=[new_ref_transform])
+    jresult['timings'] = timings.to_dict()
     return resolved, new_ref_transform, jresult
 
 
@@ -1184,6 +1393,12 @@ class MeshAndSolveTransform(ArgSchemaParser):
         else:
             self.matches = jsongz.load(self.args['match_file'])
 
+        linear_system_path = None
+        if self.args['dump_linear_system']:
+            from .solve_replay import linear_system_name
+            linear_system_path = os.path.abspath(os.path.join(
+                self.args['output_dir'], linear_system_name))
+
         return _solve_resolvedtiles(
             renderapi.resolvedtiles.ResolvedTiles(
                 tilespecs=self.tilespecs, transformList=[]),
@@ -1192,27 +1407,52 @@ class MeshAndSolveTransform(ArgSchemaParser):
             self.args["regularization"]["translation_factor"],
             self.args["regularization"]["lens_lambda"],
             self.args["good_solve"],
-            logger=self.logger
+            logger=self.logger,
+            linear_system_path=linear_system_path,
+            diagnostics=self.args['diagnostics']
             )
 
+    @profiled
     def run(self):
-        self.resolved, self.new_ref_transform, jresult = (
-            self.solve_resolvedtiles_from_args())
+        timings = Timings()
+        with timings.span('solve_resolvedtiles'):
+            try:
+                self.resolved, self.new_ref_transform, jresult = (
+                    self.solve_resolvedtiles_from_args())
+            except MeshLensCorrectionException as e:
+                if (e.diagnostics is not None) and (
+                        self.args.get('output_dir')):
+                    # most wanted for the solves that fail
+                    path = jsongz.dump(
+                        e.diagnostics,
+                        os.path.join(
+                            self.args['output_dir'], diagnostics_name),
+                        compress=False, indent=2)
+                    self.logger.error(
+                        "wrote diagnostics of the failed solve:\n  %s" % (
+                            path))
+                raise
+        timings.update(jresult.pop('timings'), prefix='solve_resolvedtiles')
 
         new_path = None
+        sidecar = None
         if 'outfile' in self.args:
             fname = self.args['outfile']
             if self.args['timestamp']:
                 spf = fname.split(os.extsep, 1)
                 spf[0] += '_%s' % self.new_ref_transform.transformId
                 fname = os.extsep.join(spf)
-            new_path = jsongz.dump(
-                    self.resolved.to_dict(),
-                    os.path.join(
-                        self.args['output_dir'],
-                        fname),
-                    compress=self.args['compress_output'])
-            new_path = os.path.abspath(new_path)
+            with timings.span('write_resolvedtiles'):
+                new_path = jsongz.dump(
+                        self.resolved.to_dict(),
+                        os.path.join(
+                            self.args['output_dir'],
+                            fname),
+                        compress=self.args['compress_output'])
+                new_path = os.path.abspath(new_path)
+                if self.args['transform_sidecar']:
+                    sidecar = write_sidecar(
+                        self.new_ref_transform, new_path)
 
         fname = 'output.json'
         if self.args['timestamp']:
@@ -1223,6 +1463,8 @@ class MeshAndSolveTransform(ArgSchemaParser):
                 fname)
 
         jresult['resolved_tiles'] = new_path
+        jresult['transform_sidecar'] = sidecar
+        jresult['timings'] = timings.to_dict()
 
         self.output(jresult, indent=2)
 
@@ -89,6 +89,28 @@ class MeshLensCorrectionSchema(ArgSchema):
         missing=False,
         default=False,
         description="add a timestamp to basename output")
+    transform_sidecar = Boolean(
+        required=False,
+        missing=True,
+        default=True,
+        description=("also write the lens correction transform to a "
+                     "binary .npz next to the resolved tiles json"))
+    dump_linear_system = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("before solving, write the assembled linear "
+                     "system and mesh to linear_system.npz in "
+                     "output_dir, to be re-run by "
+                     "em_stitch.lens_correction.solve_replay"))
+    diagnostics = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("also report the size, fill-in and estimated "
+                     "condition number of the normal equations and "
+                     "the residual rms of each tile pair. Costs an "
+                     "extra factorization"))
 
     @mm.post_load
     def one_of_two(self, data):
@@ -141,3 +163,173 @@ class LensCorrectionSchema(ArgSchema):
         missing=False,
         default=False,
         description="add a timestamp to basename output")
+    transform_sidecar = Boolean(
+        required=False,
+        missing=True,
+        default=True,
+        description=("also write the lens correction transform to a "
+                     "binary .npz next to the resolved tiles json"))
+    dump_linear_system = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("before solving, write the assembled linear "
+                     "system and mesh to linear_system.npz in "
+                     "output_dir, to be re-run by "
+                     "em_stitch.lens_correction.solve_replay"))
+    diagnostics = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("also report the size, fill-in and estimated "
+                     "condition number of the normal equations and "
+                     "the residual rms of each tile pair. Costs an "
+                     "extra factorization"))
+    cache_dir = Str(
+        required=False,
+        missing=None,
+        default=None,
+        description=("directory of a stage result cache. Stages whose "
+                     "inputs are unchanged reuse prior results. "
+                     "None to disable"))
+    cache_max_bytes = Int(
+        required=False,
+        missing=2**32,
+        default=2**32,
+        allow_none=True,
+        description=("size of the stage result cache above which the "
+                     "least recently used entries are evicted. "
+                     "None for no limit"))
+    force_recompute = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("recompute all stages, replacing their cached "
+                     "results"))
+    resume = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("skip the stages an earlier run in output_dir "
+                     "completed with the same inputs, as recorded in "
+                     "its stage_manifest.json"))
+
+
+class SyntheticLensDataSchema(ArgSchema):
+    output_dir = OutputDir(
+        required=True,
+        description=("directory for the synthetic metafile, template "
+                     "matches and expected transform"))
+    seed = Int(
+        required=False,
+        missing=0,
+        default=0,
+        description="seed of all random choices")
+    tile_width = Int(
+        required=False,
+        missing=3840,
+        default=3840,
+        description="tile width [pixels]")
+    tile_height = Int(
+        required=False,
+        missing=3840,
+        default=3840,
+        description="tile height [pixels]")
+    n_rows = Int(
+        required=False,
+        missing=3,
+        default=3,
+        description="rows of the tile grid")
+    n_cols = Int(
+        required=False,
+        missing=3,
+        default=3,
+        description="columns of the tile grid")
+    overlap = Float(
+        required=False,
+        missing=0.6,
+        default=0.6,
+        description=("overlap of neighboring tiles as a fraction of "
+                     "the tile size"))
+    stage_error = Float(
+        required=False,
+        missing=2.0,
+        default=2.0,
+        description=("standard deviation [pixels] of the difference "
+                     "between the true and the recorded tile positions"))
+    pixel_size = Float(
+        required=False,
+        missing=4.0,
+        default=4.0,
+        description="pixel size [nm] recorded in the metafile")
+    distortion_transform = InputFile(
+        required=False,
+        missing=None,
+        default=None,
+        description=("json of a render ThinPlateSplineTransform to use "
+                     "as the ground truth distortion. If not set, a "
+                     "radial distortion with a random smooth component "
+                     "is generated"))
+    distortion_scale = Float(
+        required=False,
+        missing=20.0,
+        default=20.0,
+        description=("largest displacement [pixels] of the generated "
+                     "distortion"))
+    n_control = Int(
+        required=False,
+        missing=8,
+        default=8,
+        description=("control points per side of the generated "
+                     "distortion"))
+    match_density = Float(
+        required=False,
+        missing=80.0,
+        default=80.0,
+        description=("point pairs per megapixel of overlap between "
+                     "two tiles"))
+    min_overlap = Float(
+        required=False,
+        missing=0.1,
+        default=0.1,
+        description=("smallest overlap, as a fraction of the tile "
+                     "area, of tile pairs that get matches"))
+    match_noise = Float(
+        required=False,
+        missing=0.5,
+        default=0.5,
+        description=("standard deviation [pixels] of the localization "
+                     "error of matched points"))
+    outlier_fraction = Float(
+        required=False,
+        missing=0.0,
+        default=0.0,
+        description=("fraction of point pairs replaced by random "
+                     "outliers"))
+
+
+class SolveReplaySchema(ArgSchema):
+    input_file = InputFile(
+        required=True,
+        description=("linear system written by MeshAndSolveTransform "
+                     "with dump_linear_system"))
+    backends = List(
+        Str(validate=mm.validate.OneOf(
+            ['factorized', 'spsolve', 'cg', 'cholmod'])),
+        required=False,
+        missing=['factorized'],
+        default=['factorized'],
+        description=("solvers to run. factorized is the one of "
+                     "MeshAndSolveTransform, cholmod needs "
+                     "scikit-sparse"))
+    repeat = Int(
+        required=False,
+        missing=1,
+        default=1,
+        description="runs of each backend, the fastest is reported")
+    diagnostics = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("also report the solve_diagnostics of the system, "
+                     "with the residuals of the first backend"))
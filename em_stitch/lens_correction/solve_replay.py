@@ -0,0 +1,260 @@
+"""re-run lens correction solves from the linear systems written by
+MeshAndSolveTransform with dump_linear_system.
+
+The .npz holds everything :func:`mesh_and_solve_transform.solve` needs,
+and the mesh, so a slow or failed solve can be reproduced, and solvers
+compared on it, without the tilespecs, matches or output directory it
+came from:
+
+    python -m em_stitch.lens_correction.solve_replay \\
+        --input_file linear_system.npz --backends factorized cg
+
+Each backend factorizes (or iteratively solves) the same normal
+equations K = A^T W A + reg. The residuals are judged by the good_solve
+criteria of the original run.
+"""
+import json
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse import csr_matrix
+
+from argschema import ArgSchemaParser
+
+from . import mesh_and_solve_transform as mst
+from .schemas import SolveReplaySchema
+from ..utils.profiling import profiled
+
+try:
+    from sksparse.cholmod import cholesky
+except ImportError:
+    cholesky = None
+
+example = {
+        "input_file": "/data/em-131fs3/lctest/T4_6/001738/0/linear_system.npz",
+        "backends": ["factorized", "spsolve", "cg"],
+        "repeat": 3,
+        "log_level": "INFO"
+        }
+
+linear_system_name = 'linear_system.npz'
+linear_system_version = 1
+
+
+def _diagonal(values):
+    # as create_A and create_regularization make them
+    m = sparse.eye(values.size, dtype='float64', format='csr')
+    m.data = values.astype('float64')
+    return m
+
+
+def dump_system(path, A, weights, reg, x0, b, mesh, lens_dof_start,
+                **metadata):
+    """write a lens correction linear system to a compressed .npz
+
+    Parameters
+    ----------
+    path : str
+        destination
+    A, weights, reg, x0, b :
+        arguments of :func:`mesh_and_solve_transform.solve`
+    mesh : scipy.spatial.Delaunay
+        the mesh of the lens degrees of freedom
+    lens_dof_start : int
+        first lens column of A
+    metadata :
+        json serializable values stored with the system, e.g.
+        good_solve criteria and tileIds
+
+    Returns
+    -------
+    path : str
+        path of the written file
+    """
+    A = csr_matrix(A)
+    metadata = dict(
+        metadata,
+        version=linear_system_version,
+        lens_dof_start=int(lens_dof_start))
+    # write then rename so readers never see a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(
+            f,
+            metadata=np.array(json.dumps(metadata)),
+            A_data=A.data,
+            A_indices=A.indices,
+            A_indptr=A.indptr,
+            A_shape=np.array(A.shape),
+            weights=weights.diagonal(),
+            reg=reg.diagonal(),
+            x0=np.array(x0),
+            b=b,
+            mesh_points=mesh.points,
+            mesh_simplices=mesh.simplices)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_system(path):
+    """read a linear system written by :func:`dump_system`
+
+    Returns
+    -------
+    system : dict
+        'A', 'weights', 'reg', 'x0' and 'b' as passed to
+        :func:`mesh_and_solve_transform.solve`, 'mesh_points',
+        'mesh_simplices', 'lens_dof_start' and 'metadata'
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        metadata = json.loads(str(npz['metadata']))
+        if metadata['version'] != linear_system_version:
+            raise mst.MeshLensCorrectionException(
+                "%s has version %s, expected %d" % (
+                    path, metadata['version'], linear_system_version))
+        return {
+            'A': csr_matrix(
+                (npz['A_data'], npz['A_indices'], npz['A_indptr']),
+                shape=tuple(npz['A_shape'])),
+            'weights': _diagonal(npz['weights']),
+            'reg': _diagonal(npz['reg']),
+            'x0': list(npz['x0']),
+            'b': npz['b'],
+            'mesh_points': npz['mesh_points'],
+            'mesh_simplices': npz['mesh_simplices'],
+            'lens_dof_start': metadata.pop('lens_dof_start'),
+            'metadata': metadata}
+
+
+def _factorized(K):
+    from scipy.sparse.linalg import factorized
+    return factorized(K)
+
+
+def _spsolve(K):
+    from scipy.sparse.linalg import spsolve
+    K = K.tocsc()
+    return lambda Lm: spsolve(K, Lm)
+
+
+def _cg(K):
+    from scipy.sparse.linalg import LinearOperator, cg
+    # jacobi preconditioner
+    d = 1.0 / K.diagonal()
+    M = LinearOperator(K.shape, matvec=lambda x: d * x)
+
+    def solve(Lm):
+        x, info = cg(K, Lm, M=M)
+        if info != 0:
+            raise mst.MeshLensCorrectionException(
+                "cg did not converge (info %d)" % info)
+        return x
+    return solve
+
+
+def _cholmod(K):
+    if cholesky is None:
+        raise ImportError("the cholmod backend needs scikit-sparse")
+    return cholesky(K.tocsc())
+
+
+# backend: function of K returning a solve function of the right hand
+# side, passed to mesh_and_solve_transform.solve as
+# precomputed_K_factorized
+backends = {
+    'factorized': _factorized,
+    'spsolve': _spsolve,
+    'cg': _cg,
+    'cholmod': _cholmod}
+
+
+def replay(system, backend='factorized'):
+    """solve a loaded linear system
+
+    Parameters
+    ----------
+    system : dict
+        from :func:`load_system`
+    backend : str
+        key of :data:`backends`
+
+    Returns
+    -------
+    solution : list of numpy.ndarray
+        x and y solutions
+    errx : numpy.ndarray
+        x residuals
+    erry : numpy.ndarray
+        y residuals
+    """
+    A = system['A']
+    ATW = A.transpose().dot(system['weights'])
+    ATWA = ATW.dot(A)
+    return mst.solve(
+        A, system['weights'], system['reg'], system['x0'], system['b'],
+        precomputed_ATW=ATW, precomputed_ATWA=ATWA,
+        precomputed_K_factorized=backends[backend](ATWA + system['reg']))
+
+
+class SolveReplay(ArgSchemaParser):
+    default_schema = SolveReplaySchema
+
+    @profiled
+    def run(self):
+        system = load_system(self.args['input_file'])
+        good_solve = system['metadata'].get('good_solve')
+        A = system['A']
+        self.logger.info(
+            "%s: %d x %d, %d nonzeros, %d mesh vertices" % (
+                self.args['input_file'], A.shape[0], A.shape[1], A.nnz,
+                system['mesh_points'].shape[0]))
+
+        self.results = {
+            'input_file': self.args['input_file'],
+            'n_rows': int(A.shape[0]),
+            'n_cols': int(A.shape[1]),
+            'nnz': int(A.nnz),
+            'backends': {}}
+        reference = None
+        for backend in self.args['backends']:
+            wall_times = []
+            for i in range(self.args['repeat']):
+                t0 = time.perf_counter()
+                solution, errx, erry = replay(system, backend)
+                wall_times.append(time.perf_counter() - t0)
+            result = {
+                'wall_time': min(wall_times),
+                'x': {'mean': float(errx.mean()), 'stdev': float(errx.std())},
+                'y': {'mean': float(erry.mean()), 'stdev': float(erry.std())},
+                'good_solve': None}
+            if good_solve is not None:
+                result['good_solve'] = bool(
+                    mst.solve_is_good(errx, erry, good_solve))
+            # difference from the first backend
+            if reference is None:
+                reference = solution
+                if self.args['diagnostics']:
+                    self.results['diagnostics'] = mst.solve_diagnostics(
+                        A, system['weights'], system['reg'],
+                        system['lens_dof_start'], errx, erry,
+                        tileIds=system['metadata'].get('tileIds'))
+            result['max_difference'] = float(max(
+                np.abs(s - r).max() for s, r in zip(solution, reference)))
+            self.results['backends'][backend] = result
+            self.logger.info(
+                "%-10s %8.3f s  residuals x %0.3f +/- %0.3f, "
+                "y %0.3f +/- %0.3f  max difference %0.2e" % (
+                    backend, result['wall_time'],
+                    result['x']['mean'], result['x']['stdev'],
+                    result['y']['mean'], result['y']['stdev'],
+                    result['max_difference']))
+
+        if 'output_json' in self.args:
+            self.output(self.results, indent=2)
+
+
+if __name__ == '__main__':
+    smod = SolveReplay(input_data=example)
+    smod.run()
@@ -0,0 +1,329 @@
+"""synthetic lens correction data with a known distortion.
+
+Writes a TEMCA style _metadata*.json and _template_matches*.json for a
+grid of tiles that all see the sample through the same ground truth
+ThinPlateSpline distortion, and the distortion itself, so that
+LensCorrectionSolver can be run on data of any size and its result
+compared to the truth with :func:`distortion_error`. No images are
+needed, and everything is determined by the seed.
+
+A point X of the sample is seen in tile i at the raw pixel p with
+D(p) + t_i = X, where D is the distortion and t_i the true position
+of the tile. The metafile records the positions with a stage_error.
+"""
+import os
+
+import numpy as np
+import renderapi
+
+from argschema import ArgSchemaParser
+
+from .schemas import SyntheticLensDataSchema
+from ..utils import jsongz
+from ..utils.generate_EM_tilespecs_from_metafile import (
+        GenerateEMTileSpecsModule)
+from ..utils.profiling import profiled
+
+example = {
+        "output_dir": "/data/em-131fs3/synthetic/lens_10x",
+        "seed": 0,
+        "n_rows": 10,
+        "n_cols": 10,
+        "outlier_fraction": 0.05,
+        "log_level": "INFO"
+        }
+
+expected_transform_name = 'expected_transform.json'
+
+
+def generate_distortion(width, height, scale, n_control, rng):
+    """a radial distortion with a random smooth component
+
+    Parameters
+    ----------
+    width : int
+        tile width
+    height : int
+        tile height
+    scale : float
+        largest displacement [pixels]
+    n_control : int
+        control points per side
+    rng : numpy.random.RandomState
+        random state
+
+    Returns
+    -------
+    tform : renderapi.transform.ThinPlateSplineTransform
+        maps raw tile pixels to undistorted ones
+    """
+    x, y = np.meshgrid(
+        np.linspace(0, width, n_control), np.linspace(0, height, n_control))
+    src = np.vstack((x.flatten(), y.flatten())).transpose()
+    center = np.array([width, height]) / 2.0
+    u = (src - center) / np.linalg.norm(center)
+    # barrel distortion, largest in the corners, and a random part
+    disp = 0.8 * (np.linalg.norm(u, axis=1)**2)[:, np.newaxis] * u
+    disp += 0.2 * rng.uniform(-1, 1, size=src.shape)
+    tform = renderapi.transform.ThinPlateSplineTransform()
+    tform.estimate(src, src + scale * disp, computeAffine=False)
+    tform.transformId = 'synthetic_lens'
+    return tform
+
+
+def tile_positions(n_rows, n_cols, width, height, overlap, stage_error, rng):
+    """recorded and true positions of a grid of tiles
+
+    Returns
+    -------
+    raster : numpy.ndarray
+        Nx2 (col, row) of each tile
+    recorded : numpy.ndarray
+        Nx2 integer positions [pixels] as recorded by the stage
+    true : numpy.ndarray
+        Nx2 positions [pixels] the tiles were acquired at
+    """
+    col, row = np.meshgrid(np.arange(n_cols), np.arange(n_rows))
+    raster = np.vstack((col.flatten(), row.flatten())).transpose()
+    step = np.array([width, height]) * (1.0 - overlap)
+    recorded = np.round(raster * step).astype('int64')
+    true = recorded + rng.normal(0, stage_error, size=recorded.shape)
+    return raster, recorded, true
+
+
+def pair_matches(
+        tform, ti, tj, width, height, density, min_overlap, noise,
+        outlier_fraction, rng):
+    """point pairs between two tiles
+
+    Parameters
+    ----------
+    tform : renderapi.transform.ThinPlateSplineTransform
+        ground truth distortion
+    ti : numpy.ndarray
+        true position of the first tile
+    tj : numpy.ndarray
+        true position of the second tile
+    width : int
+        tile width
+    height : int
+        tile height
+    density : float
+        point pairs per megapixel of overlap
+    min_overlap : float
+        no pairs for less overlap than this fraction of a tile
+    noise : float
+        standard deviation [pixels] of the localization error
+    outlier_fraction : float
+        fraction of pairs replaced by random points
+    rng : numpy.random.RandomState
+        random state
+
+    Returns
+    -------
+    p : numpy.ndarray
+        Nx2 points in the first tile, None if the tiles do not overlap
+    q : numpy.ndarray
+        Nx2 corresponding points in the second tile
+    n_outliers : int
+        number of outliers among them
+    """
+    size = np.array([width, height])
+    lower = np.maximum(ti, tj)
+    upper = np.minimum(ti, tj) + size
+    extent = upper - lower
+    if np.any(extent <= 0) or (np.prod(extent) < min_overlap * width * height):
+        return None, None, 0
+    n = int(round(density * np.prod(extent) / 1e6))
+    X = lower + rng.uniform(size=(n, 2)) * extent
+    p = tform.inverse_tform(X - ti) + rng.normal(0, noise, size=(n, 2))
+    q = tform.inverse_tform(X - tj) + rng.normal(0, noise, size=(n, 2))
+    n_outliers = int(round(outlier_fraction * n))
+    outliers = rng.choice(n, n_outliers, replace=False)
+    q[outliers] = rng.uniform(size=(n_outliers, 2)) * size
+    # the distortion moves some points out of the tiles
+    inside = np.all((p >= 0) & (p < size) & (q >= 0) & (q < size), axis=1)
+    n_outliers = int(np.count_nonzero(inside[outliers]))
+    return p[inside], q[inside], n_outliers
+
+
+def distortion_error(expected, recovered, width, height, npts=32):
+    """difference of a recovered lens correction from the truth
+
+    The lens correction is only determined up to an affine, which is
+    removed before comparing.
+
+    Parameters
+    ----------
+    expected : renderapi.transform.Transform
+        ground truth distortion
+    recovered : renderapi.transform.Transform
+        e.g. the transform of a LensCorrectionSolver run
+    width : int
+        tile width
+    height : int
+        tile height
+    npts : int
+        compare on a npts x npts grid over the tile
+
+    Returns
+    -------
+    error : dict
+        'mean', 'rms' and 'max' distance [pixels] on the grid
+    """
+    x, y = np.meshgrid(
+        np.linspace(0, width, npts), np.linspace(0, height, npts))
+    src = np.vstack((x.flatten(), y.flatten())).transpose()
+    e = expected.tform(src)
+    r = recovered.tform(src)
+    aff = renderapi.transform.AffineModel()
+    aff.estimate(r, e)
+    d = np.linalg.norm(aff.tform(r) - e, axis=1)
+    return {
+        'mean': float(d.mean()),
+        'rms': float(np.sqrt((d**2).mean())),
+        'max': float(d.max())}
+
+
+def load_expected_transform(path):
+    """ground truth distortion and tile positions written by
+    GenerateSyntheticLensData
+
+    Returns
+    -------
+    tform : renderapi.transform.ThinPlateSplineTransform
+        ground truth distortion
+    translations : dict
+        tileId: true [x, y] position of the tile
+    """
+    j = jsongz.load(path)
+    return (
+        renderapi.transform.ThinPlateSplineTransform(json=j['transform']),
+        j['translations'])
+
+
+class GenerateSyntheticLensData(ArgSchemaParser):
+    default_schema = SyntheticLensDataSchema
+
+    def metadata(self, grid):
+        return {
+            "calibration": {
+                "highmag": {
+                    "nm_per_pix": self.args['pixel_size'],
+                    "x_nm_per_pix": self.args['pixel_size'],
+                    "y_nm_per_pix": self.args['pixel_size'],
+                    "angle": 0.0}},
+            "camera_info": {
+                "width": self.args['tile_width'],
+                "height": self.args['tile_height'],
+                "pixel_depth": 1,
+                "camera_bpp": 8,
+                "camera_model": "synthetic",
+                "camera_id": "synthetic"},
+            "grid": grid,
+            "overlap": self.args['overlap'],
+            "roi_center": [0, 0],
+            "roi_index": 0,
+            "session_id": "synthetic",
+            "temca_id": "synthetic"}
+
+    @profiled
+    def run(self):
+        rng = np.random.RandomState(self.args['seed'])
+        width = self.args['tile_width']
+        height = self.args['tile_height']
+        pixel_size = self.args['pixel_size']
+
+        if self.args['distortion_transform'] is not None:
+            tform = renderapi.transform.ThinPlateSplineTransform(
+                json=jsongz.load(self.args['distortion_transform']))
+        else:
+            tform = generate_distortion(
+                width, height, self.args['distortion_scale'],
+                self.args['n_control'], rng)
+
+        raster, recorded, true = tile_positions(
+            self.args['n_rows'], self.args['n_cols'], width, height,
+            self.args['overlap'], self.args['stage_error'], rng)
+
+        grid = 'synthetic_%d' % self.args['seed']
+        data = []
+        for (col, row), pos in zip(raster, recorded):
+            data.append({
+                "img_path": "%s_0_%d_%d.tif" % (grid, col, row),
+                "img_meta": {
+                    "raster_index": len(data),
+                    "stage_pos": (pos * pixel_size).tolist(),
+                    "raster_pos": [int(col), int(row)],
+                    "pixel_size": pixel_size,
+                    "pixel_size_x_move": pixel_size,
+                    "pixel_size_y_move": pixel_size,
+                    "angle": 0.0}})
+        tile_ids = [
+            GenerateEMTileSpecsModule.tileId_from_basename(d['img_path'])
+            for d in data]
+
+        matches = []
+        n_outliers = 0
+        for i in range(len(data)):
+            for j in range(i + 1, len(data)):
+                p, q, n = pair_matches(
+                    tform, true[i], true[j], width, height,
+                    self.args['match_density'], self.args['min_overlap'],
+                    self.args['match_noise'],
+                    self.args['outlier_fraction'], rng)
+                if p is None:
+                    continue
+                n_outliers += n
+                matches.append({
+                    "pId": tile_ids[i],
+                    "qId": tile_ids[j],
+                    "pGroupId": grid,
+                    "qGroupId": grid,
+                    "matches": {
+                        "p": np.round(p.transpose(), 2).tolist(),
+                        "q": np.round(q.transpose(), 2).tolist(),
+                        "w": np.ones(p.shape[0]).tolist()}})
+
+        out_dir = self.args['output_dir']
+        metafile = jsongz.dump(
+            [{"metadata": self.metadata(grid)}, {"data": data}],
+            os.path.join(out_dir, "_metadata_%s_0_.json" % grid),
+            compress=False)
+        template = jsongz.dump(
+            {
+                "collection": matches,
+                "calibration": {"nm_per_pix": pixel_size, "angle": 0.0},
+                "tilespecs": [{
+                    "tileId": t,
+                    "xstage": d['img_meta']['stage_pos'][0],
+                    "ystage": d['img_meta']['stage_pos'][1]}
+                    for t, d in zip(tile_ids, data)]},
+            os.path.join(out_dir, "_template_matches_%s_0_.json" % grid),
+            compress=False)
+        expected = jsongz.dump(
+            {
+                "transform": tform.to_dict(),
+                "translations": dict(zip(tile_ids, true.tolist())),
+                "tile_width": width,
+                "tile_height": height},
+            os.path.join(out_dir, expected_transform_name),
+            compress=False)
+
+        self.results = {
+            "data_dir": out_dir,
+            "metafile": metafile,
+            "template_matches": template,
+            "expected_transform": expected,
+            "n_tiles": len(data),
+            "n_matches": len(matches),
+            "n_point_pairs": int(sum(
+                len(m['matches']['w']) for m in matches)),
+            "n_outliers": n_outliers}
+        if 'output_json' in self.args:
+            self.output(self.results, indent=2)
+
+
+if __name__ == '__main__':
+    gmod = GenerateSyntheticLensData(input_data=example)
+    gmod.run()
@@ -1,9 +1,7 @@
 import time
 import logging
 
-import cv2
 import numpy as np
-from scipy import ndimage
 
 import renderapi
 
@@ -62,6 +60,9 @@ def maps_from_tform(tform, width, height, block_size=10000, res=32):
         Tuple containing map1, map2, and mask arrays.
 
     """
+    import cv2
+    from scipy import ndimage
+
     t0 = time.time()
 
     x = np.arange(0, width + res, res)
@@ -5,12 +5,18 @@
 '''
 
 import argparse
+from collections import defaultdict
 from enum import IntEnum
 import glob
-import json
+import heapq
 import os
 import sys
 
+import numpy as np
+
+from em_stitch.utils.metafile import Metafile, iter_metafile_items
+from em_stitch.utils.raster_grid import RasterGrid
+
 
 # Position codes in metafile
 class Edge(IntEnum):
@@ -21,6 +27,13 @@ class Edge(IntEnum):
     RIGHT = 4
 
 
+# (col, row) offset of the neighbor at each edge
+neighbor_offsets = {
+    Edge.LEFT: (-1, 0),
+    Edge.RIGHT: (1, 0),
+    Edge.TOP: (0, -1)}
+
+
 class MetaToCollection(object):
     ''' Converts a raw TEMCA metafile into a collection
         json file which the render stack can consume.
@@ -34,34 +47,13 @@ class MetaToCollection(object):
             None is returned
         '''
         if direction is None:
-            return args.raster_pos_lookup[str(col) + "_" + str(row)]
-        elif direction == Edge.LEFT:
-            if col > 0:
-                try:
-                    return args.raster_pos_lookup[
-                            str(col - 1) + "_" + str(row)]
-                except:
-                    return None
-            else:
-                return None
-        elif direction == Edge.RIGHT:
-            if col < args.tcols:
-                try:
-                    return args.raster_pos_lookup[
-                            str(col + 1) + "_" + str(row)]
-                except:
-                    return None
-            else:
-                return None
-        elif direction == Edge.TOP:
-            if row > 0:
-                try:
-                    return args.raster_pos_lookup[
-                            str(col) + "_" + str(row - 1)]
-                except:
-                    return None
-            else:
-                return None
+            offset = (0, 0)
+        elif direction in neighbor_offsets:
+            offset = neighbor_offsets[direction]
+        else:
+            return None
+        ind = args.raster_grid.neighbors(col, row, offset)
+        return None if ind < 0 else args.data[ind]
 
     def tile_from_tile(self, args, tile, direction=None):
         ''' returns a neighboring tile given a tile.
@@ -70,13 +62,27 @@ class MetaToCollection(object):
         col, row = tile['img_meta']['raster_pos']
         return self.tile_from_raster_pos(args, col, row, direction)
 
-    def create_raster_pos_dict(self, args):
-        ''' create the look up dictionary for raster pos to nodes '''
-        args.raster_pos_lookup = {}
-        for tile in args.data:
-            rp = tile['img_meta']['raster_pos']
-            col, row = rp
-            args.raster_pos_lookup[str(col) + "_" + str(row)] = tile
+    def create_raster_grid(self, args):
+        ''' create the look up grid for raster pos to tile index '''
+        args.raster_grid = RasterGrid.from_tiles(args.data)
+
+    def group_id(self, metadata):
+        ''' the p and q group id for all matches of a metafile '''
+        temca_id = metadata["temca_id"]
+        session_id = metadata["session_id"]
+        grid = metadata["grid"]
+        specimen_id = metadata["specimen_id"]
+        if "tape_id" in metadata:
+            tape_id = metadata["tape_id"]
+        else:
+            tape_id = None
+
+        return (
+                str(specimen_id) + '_' +
+                str(temca_id) + '_' +
+                str(tape_id) + '_' +
+                str(session_id) + '_' +
+                str(grid))
 
     def get_meta_and_montage_files(self, rootdir):
         '''get the names of the meta and montage files'''
@@ -87,109 +93,162 @@ class MetaToCollection(object):
             montage = name
         return (meta, montage)
 
-    def process(self, args):
+    def process(self, args, metafile=None):
         ''' the main thing.'''
-        ''' read in the metadata file and extract relevant info'''
-        rootdir = args.directory
+        ''' read in the metadata file and extract relevant info
+            metafile: an already parsed
+            em_stitch.utils.metafile.Metafile can be passed in
+            to avoid reading the metafile again.'''
         try:
-            args.meta_file, args.montage_file = \
-                    self.get_meta_and_montage_files(rootdir)
-
-            with open(args.meta_file) as data_file:
-                json_data = json.load(data_file)
+            if metafile is None:
+                args.meta_file, args.montage_file = \
+                        self.get_meta_and_montage_files(args.directory)
+                metafile = Metafile(args.meta_file)
+            else:
+                args.meta_file = metafile.path
+            metadata = args.metadata = metafile.metadata
+            data = args.data = metafile.data
         except:
             raise Exception("Cannot find or parse metafile in: " +
                             args.directory)
 
-        metadata = args.metadata = json_data[0]['metadata']
-        data = args.data = json_data[1]['data']
+        qGroupId = pGroupId = self.group_id(metadata)
 
-        temca_id = metadata["temca_id"]
-        session_id = metadata["session_id"]
-        grid = metadata["grid"]
-        specimen_id = metadata["specimen_id"]
-        if "tape_id" in metadata:
-            tape_id = metadata["tape_id"]
-        else:
-            tape_id = None
-
-        gid = (
-                str(specimen_id) + '_' +
-                str(temca_id) + '_' +
-                str(tape_id) + '_' +
-                str(session_id) + '_' +
-                str(grid))
-        qGroupId = pGroupId = gid
+        # create a grid to look up neighboring tiles
+        self.create_raster_grid(args)
 
         # total number of rows and cols
-        args.trows = max([tile['img_meta']['raster_pos'][1] for tile in data])
-        args.tcols = max([tile['img_meta']['raster_pos'][0] for tile in data])
+        args.tcols, args.trows = (
+                args.raster_grid.origin + args.raster_grid.index.shape - 1)
         print('rows: ', args.trows, ', cols: ', args.tcols)
 
-        # create a dictionary to look up neighboring tiles
-        self.create_raster_pos_dict(args)
-
-        samples = []
-        tilespecs = []
-
-        # for all tiles
+        # tile == 'q' tile, where the template search is taking place
+        # hmm, munge the filenames?
+        tile_ids = [tile["img_path"].replace(".tif", "") for tile in data]
+        raster_pos = np.array(
+                [tile['img_meta']['raster_pos'] for tile in data],
+                dtype='int64').reshape(-1, 2)
+
+        # every match to a possible neighbor, in tile and matcher order
+        qind = []
+        offsets = []
+        matches = []
         for index, tile in enumerate(data):
+            for match in tile.get('matcher', []):
+                if match['match_quality'] == -1:
+                    # -1 is a flag indicating no matches
+                    # are possible for this tile edge
+                    continue
+                if match['position'] not in neighbor_offsets:
+                    continue
+                qind.append(index)
+                offsets.append(neighbor_offsets[match['position']])
+                matches.append(match)
+        qind = np.array(qind, dtype='int64')
+        offsets = np.array(offsets, dtype='int64').reshape(-1, 2)
+
+        # neighbor == 'p' tile, which
+        # contains the original template
+        pind = args.raster_grid.neighbors(
+                raster_pos[qind, 0], raster_pos[qind, 1], offsets.T)
 
-            # tile == 'q' tile, where the template search is taking place
-
-            qId = tile["img_path"]
-            # hmm, munge the filenames?
-            qId = qId.replace(".tif", "")
-            tilespec = {
-                'tileId': qId,
-                'xstage': float(tile["img_meta"]['stage_pos'][0]),
-                'ystage': float(tile["img_meta"]['stage_pos'][1])
-            }
-            tilespecs.append(tilespec)
-
-            p = [[], []]
-            q = [[], []]
-            w = []
-
-            if 'matcher' in tile:
-                for match in tile['matcher']:
-                    position = match['position']
-                    match_quality = match['match_quality']
-                    if match_quality == -1:
-                        # -1 is a flag indicating no matches
-                        # are possible for this tile edge
-                        continue
-                    neighbor = self.tile_from_tile(args, tile, position)
-                    # neighbor == 'p' tile, which
-                    # contains the original template
-                    if neighbor:
-                        p = [match["pX"], match["pY"]]
-                        q = [match["qX"], match["qY"]]
-                        w = [1] * len(match["pX"])
-                        # hmm, munge the filenames?
-                        pId = neighbor["img_path"]
-                        pId = pId.replace(".tif", "")
-
-                        samples.append({
-                            'pId': pId,
-                            'qId': qId,
-                            'pGroupId': pGroupId,
-                            'qGroupId': qGroupId,
-                            'matches': {
-                                'p': p,
-                                'q': q,
-                                'w': w,
-                                'match_count': len(w),
-                            }
-                        })
-
-        #with open(args.output_file, 'w') as f:
-        #    json.dump(samples, f, indent=2)
+        samples = []
+        for i in np.flatnonzero(pind >= 0):
+            match = matches[i]
+            w = [1] * len(match["pX"])
+            samples.append({
+                'pId': tile_ids[pind[i]],
+                'qId': tile_ids[qind[i]],
+                'pGroupId': pGroupId,
+                'qGroupId': qGroupId,
+                'matches': {
+                    'p': [match["pX"], match["pY"]],
+                    'q': [match["qX"], match["qY"]],
+                    'w': w,
+                    'match_count': len(w),
+                }
+            })
 
         return samples
 
+    def process_stream(self, meta_file):
+        ''' generator version of process. The metafile is parsed
+            incrementally, with p and q of each sample as 2xN numpy
+            arrays. Samples are the same as from process and in the
+            same order: a sample is yielded once both of its tiles
+            have been read and no earlier sample still waits for a
+            neighbor later in the file. Only one tile, plus those
+            waiting samples and matches, is held in memory.
+        '''
+        items = iter_metafile_items(meta_file, matchers_as_arrays=True)
+        gid = None
+        tile_ids = {}
+        pending = defaultdict(list)
+        # (tile index, matcher index) of the matches waiting for a
+        # neighbor, in file order, and the samples that are ready
+        waiting = {}
+        ready = []
+
+        def sample(pId, qId, match):
+            n = match['pX'].size
+            return {
+                'pId': pId,
+                'qId': qId,
+                'pGroupId': gid,
+                'qGroupId': gid,
+                'matches': {
+                    'p': np.vstack((match['pX'], match['pY'])),
+                    'q': np.vstack((match['qX'], match['qY'])),
+                    'w': [1] * n,
+                    'match_count': n,
+                }
+            }
 
-def main(args):
+        index = 0
+        for key, value in items:
+            if key == 'metadata':
+                gid = self.group_id(value)
+            if key != 'data':
+                continue
+
+            tile = value
+            qId = tile["img_path"].replace(".tif", "")
+            col, row = tile['img_meta']['raster_pos']
+            tile_ids[(col, row)] = qId
+
+            # matches from earlier tiles that were waiting for this one
+            for order, waiting_qId, match in pending.pop((col, row), []):
+                del waiting[order]
+                heapq.heappush(
+                        ready, (order, sample(qId, waiting_qId, match)))
+
+            for j, match in enumerate(tile.get('matcher', [])):
+                if match['match_quality'] == -1:
+                    # -1 is a flag indicating no matches
+                    # are possible for this tile edge
+                    continue
+                if match['position'] not in neighbor_offsets:
+                    continue
+                dc, dr = neighbor_offsets[match['position']]
+                neighbor = (col + dc, row + dr)
+                if neighbor in tile_ids:
+                    heapq.heappush(ready, (
+                        (index, j), sample(tile_ids[neighbor], qId, match)))
+                else:
+                    waiting[(index, j)] = True
+                    pending[neighbor].append(((index, j), qId, match))
+            index += 1
+
+            while ready and (
+                    (not waiting) or (ready[0][0] < next(iter(waiting)))):
+                yield heapq.heappop(ready)[1]
+
+        # anything still waiting has no neighbor tile, as in process
+        while ready:
+            yield heapq.heappop(ready)[1]
+
+
+def main(args, metafile=None):
     parent_parser = argparse.ArgumentParser(
         description='Converts raw TEMCA metadata files to render collections')
 
@@ -211,7 +270,7 @@ def main(args):
     args = parent_parser.parse_args(args)
 
     m2c = MetaToCollection()
-    return m2c.process(args)
+    return m2c.process(args, metafile=metafile)
 
 
 if __name__ == "__main__":
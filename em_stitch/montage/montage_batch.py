@@ -0,0 +1,197 @@
+import concurrent.futures
+import glob
+import logging
+import os
+import time
+import traceback
+
+from argschema import ArgSchema, ArgSchemaParser
+
+from em_stitch.montage.montage_solver import (
+    MontageSolver, limit_blas_threads, load_template)
+from em_stitch.montage.schemas import (
+    MontageBatchSchema, montage_section_schema)
+from em_stitch.utils import jsongz
+from em_stitch.utils.profiling import profiled
+
+logger = logging.getLogger(__name__)
+
+example = {
+        "data_dir_glob": "/data/em-131fs3/lctest/T4_6/0018*/0",
+        "ransacReprojThreshold": 10,
+        "solver_template_dir": "/data/em-131fs3/lctest/templates",
+        "solver_templates": [
+            "affine_template.json",
+            "polynomial_template.json",
+            ],
+        "output_json": "/data/em-131fs3/lctest/T4_6/montage_batch.json"
+        }
+
+# keys passed through from the batch args to each MontageSolver
+section_keys = [
+        k for k in montage_section_schema._declared_fields
+        if k not in ArgSchema._declared_fields] + ['log_level']
+
+
+def section_dirs(data_dirs, data_dir_glob=None):
+    """
+    Collect section directories from a list and a glob pattern.
+
+    Parameters
+    ----------
+    data_dirs : List[str]
+        explicit section directories.
+    data_dir_glob : str, optional
+        glob pattern matching section directories.
+
+    Returns
+    -------
+    List[str]
+        unique directories, explicit ones first, then sorted glob matches.
+    """
+    dirs = list(data_dirs)
+    if data_dir_glob is not None:
+        dirs += sorted([d for d in glob.glob(data_dir_glob)
+                        if os.path.isdir(d)])
+    # de-duplicate, keeping order
+    return list(dict.fromkeys(dirs))
+
+
+def init_worker(template_paths, blas_threads):
+    """
+    Process pool initializer. Limits BLAS threads and parses the solver
+    templates once for all the sections this worker will handle.
+
+    Parameters
+    ----------
+    template_paths : List[str]
+        paths to the solver templates.
+    blas_threads : int or None
+        passed to :func:`em_stitch.montage.montage_solver.limit_blas_threads`
+    """
+    limit_blas_threads(blas_threads)
+    for t in template_paths:
+        load_template(t)
+
+
+def run_section(data_dir, section_args):
+    """
+    Run MontageSolver on one section, isolating any failure.
+
+    Parameters
+    ----------
+    data_dir : str
+        section directory.
+    section_args : Dict[str, Any]
+        MontageSolver input, without data_dir.
+
+    Returns
+    -------
+    Dict[str, Any]
+        one row of the batch results table.
+    """
+    t0 = time.time()
+    row = {
+            'data_dir': data_dir,
+            'status': 'ok',
+            'error': None,
+            'output_json': None,
+            'results': None}
+    try:
+        args = dict(section_args, data_dir=data_dir)
+        ms = MontageSolver(input_data=args, args=[])
+        ms.run()
+        row['output_json'] = ms.args['output_json']
+        row['results'] = ms.results
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error'] = "%s: %s" % (e.__class__.__name__, e)
+        logger.error("montage failed for %s\n%s" % (
+            data_dir, traceback.format_exc()))
+    row['wall_time'] = time.time() - t0
+    return row
+
+
+def run_sections(data_dirs, section_args, n_workers=None, blas_threads=1):
+    """
+    Montage many sections with a bounded process pool.
+
+    Parameters
+    ----------
+    data_dirs : List[str]
+        section directories.
+    section_args : Dict[str, Any]
+        MontageSolver input shared by all sections.
+    n_workers : int, optional
+        maximum number of concurrent sections, by default os.cpu_count()
+    blas_threads : int, optional
+        BLAS thread limit per worker, by default 1.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        results table rows, in the order of data_dirs.
+    """
+    n_workers = n_workers or os.cpu_count()
+    template_paths = [
+            os.path.join(section_args['solver_template_dir'], t)
+            for t in section_args['solver_templates']]
+
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, min(n_workers, len(data_dirs))),
+            initializer=init_worker,
+            initargs=(template_paths, blas_threads)) as executor:
+        futures = [executor.submit(run_section, d, section_args)
+                   for d in data_dirs]
+        for d, f in zip(data_dirs, futures):
+            try:
+                rows.append(f.result())
+            except Exception as e:
+                # the worker itself died, e.g. BrokenProcessPool
+                rows.append({
+                    'data_dir': d,
+                    'status': 'failed',
+                    'error': "%s: %s" % (e.__class__.__name__, e),
+                    'output_json': None,
+                    'results': None,
+                    'wall_time': None})
+    return rows
+
+
+class MontageBatchSolver(ArgSchemaParser):
+    default_schema = MontageBatchSchema
+
+    @profiled
+    def run(self):
+        logger.setLevel(self.args['log_level'])
+        data_dirs = section_dirs(
+                self.args['data_dirs'], self.args['data_dir_glob'])
+
+        section_args = {k: self.args[k] for k in section_keys}
+        if section_args['read_transform_from'] == 'reffile':
+            # read the reference transform once for all sections
+            section_args['ref_transform_dict'] = jsongz.load(
+                    section_args['ref_transform'])
+            section_args['read_transform_from'] = 'dict'
+
+        t0 = time.time()
+        self.rows = run_sections(
+                data_dirs,
+                section_args,
+                n_workers=self.args['n_workers'],
+                blas_threads=self.args['blas_threads'])
+        nfailed = len([r for r in self.rows if r['status'] != 'ok'])
+        logger.info("montaged %d sections, %d failed, in %0.1f seconds" % (
+            len(self.rows), nfailed, time.time() - t0))
+
+        if 'output_json' in self.args:
+            self.output({
+                'n_sections': len(self.rows),
+                'n_failed': nfailed,
+                'sections': self.rows}, indent=2)
+
+
+if __name__ == "__main__":
+    mb = MontageBatchSolver(input_data=example)
+    mb.run()
@@ -1,17 +1,35 @@
+import concurrent.futures
+import copy
+import functools
 import glob
-import json
+import logging
 import os
+import sys
+import time
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
-import bigfeta.bigfeta as bfa
 import renderapi
 
 from em_stitch.montage import meta_to_collection
 from em_stitch.montage.schemas import MontageSolverSchema
+from em_stitch.utils import jsongz
 from em_stitch.utils.generate_EM_tilespecs_from_metafile import (
     GenerateEMTileSpecsModule)
-from em_stitch.utils.utils import pointmatch_filter, get_z_from_metafile
+from em_stitch.utils.instrumentation import Timings
+from em_stitch.utils.metafile import Metafile, as_metafile
+from em_stitch.utils.profiling import profiled
+from em_stitch.utils.stage_cache import file_hash, stages_from_args
+from em_stitch.utils.transform_sidecar import read_sidecar, sidecar_path
+from em_stitch.utils.utils import (
+    pointmatch_filter, get_z_from_metafile, reset_cv2_rng)
+
+try:
+    # threadpoolctl can limit BLAS pools already loaded in a worker
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+logger = logging.getLogger(__name__)
 
 dname = os.path.join(
             os.path.dirname(os.path.abspath(__file__)),
@@ -30,10 +48,67 @@ example = {
         }
 
 
+_blas_thread_env_vars = [
+        "OMP_NUM_THREADS",
+        "OPENBLAS_NUM_THREADS",
+        "MKL_NUM_THREADS",
+        "VECLIB_MAXIMUM_THREADS",
+        "NUMEXPR_NUM_THREADS"]
+
+
 class MontageSolverException(Exception):
     pass
 
 
+def limit_blas_threads(nthreads):
+    """
+    Limit the number of threads used by BLAS/OpenMP in this process.
+
+    Intended as a process pool initializer so that concurrent solves
+    do not oversubscribe the node.
+
+    Parameters
+    ----------
+    nthreads : int or None
+        Maximum number of threads. If None, no limit is applied.
+    """
+    if nthreads is None:
+        return
+    for v in _blas_thread_env_vars:
+        os.environ[v] = str(nthreads)
+    if threadpoolctl is not None:
+        # environment variables do not affect libraries already loaded
+        threadpoolctl.threadpool_limits(limits=nthreads)
+    elif 'numpy' in sys.modules:
+        logger.warning(
+            "threadpoolctl is not installed, BLAS pools already loaded "
+            "in this process are not limited to %d threads" % nthreads)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_template(template_path, mtime):
+    return jsongz.load(template_path)
+
+
+def load_template(template_path):
+    """
+    Load a solver template, parsing each template file only once
+    per process (or again, if it has been modified).
+
+    Parameters
+    ----------
+    template_path : str
+        Path to the template file.
+
+    Returns
+    -------
+    Dict[str, Any]
+        a copy of the template, safe to modify.
+    """
+    return copy.deepcopy(_read_template(
+        os.path.abspath(template_path), os.path.getmtime(template_path)))
+
+
 def do_solve(template_path, args, index):
     """
     Perform alignment solving based on the provided template and arguments.
@@ -52,8 +127,11 @@ def do_solve(template_path, args, index):
     Dict[str, Any]
         Results of the alignment solving process.
     """
-    with open(template_path, 'r') as f:
-        template = json.load(f)
+    # slow to import, and only needed here
+    import bigfeta.bigfeta as bfa
+
+    t0 = time.time()
+    template = load_template(template_path)
     template['input_stack']['input_file'] = \
         args['input_stack']['input_file']
     template['pointmatch']['input_file'] = \
@@ -67,8 +145,10 @@ def do_solve(template_path, args, index):
             'resolvedtiles_%s_%d.json' % (template['transformation'], index))
     template['output_stack']['output_file'] = fname
     template['fullsize_transform'] = False
-    aligner = bfa.BigFeta(input_data=template, args=[])
-    aligner.run()
+    timings = Timings()
+    with timings.span('bigfeta'):
+        aligner = bfa.BigFeta(input_data=template, args=[])
+        aligner.run()
     # these numbers only meaningful for fullsize_transform = False
     # to get results already in memory, on-scope, let's keep it that way
     # otherwise, we'll need a separate calculation that loads tilespecs
@@ -89,15 +169,47 @@ def do_solve(template_path, args, index):
             'mag': {
                 'mean': aligner.results['mag'][0],
                 'stdev': aligner.results['mag'][1]
-                }
+                },
+            'template': os.path.basename(template_path),
+            'wall_time': time.time() - t0,
+            'timings': timings.to_dict()
             }
     return res
 
 
-def do_solves(collection, input_stack, z, compress, solver_args):
+def solve_meets_criteria(result, criteria):
+    """
+    Check a montage solve result against residual thresholds.
+
+    Parameters
+    ----------
+    result : Dict[str, Any]
+        Result of :func:`do_solve`.
+    criteria : Dict[str, float]
+        'error_mean' and 'error_std' maximum values [pixels], applied
+        to each of the x, y and mag residual statistics.
+
+    Returns
+    -------
+    bool
+        True if all residual statistics are within the thresholds.
+    """
+    return all(
+        (abs(result[k]['mean']) < criteria['error_mean']) and
+        (result[k]['stdev'] < criteria['error_std'])
+        for k in ['x', 'y', 'mag'])
+
+
+def do_solves(collection, input_stack, z, compress, solver_args,
+              n_workers=1, blas_threads=None, cascade_criteria=None):
     """
     Perform multiple alignment solving processes.
 
+    The solves are independent of one another. With n_workers > 1 they
+    are run concurrently in a process pool. With cascade_criteria, they
+    are run in order and the remaining templates are skipped once one
+    result meets the criteria.
+
     Parameters
     ----------
     collection : str
@@ -108,13 +220,22 @@ def do_solves(collection, input_stack, z, compress, solver_args):
         Z value.
     compress : bool
         Whether to compress the output.
-    solver_args : List[Dict[str, Any]]
-        List of solver arguments.
+    solver_args : List[str]
+        List of paths to solver templates.
+    n_workers : int, optional
+        Maximum number of concurrent solves, by default 1 (sequential).
+        Ignored in cascade mode.
+    blas_threads : int, optional
+        BLAS thread limit for each pool worker, by default None (no limit).
+    cascade_criteria : Dict[str, float], optional
+        acceptance thresholds for :func:`solve_meets_criteria`, by default
+        None (run all templates).
 
     Returns
     -------
     List[Dict[str, Any]]
-        List of results from alignment solving processes.
+        List of results from alignment solving processes,
+        in the same order as solver_args.
     """
     args = {'input_stack': {}, 'output_stack': {}, 'pointmatch': {}}
     args['input_stack']['input_file'] = input_stack
@@ -122,9 +243,61 @@ def do_solves(collection, input_stack, z, compress, solver_args):
     args['output_stack']['compress_output'] = compress
     args['first_section'] = args['last_section'] = z
 
+    if cascade_criteria is not None:
+        return do_cascade_solves(args, solver_args, cascade_criteria)
+
+    n_workers = min(n_workers, len(solver_args))
+    if n_workers <= 1:
+        return [do_solve(template, args, index)
+                for index, template in enumerate(solver_args)]
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=limit_blas_threads,
+            initargs=(blas_threads,)) as executor:
+        futures = [executor.submit(do_solve, template, args, index)
+                   for index, template in enumerate(solver_args)]
+        results = [f.result() for f in futures]
+
+    return results
+
+
+def do_cascade_solves(args, solver_args, criteria):
+    """
+    Run solver templates in order, stopping at the first acceptable result.
+
+    Parameters
+    ----------
+    args : Dict[str, Any]
+        Arguments dictionary as passed to :func:`do_solve`.
+    solver_args : List[str]
+        List of paths to solver templates, in order of preference.
+    criteria : Dict[str, float]
+        acceptance thresholds for :func:`solve_meets_criteria`.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        Results of the templates that were run, each with an 'accepted'
+        flag. The accepted result also records the skipped templates and
+        'time_saved_lower_bound', a lower bound of the solve time saved
+        by skipping them: templates are ordered from the cheapest, so
+        each skipped one would have taken at least as long as the
+        slowest measured solve.
+    """
     results = []
     for index, template in enumerate(solver_args):
-        results.append(do_solve(template, args, index))
+        res = do_solve(template, args, index)
+        res['accepted'] = solve_meets_criteria(res, criteria)
+        results.append(res)
+        if res['accepted']:
+            skipped = solver_args[index + 1:]
+            solve_time = max(
+                    [r['timings']['bigfeta']['wall_time'] for r in results])
+            res['cascade'] = {
+                    'skipped': [os.path.basename(t) for t in skipped],
+                    'time_saved_lower_bound': solve_time * len(skipped)}
+            break
 
     return results
 
@@ -142,8 +315,11 @@ def montage_filter_matches(matches, thresh, model='Similarity'):
     model : str, optional
         Model type, by default 'Similarity'.
 
+    The OpenCV RNG is reset before each match, so that its weights do
+    not depend on the order in which the matches are filtered.
     """
     for match in matches:
+        reset_cv2_rng()
         _, _, w, _ = pointmatch_filter(
                 match,
                 n_clusters=1,
@@ -153,6 +329,36 @@ def montage_filter_matches(matches, thresh, model='Similarity'):
         match['matches']['w'] = w.tolist()
 
 
+def stream_filtered_matches(metafile, thresh, model='Similarity'):
+    """
+    Read and filter the matches of a metafile incrementally, so that
+    filtering overlaps with parsing and the full metafile is never held
+    in memory.
+
+    Parameters
+    ----------
+    metafile : str
+        Path to the metadata file.
+    thresh : float
+        Threshold value.
+    model : str, optional
+        Model type, by default 'Similarity'.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        List of filtered matches, json serializable.
+    """
+    matches = []
+    m2c = meta_to_collection.MetaToCollection()
+    for match in m2c.process_stream(metafile):
+        montage_filter_matches([match], thresh, model=model)
+        for k in ['p', 'q']:
+            match['matches'][k] = match['matches'][k].tolist()
+        matches.append(match)
+    return matches
+
+
 def get_metafile_path(datadir):
     """
     Get the path of the metadata file in the specified directory.
@@ -174,34 +380,39 @@ def make_raw_tilespecs(metafile, outputdir, groupId, compress):
     """
     Generate raw tilespecs from a metadata file.
 
+    The tilespecs are kept in memory and handed to make_resolved,
+    rather than being written to a temporary file first.
+
     Parameters
     ----------
-    metafile : str
-        Path to the metadata file.
+    metafile : str or em_stitch.utils.metafile.Metafile
+        Path to the metadata file, or the parsed metafile.
     outputdir : str
-        Directory where the output will be stored.
+        Directory where the output will be stored. Unused, kept
+        for backward compatibility.
     groupId : str
         Group ID.
     compress : bool
-        Whether to compress the output.
+        Whether to compress the output. Unused, kept for backward
+        compatibility.
 
     Returns
     -------
-    Tuple[str, int]
-        Path of the generated raw tilespecs file and the corresponding z value.
+    Tuple[List[Dict[str, Any]], int]
+        The generated json tilespecs and the corresponding z value.
 
     """
+    metafile = as_metafile(metafile)
     z = get_z_from_metafile(metafile)
     tspecin = {
-            "metafile": metafile,
+            "metafile": metafile.path,
             "z": z,
-            "sectionId": groupId,
-            "output_path": os.path.join(outputdir, 'raw_tilespecs.json'),
-            "compress_output": compress
+            "sectionId": groupId
             }
-    gmod = GenerateEMTileSpecsModule(input_data=tspecin, args=[])
+    gmod = GenerateEMTileSpecsModule(
+            input_data=tspecin, args=[], metafile=metafile)
     gmod.run()
-    return gmod.args['output_path'], z
+    return gmod.tilespecs, z
 
 
 def get_transform(metafile, tfpath, refdict, read_from):
@@ -210,8 +421,8 @@ def get_transform(metafile, tfpath, refdict, read_from):
 
     Parameters
     ----------
-    metafile : str
-        Path to the metadata file.
+    metafile : str or em_stitch.utils.metafile.Metafile
+        Path to the metadata file, or the parsed metafile.
     tfpath : str
         Path to the transformation file.
     refdict : Dict[str, Any]
@@ -225,25 +436,28 @@ def get_transform(metafile, tfpath, refdict, read_from):
         Transformation object.
     """
     if read_from == 'metafile':
-        with open(metafile, 'r') as f:
-            j = json.load(f)
-        tfj = j[2]['sharedTransform']
+        tfj = as_metafile(metafile).shared_transform
     elif read_from == 'reffile':
-        with open(tfpath, 'r') as f:
-            tfj = json.load(f)
+        sidecar = sidecar_path(tfpath)
+        if os.path.isfile(sidecar):
+            tform = read_sidecar(sidecar, json_path=tfpath)
+            if tform is not None:
+                return tform
+        tfj = jsongz.load(tfpath)
     elif read_from == 'dict':
         tfj = refdict
     return renderapi.transform.Transform(json=tfj)
 
 
-def make_resolved(rawspecpath, tform, outputdir, compress):
+def make_resolved(tilespecs, tform, outputdir, compress):
     """
     Generate resolved tiles from raw tilespecs and a transformation.
 
     Parameters
     ----------
-    rawspecpath : str
-        Path to the raw tilespecs file.
+    tilespecs : list of dict or str
+        Json tilespecs from make_raw_tilespecs, or the path to a
+        raw tilespecs file.
     tform : renderapi.transform.Transform
         Transformation object.
     outputdir : str
@@ -256,90 +470,225 @@ def make_resolved(rawspecpath, tform, outputdir, compress):
     str
         Path of the generated resolved tiles file.
     """
-    # read in the tilespecs
-    rtj = jsongz.load(rawspecpath)
-    tspecs = [renderapi.tilespec.TileSpec(json=t) for t in rtj]
-
-    # do not need this anymore
-    os.remove(rawspecpath)
-
-    # add the reference transform
-    ref = renderapi.transform.ReferenceTransform()
-    ref.refId = tform.transformId
-    for t in tspecs:
-        t.tforms.insert(0, ref)
-
-    # make a resolved tile object
-    resolved = renderapi.resolvedtiles.ResolvedTiles(
-            tilespecs=tspecs,
-            transformList=[tform])
-
-    # write it to file and return the path
+    if isinstance(tilespecs, str):
+        tilespecs = jsongz.load(tilespecs)
+
+    # prepend a reference to the shared transform to every tile,
+    # working on the json directly rather than TileSpec objects
+    ref = renderapi.transform.ReferenceTransform(
+            refId=tform.transformId).to_dict()
+    tileIdToSpecMap = {}
+    for t in tilespecs:
+        t = dict(t)
+        t['transforms'] = dict(
+                t['transforms'],
+                specList=[ref] + t['transforms']['specList'])
+        tileIdToSpecMap[t['tileId']] = t
+
+    # same layout as renderapi.resolvedtiles.ResolvedTiles.to_dict()
+    resolved = {
+            'transformIdToSpecMap': {tform.transformId: tform.to_dict()},
+            'tileIdToSpecMap': tileIdToSpecMap}
+
+    # write it to file and return the path, formatted as json.dump
+    # does, so that the file stays byte-identical to earlier versions
     rpath = os.path.join(outputdir, 'resolvedtiles_input.json')
 
-    return jsongz.dump(resolved.to_dict(), rpath, compress)
+    return jsongz.dump(
+            resolved, rpath, compress, separators=(', ', ': '))
 
 
 class MontageSolver(ArgSchemaParser):
     default_schema = MontageSolverSchema
 
-    def run(self):
-        if 'metafile' not in self.args:
-            self.args['metafile'] = get_metafile_path(self.args['data_dir'])
-        else:
-            self.args['data_dir'] = os.path.dirname(self.args['metafile'])
-
-        if not self.args['output_dir']:
-            self.args['output_dir'] = self.args['data_dir']
-
+    def get_metafile(self):
+        """the parsed metafile, shared by all the stages. Only parsed
+        when a stage needs it, not when all are cached"""
+        if self.metafile is None:
+            self.metafile = Metafile(
+                    self.args['metafile'],
+                    skip_matchers=self.args['stream_metafile'])
+        return self.metafile
+
+    def filter_matches(self, collection):
+        """read, filter and write the matches of the metafile
+
+        Returns
+        -------
+        collection : str
+            path of the written collection
+        pGroupId : str
+            group of the matches
+        """
         # read the matches from the metafile
-        matches = meta_to_collection.main([self.args['data_dir']])
+        if self.args['stream_metafile']:
+            matches = stream_filtered_matches(
+                    self.args['metafile'],
+                    self.args['ransacReprojThreshold'])
+        else:
+            matches = meta_to_collection.main(
+                    [self.args['data_dir']], metafile=self.get_metafile())
 
-        montage_filter_matches(
-                matches,
-                self.args['ransacReprojThreshold'])
+            montage_filter_matches(
+                    matches,
+                    self.args['ransacReprojThreshold'])
 
         # write to file
-        collection = os.path.join(self.args['output_dir'], "collection.json")
         collection = jsongz.dump(
                 matches,
                 collection,
                 compress=self.args['compress_output'])
+        return collection, matches[0]['pGroupId']
 
-        # make raw tilespec json
-        rawspecpath, z = make_raw_tilespecs(
-                self.args['metafile'],
-                self.args['output_dir'],
-                matches[0]['pGroupId'],
-                self.args['compress_output'])
-
-        # get the ref transform
-        tform = get_transform(
-                self.args['metafile'],
-                self.args['ref_transform'],
-                self.args['ref_transform_dict'],
-                self.args['read_transform_from'])
-
-        # make a resolved tile object
-        input_stack_path = make_resolved(
-                rawspecpath,
-                tform,
-                self.args['output_dir'],
-                self.args['compress_output'])
+    @profiled
+    def run(self):
+        if 'metafile' not in self.args:
+            self.args['metafile'] = get_metafile_path(self.args['data_dir'])
+        else:
+            self.args['data_dir'] = os.path.dirname(self.args['metafile'])
+
+        if not self.args['output_dir']:
+            self.args['output_dir'] = self.args['data_dir']
+
+        self.metafile = None
+        # stages reused from the manifest of an interrupted run in
+        # output_dir, or from the stage cache
+        self.stages = stages_from_args(self.args, self.args['output_dir'])
+        metafile_inputs = {
+                'files': {'metafile_sha256': self.args['metafile']},
+                'metafile': os.path.abspath(self.args['metafile'])}
+        timings = Timings()
+
+        # filtered matches
+        with timings.span('filter_matches') as span:
+            matches_key = self.stages.key(
+                    'montage_matches',
+                    ransacReprojThreshold=self.args['ransacReprojThreshold'],
+                    compress=self.args['compress_output'],
+                    **metafile_inputs)
+            record = self.stages.get(matches_key)
+            if record is not None:
+                span.annotate(reused=record['source'])
+                collection = record['files']['collection']
+                groupId = record['data']['pGroupId']
+            else:
+                collection, groupId = self.filter_matches(os.path.join(
+                        self.args['output_dir'], "collection.json"))
+                self.stages.put(
+                        matches_key,
+                        data={'pGroupId': groupId},
+                        files={'collection': collection})
+
+        # raw tilespecs
+        with timings.span('tilespecs') as span:
+            tilespecs_key = self.stages.key(
+                    'montage_tilespecs',
+                    groupId=groupId,
+                    **metafile_inputs)
+            record = self.stages.get(tilespecs_key)
+            if record is not None:
+                span.annotate(reused=record['source'])
+                rawspecs = jsongz.load(record['files']['raw_tilespecs'])
+                z = record['data']['z']
+            else:
+                # make raw tilespec json
+                rawspecs, z = make_raw_tilespecs(
+                        self.get_metafile(),
+                        self.args['output_dir'],
+                        groupId,
+                        self.args['compress_output'])
+                if self.stages.recording:
+                    # only written to be reused
+                    tilespec_path = jsongz.dump(
+                            rawspecs,
+                            os.path.join(
+                                self.args['output_dir'],
+                                'raw_tilespecs.json.gz'),
+                            compress=True)
+                    self.stages.put(
+                            tilespecs_key,
+                            data={'z': z},
+                            files={'raw_tilespecs': tilespec_path})
+            span.annotate(n_tiles=len(rawspecs))
 
         templates = [os.path.join(self.args['solver_template_dir'], t)
                      for t in self.args['solver_templates']]
-        self.results = do_solves(
-                collection,
-                input_stack_path,
-                z,
-                self.args['compress_output'],
-                templates)
+
+        # solves
+        read_from = self.args['read_transform_from']
+        with timings.span('solve') as span:
+            solve_key = self.stages.key(
+                    'montage_solve',
+                    files={
+                        'ref_transform': (
+                            self.args['ref_transform']
+                            if read_from == 'reffile' else None)},
+                    matches=matches_key,
+                    tilespecs=tilespecs_key,
+                    read_transform_from=read_from,
+                    ref_transform_dict=(
+                        self.args['ref_transform_dict']
+                        if read_from == 'dict' else None),
+                    templates=[
+                        [os.path.basename(t), file_hash(t)]
+                        for t in templates],
+                    compress=self.args['compress_output'],
+                    cascade=self.args['cascade'],
+                    cascade_criteria=self.args['cascade_criteria'])
+            record = self.stages.get(solve_key)
+            if record is not None:
+                span.annotate(reused=record['source'])
+                # spans of the run that did the solves
+                results = [
+                    dict(r, timings={}) for r in record['data']]
+            else:
+                with timings.span('transform'):
+                    # get the ref transform
+                    tform = get_transform(
+                            (self.get_metafile() if read_from == 'metafile'
+                             else self.args['metafile']),
+                            self.args['ref_transform'],
+                            self.args['ref_transform_dict'],
+                            read_from)
+
+                with timings.span('make_resolved'):
+                    # make a resolved tile object
+                    input_stack_path = make_resolved(
+                            rawspecs,
+                            tform,
+                            self.args['output_dir'],
+                            self.args['compress_output'])
+
+                results = do_solves(
+                        collection,
+                        input_stack_path,
+                        z,
+                        self.args['compress_output'],
+                        templates,
+                        n_workers=self.args['n_parallel_solves'],
+                        blas_threads=self.args['solver_blas_threads'],
+                        cascade_criteria=(
+                            self.args['cascade_criteria']
+                            if self.args['cascade'] else None))
+                files = {'input': input_stack_path}
+                for i, r in enumerate(results):
+                    files['output%d' % i] = os.path.join(
+                            self.args['output_dir'], r['output'])
+                self.stages.put(solve_key, data=results, files=files)
+
+        # the run's spans with those of each solve, which may have run
+        # in another process
+        run_timings = timings.to_dict()
+        self.results = []
+        for r in results:
+            r_timings = dict(run_timings)
+            r_timings.update({
+                'solve.' + k: v for k, v in r['timings'].items()})
+            self.results.append(dict(r, timings=r_timings))
 
         self.args['output_json'] = os.path.join(
                 self.args['output_dir'], 'montage_results.json')
-        with open(self.args['output_json'], 'w') as f:
-            json.dump(self.results, f, indent=2)
+        jsongz.dump(self.results, self.args['output_json'], indent=2)
 
 
 if __name__ == "__main__":
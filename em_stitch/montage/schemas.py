@@ -5,34 +5,37 @@ from marshmallow.warnings import ChangedInMarshmallow3Warning
 import marshmallow as mm
 
 from argschema import ArgSchema
+from argschema.schemas import DefaultSchema
 from argschema.fields import (
-    Boolean, InputDir, InputFile, Float,
-    OutputDir, List, Str, Dict)
+    Boolean, InputDir, InputFile, Float, Int,
+    OutputDir, List, Nested, Str, Dict)
 
 warnings.simplefilter(
         action='ignore',
         category=ChangedInMarshmallow3Warning)
 
 
-class MontageSolverSchema(ArgSchema):
-    data_dir = InputDir(
+class cascade_criteria(DefaultSchema):
+    error_mean = Float(
         required=False,
-        description="directory containing metafile, images, and matches")
-    metafile = InputFile(
+        default=2.0,
+        missing=2.0,
+        description=("maximum absolute x, y and mag residual mean "
+                     "[pixels] to accept a solve"))
+    error_std = Float(
         required=False,
-        description=("fullpath to metafile. Helps in the case of multiple"
-                     " metafiles in one directory. data_dir will take "
-                     " os.path.dirname(metafile)"))
-    output_dir = OutputDir(
-        required=False,
-        missing=None,
-        default=None,
-        description="directory for output files")
+        default=2.0,
+        missing=2.0,
+        description=("maximum x, y and mag residual std [pixels] "
+                     "to accept a solve"))
+
+
+class montage_section_schema(ArgSchema):
     read_transform_from = Str(
         required=False,
         missing='metafile',
         default='metafile',
-        validator=mm.validate.OneOf(['metafile', 'reffile', 'dict']),
+        validate=mm.validate.OneOf(['metafile', 'reffile', 'dict']),
         description="3 possible ways to read in the reference transform")
     ref_transform = InputFile(
         required=False,
@@ -54,6 +57,13 @@ class MontageSolverSchema(ArgSchema):
         missing=True,
         default=True,
         description=("tilespecs will be .json or .json.gz"))
+    stream_metafile = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("parse the metafile incrementally, filtering matches "
+                     "as they are read, to bound memory use for large "
+                     "matcher payloads"))
     solver_templates = List(
         Str,
         required=True,
@@ -61,6 +71,42 @@ class MontageSolverSchema(ArgSchema):
     solver_template_dir = InputDir(
         required=True,
         description="location of the templates for the solver")
+    cascade = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("run solver_templates in order and skip the "
+                     "remaining ones once a result meets "
+                     "cascade_criteria. Solves are sequential."))
+    cascade_criteria = Nested(cascade_criteria, missing={})
+    cache_dir = Str(
+        required=False,
+        missing=None,
+        default=None,
+        description=("directory of a stage result cache. Stages whose "
+                     "inputs are unchanged reuse prior results. "
+                     "None to disable"))
+    cache_max_bytes = Int(
+        required=False,
+        missing=2**32,
+        default=2**32,
+        allow_none=True,
+        description=("size of the stage result cache above which the "
+                     "least recently used entries are evicted. "
+                     "None for no limit"))
+    force_recompute = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("recompute all stages, replacing their cached "
+                     "results"))
+    resume = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("skip the stages an earlier run in output_dir "
+                     "completed with the same inputs, as recorded in "
+                     "its stage_manifest.json"))
 
     @mm.post_load
     def check_solver_inputs(self, data):
@@ -70,8 +116,158 @@ class MontageSolverSchema(ArgSchema):
                 raise mm.ValidationError(
                         "solver arg file doesn't exist: %s" % argpath)
 
+
+class MontageSolverSchema(montage_section_schema):
+    data_dir = InputDir(
+        required=False,
+        description="directory containing metafile, images, and matches")
+    metafile = InputFile(
+        required=False,
+        description=("fullpath to metafile. Helps in the case of multiple"
+                     " metafiles in one directory. data_dir will take "
+                     " os.path.dirname(metafile)"))
+    output_dir = OutputDir(
+        required=False,
+        missing=None,
+        default=None,
+        description="directory for output files")
+    n_parallel_solves = Int(
+        required=False,
+        missing=1,
+        default=1,
+        validate=mm.validate.Range(min=1),
+        description=("maximum number of solver templates to run "
+                     "concurrently in a process pool. 1 is sequential"))
+    solver_blas_threads = Int(
+        required=False,
+        missing=1,
+        default=1,
+        allow_none=True,
+        description=("BLAS thread limit for each concurrent solve. "
+                     "None for no limit. Not applied when "
+                     "n_parallel_solves is 1"))
+
     @mm.post_load
     def check_metafile(self, data):
         if ('data_dir' not in data) & ('metafile' not in data):
             raise mm.ValidationError(" must specify either data_dir"
                                      " or metafile")
+
+
+class MontageBatchSchema(montage_section_schema):
+    data_dirs = List(
+        InputDir,
+        required=False,
+        missing=[],
+        default=[],
+        description="section directories to montage")
+    data_dir_glob = Str(
+        required=False,
+        missing=None,
+        default=None,
+        description=("glob pattern for section directories, "
+                     "added to data_dirs"))
+    n_workers = Int(
+        required=False,
+        missing=None,
+        default=None,
+        allow_none=True,
+        description=("number of sections to solve concurrently. "
+                     "None uses os.cpu_count()"))
+    blas_threads = Int(
+        required=False,
+        missing=1,
+        default=1,
+        allow_none=True,
+        description="BLAS thread limit for each worker. None for no limit")
+
+    @mm.post_load
+    def check_data_dirs(self, data):
+        if (not data['data_dirs']) & (data['data_dir_glob'] is None):
+            raise mm.ValidationError(" must specify either data_dirs"
+                                     " or data_dir_glob")
+
+
+class SyntheticMontageDataSchema(ArgSchema):
+    output_dir = OutputDir(
+        required=True,
+        description="directory for the synthetic metafile")
+    seed = Int(
+        required=False,
+        missing=0,
+        default=0,
+        description="seed of all random choices")
+    tile_width = Int(
+        required=False,
+        missing=3840,
+        default=3840,
+        description="tile width [pixels]")
+    tile_height = Int(
+        required=False,
+        missing=3840,
+        default=3840,
+        description="tile height [pixels]")
+    n_rows = Int(
+        required=False,
+        missing=10,
+        default=10,
+        description="rows of the raster")
+    n_cols = Int(
+        required=False,
+        missing=10,
+        default=10,
+        description="columns of the raster")
+    overlap = Float(
+        required=False,
+        missing=0.1,
+        default=0.1,
+        description=("overlap of neighboring tiles as a fraction of "
+                     "the tile size"))
+    stage_error = Float(
+        required=False,
+        missing=5.0,
+        default=5.0,
+        description=("standard deviation [pixels] of the stage jitter, "
+                     "the difference between the true and the recorded "
+                     "tile positions"))
+    pixel_size = Float(
+        required=False,
+        missing=4.0,
+        default=4.0,
+        description="pixel size [nm] recorded in the metafile")
+    distortion_scale = Float(
+        required=False,
+        missing=20.0,
+        default=20.0,
+        description=("largest displacement [pixels] of the lens "
+                     "distortion, written as the metafile's "
+                     "sharedTransform"))
+    n_points = Int(
+        required=False,
+        missing=50,
+        default=50,
+        description="point pairs in each matcher block")
+    match_noise = Float(
+        required=False,
+        missing=0.5,
+        default=0.5,
+        description=("standard deviation [pixels] of the localization "
+                     "error of matched points"))
+    outlier_fraction = Float(
+        required=False,
+        missing=0.0,
+        default=0.0,
+        description=("fraction of the point pairs of each matcher "
+                     "block replaced by random outliers"))
+    bad_edge_fraction = Float(
+        required=False,
+        missing=0.0,
+        default=0.0,
+        description=("fraction of matcher blocks made up of outliers "
+                     "only, as from a failed template match"))
+    missing_edge_fraction = Float(
+        required=False,
+        missing=0.0,
+        default=0.0,
+        description=("fraction of matcher blocks flagged with "
+                     "match_quality -1, without matches"))
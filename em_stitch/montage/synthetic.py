@@ -0,0 +1,226 @@
+"""synthetic TEMCA montage metafiles of any size.
+
+Writes a _metadata*.json for a raster of n_rows x n_cols tiles with
+stage jitter, a shared lens distortion and a matcher block for the
+LEFT, TOP and RIGHT edge of each tile, as read by
+em_stitch.montage.meta_to_collection. Outliers, failed edges (all
+outliers) and edges without matches (match_quality -1) can be mixed
+in at controllable rates. No images are needed, and everything is
+determined by the seed.
+
+The true tile positions are written to expected_positions.json. The
+acquisition matches lens corrected tiles, so the point pairs of a
+matcher follow p + t_p = q + t_q with t the true positions, up to the
+match noise. The sharedTransform is only applied to the tiles.
+"""
+import os
+
+import numpy as np
+
+from argschema import ArgSchemaParser
+
+from em_stitch.lens_correction.synthetic import (
+        generate_distortion, tile_positions)
+from em_stitch.montage.meta_to_collection import Edge, neighbor_offsets
+from em_stitch.montage.schemas import SyntheticMontageDataSchema
+from em_stitch.utils import jsongz
+from em_stitch.utils.profiling import profiled
+
+example = {
+        "output_dir": "/data/em-131fs3/synthetic/montage_100x100",
+        "seed": 0,
+        "n_rows": 100,
+        "n_cols": 100,
+        "outlier_fraction": 0.05,
+        "bad_edge_fraction": 0.01,
+        "log_level": "INFO"
+        }
+
+expected_positions_name = 'expected_positions.json'
+
+# matcher blocks of each tile, in the order the acquisition writes them
+matcher_edges = [Edge.LEFT, Edge.TOP, Edge.RIGHT]
+
+
+def raster_edges(n_rows, n_cols):
+    """matcher blocks of a raster
+
+    Returns
+    -------
+    q : numpy.ndarray
+        index of the tile of each block
+    p : numpy.ndarray
+        index of the neighbor it matches to, -1 at the raster border
+    edge : numpy.ndarray
+        Edge of each block
+    """
+    col, row = np.meshgrid(np.arange(n_cols), np.arange(n_rows))
+    col = col.flatten()
+    row = row.flatten()
+    q = np.repeat(np.arange(col.size), len(matcher_edges))
+    edge = np.tile(np.array([int(e) for e in matcher_edges]), col.size)
+    offsets = np.array([neighbor_offsets[e] for e in matcher_edges])
+    pc = col[q] + np.tile(offsets[:, 0], col.size)
+    pr = row[q] + np.tile(offsets[:, 1], col.size)
+    inside = (pc >= 0) & (pc < n_cols) & (pr >= 0) & (pr < n_rows)
+    p = np.where(inside, pr * n_cols + pc, -1)
+    return q, p, edge
+
+
+class GenerateSyntheticMontageData(ArgSchemaParser):
+    default_schema = SyntheticMontageDataSchema
+
+    def metadata(self, grid):
+        return {
+            "calibration": {
+                "highmag": {
+                    "nm_per_pix": self.args['pixel_size'],
+                    "x_nm_per_pix": self.args['pixel_size'],
+                    "y_nm_per_pix": self.args['pixel_size'],
+                    "angle": 0.0}},
+            "camera_info": {
+                "width": self.args['tile_width'],
+                "height": self.args['tile_height'],
+                "pixel_depth": 1,
+                "camera_bpp": 8,
+                "camera_model": "synthetic",
+                "camera_id": "synthetic"},
+            "grid": grid,
+            "media": "tape",
+            "media_id": "0147",
+            "overlap": self.args['overlap'],
+            "roi_index": 0,
+            "session_id": "synthetic",
+            "specimen_id": "synthetic",
+            "temca_id": "synthetic"}
+
+    def edge_points(self, t_p, t_q, rng):
+        """point pairs of the matcher blocks between tiles at true
+        positions t_p and t_q, Ex2 arrays
+
+        Returns
+        -------
+        p : numpy.ndarray
+            E x n x 2 points in the p tiles
+        q : numpy.ndarray
+            E x n x 2 points in the q tiles
+        """
+        n = self.args['n_points']
+        size = np.array([self.args['tile_width'], self.args['tile_height']])
+        lower = np.maximum(t_p, t_q)
+        extent = np.minimum(t_p, t_q) + size - lower
+        X = (lower[:, np.newaxis, :] +
+             rng.uniform(size=(t_p.shape[0], n, 2)) *
+             extent[:, np.newaxis, :])
+        noise = self.args['match_noise']
+        p = X - t_p[:, np.newaxis, :] + rng.normal(0, noise, size=X.shape)
+        q = X - t_q[:, np.newaxis, :] + rng.normal(0, noise, size=X.shape)
+
+        # outliers anywhere in the overlap
+        random_q = (
+            (lower - t_q)[:, np.newaxis, :] +
+            rng.uniform(size=X.shape) * extent[:, np.newaxis, :])
+        outlier = rng.uniform(size=X.shape[:2]) < (
+            self.args['outlier_fraction'])
+        q[outlier] = random_q[outlier]
+        return p, q, outlier
+
+    @profiled
+    def run(self):
+        rng = np.random.RandomState(self.args['seed'])
+        width = self.args['tile_width']
+        height = self.args['tile_height']
+        pixel_size = self.args['pixel_size']
+        size = np.array([width, height])
+
+        tform = generate_distortion(
+            width, height, self.args['distortion_scale'], 8, rng)
+        raster, recorded, true = tile_positions(
+            self.args['n_rows'], self.args['n_cols'], width, height,
+            self.args['overlap'], self.args['stage_error'], rng)
+
+        qind, pind, edges = raster_edges(
+            self.args['n_rows'], self.args['n_cols'])
+        has_neighbor = pind >= 0
+        draw = rng.uniform(size=(pind.size, 2))
+        missing = has_neighbor & (
+            draw[:, 0] < self.args['missing_edge_fraction'])
+        bad = has_neighbor & ~missing & (
+            draw[:, 1] < self.args['bad_edge_fraction'])
+        matched = np.flatnonzero(has_neighbor & ~missing)
+
+        p, q, outlier = self.edge_points(
+            true[pind[matched]], true[qind[matched]], rng)
+        outlier[bad[matched]] = True
+        random_q = rng.uniform(size=q.shape) * size
+        q[bad[matched]] = random_q[bad[matched]]
+        inside = np.all(
+            (p >= 0) & (p < size) & (q >= 0) & (q < size), axis=2)
+        p = np.round(p, 2)
+        q = np.round(q, 2)
+
+        grid = self.args['seed']
+        data = []
+        for (col, row), pos in zip(raster, recorded):
+            data.append({
+                "img_path": "synthetic_%d_%d_%d.tif" % (grid, col, row),
+                "img_meta": {
+                    "raster_index": len(data),
+                    "stage_pos": (pos * pixel_size).tolist(),
+                    "raster_pos": [int(col), int(row)],
+                    "pixel_size": pixel_size,
+                    "pixel_size_x_move": pixel_size,
+                    "pixel_size_y_move": pixel_size,
+                    "angle": 0.0},
+                "matcher": []})
+        block = {i: j for j, i in enumerate(matched)}
+        for i, (tile, edge) in enumerate(zip(qind, edges)):
+            matcher = {"position": int(edge), "match_quality": -1}
+            if i in block:
+                j = block[i]
+                keep = inside[j]
+                matcher["match_quality"] = float(
+                    1.0 - outlier[j][keep].mean()) if keep.any() else 0.0
+                matcher.update({
+                    "pX": p[j, keep, 0].tolist(),
+                    "pY": p[j, keep, 1].tolist(),
+                    "qX": q[j, keep, 0].tolist(),
+                    "qY": q[j, keep, 1].tolist()})
+            else:
+                matcher.update({"pX": [], "pY": [], "qX": [], "qY": []})
+            data[tile]["matcher"].append(matcher)
+
+        out_dir = self.args['output_dir']
+        metafile = jsongz.dump(
+            [
+                {"metadata": self.metadata(grid)},
+                {"data": data},
+                {"sharedTransform": tform.to_dict()}],
+            os.path.join(out_dir, "_metadata_synthetic_%d.json" % grid),
+            compress=False)
+        tile_ids = [os.path.splitext(d['img_path'])[0] for d in data]
+        expected = jsongz.dump(
+            {
+                "translations": dict(zip(tile_ids, true.tolist())),
+                "tile_width": width,
+                "tile_height": height},
+            os.path.join(out_dir, expected_positions_name),
+            compress=False)
+
+        self.results = {
+            "data_dir": out_dir,
+            "metafile": metafile,
+            "expected_positions": expected,
+            "n_tiles": len(data),
+            "n_edges": int(matched.size),
+            "n_bad_edges": int(np.count_nonzero(bad)),
+            "n_missing_edges": int(np.count_nonzero(missing)),
+            "n_point_pairs": int(np.count_nonzero(inside)),
+            "n_outliers": int(np.count_nonzero(outlier & inside))}
+        if 'output_json' in self.args:
+            self.output(self.results, indent=2)
+
+
+if __name__ == '__main__':
+    gmod = GenerateSyntheticMontageData(input_data=example)
+    gmod.run()
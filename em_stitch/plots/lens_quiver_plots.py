@@ -1,20 +1,18 @@
 import datetime
 import glob
-import json
 import os
 import re
 import warnings
 
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pyplot as plt
 import numpy as np
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
-import renderapi
 
 from em_stitch.utils.utils import src_from_xy
 from em_stitch.plots.schemas import LensQuiverSchema
+from em_stitch.utils import jsongz
+from em_stitch.utils.profiling import profiled
+from em_stitch.utils.transform_sidecar import load_lens_transform
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -32,6 +30,9 @@ example = {
 
 def plot_lens_changes(
         lcs, arrow_scale=10.0, num=1, pdfname='lens_changes.pdf'):
+    from matplotlib.backends.backend_pdf import PdfPages
+    import matplotlib.pyplot as plt
+
     scale = 1.0 / arrow_scale
     with PdfPages(pdfname) as pdf:
         for lc in lcs:
@@ -40,43 +41,33 @@ def plot_lens_changes(
             dtsf = dt.strftime('%Y-%m-%d %H:%M:%S')
             ddir = os.path.dirname(lc)
             mfile = glob.glob(os.path.join(ddir, '_metadata*.json'))[0]
-            with open(mfile, 'r') as f:
-                meta = json.load(f)
+            meta = jsongz.load(mfile)
             obj_focus = meta[0]['metadata']['objective_focus']
             print(obj_focus)
-            with open(lc, 'r') as f:
-                tf = renderapi.transform.ThinPlateSplineTransform(
-                        json=json.load(f))
-                sz = tf.srcPts.max(axis=1)
-                src = src_from_xy(
-                        np.linspace(0, sz[0], 20),
-                        np.linspace(0, sz[1], 20))
-                dst = tf.tform(src)
-                delta = dst - src
-                rmax = np.linalg.norm(delta, axis=1).max()
-                fig, axes = plt.subplots(
-                        1, 1, num=1, clear=True, figsize=(11, 8))
-                axes.quiver(
-                        src[:, 0], src[:, 1], delta[:, 0], delta[:, 1],
-                        angles='xy', scale=scale, scale_units='xy')
-                axes.invert_yaxis()
-                axes.set_aspect('equal')
-                axes.set_title(
-                        dtsf + '\n' + lc + "\nfull transform max: %0.1f "
-                        "pixels\narrow scale = %0.1f\nobjective focus: %d" %
-                        (rmax, arrow_scale, obj_focus))
-                pdf.savefig(fig)
+            tf = load_transform(lc)
+            sz = tf.srcPts.max(axis=1)
+            src = src_from_xy(
+                    np.linspace(0, sz[0], 20),
+                    np.linspace(0, sz[1], 20))
+            dst = tf.tform(src)
+            delta = dst - src
+            rmax = np.linalg.norm(delta, axis=1).max()
+            fig, axes = plt.subplots(
+                    1, 1, num=1, clear=True, figsize=(11, 8))
+            axes.quiver(
+                    src[:, 0], src[:, 1], delta[:, 0], delta[:, 1],
+                    angles='xy', scale=scale, scale_units='xy')
+            axes.invert_yaxis()
+            axes.set_aspect('equal')
+            axes.set_title(
+                    dtsf + '\n' + lc + "\nfull transform max: %0.1f "
+                    "pixels\narrow scale = %0.1f\nobjective focus: %d" %
+                    (rmax, arrow_scale, obj_focus))
+            pdf.savefig(fig)
 
 
 def load_transform(path):
-    j = jsongz.load(path)
-
-    try:
-        return renderapi.transform.ThinPlateSplineTransform(
-                json=j)
-    except KeyError:
-        res = renderapi.resolvedtiles.ResolvedTiles(json=j)
-        return res.transforms[0]
+    return load_lens_transform(path)
 
 
 def grid_from_tform(tform, xpts=20, ypts=20):
@@ -120,7 +111,11 @@ def lens_quiver(ax, tform, src, arrow_scale=1.0, title=None):
 class LensQuiverPlots(ArgSchemaParser):
     default_schema = LensQuiverSchema
 
+    @profiled
     def run(self):
+        from matplotlib.backends.backend_pdf import PdfPages
+        import matplotlib.pyplot as plt
+
         tforms = [load_transform(p) for p in self.args['transform_list']]
 
         grid = grid_from_tform(
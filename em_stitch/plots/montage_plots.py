@@ -1,16 +1,13 @@
-import json
 import os
 
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 import numpy as np
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
 import renderapi
 
 from em_stitch.plots.schemas import MontagePlotsSchema
+from em_stitch.utils import jsongz
+from em_stitch.utils.profiling import profiled
 
 example = {
         "collection_path": "/data/em-131fs3/lctest/T4.2019.04.29b/001738/0/collection.json.gz",
@@ -104,6 +101,8 @@ def one_plot(f, ax, xy, c, vmin=-100, vmax=100, title=None, colorbar=True,fontsi
             s=2.5,
             vmin=vmin,
             vmax=vmax)
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+
     ax.set_aspect('equal')
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="3%", pad=0.5)
@@ -117,21 +116,25 @@ def one_plot(f, ax, xy, c, vmin=-100, vmax=100, title=None, colorbar=True,fontsi
 class MontagePlots(ArgSchemaParser):
     default_schema = MontagePlotsSchema
 
+    @profiled
     def run(self):
+        # matplotlib is slow to import, defer it until plotting
+        from matplotlib.backends.backend_pdf import PdfPages
+        import matplotlib.pyplot as plt
+
         matches = jsongz.load(self.args['collection_path'])
         resolved = renderapi.resolvedtiles.ResolvedTiles(
                 json=jsongz.load(self.args['resolved_path']))
 
         xy, res, mxy, mres = make_xyres(matches, resolved)
         if self.args['save_json_path']:
-            with open(self.args['save_json_path'], 'w') as f:
-                json.dump(
-                        {
-                            'xy': xy.tolist(),
-                            'res': res.tolist(),
-                            'filtered_xy': mxy.tolist(),
-                            'filtered_res': mres.tolist()
-                            }, f, indent=2)
+            jsongz.dump(
+                    {
+                        'xy': xy.tolist(),
+                        'res': res.tolist(),
+                        'filtered_xy': mxy.tolist(),
+                        'filtered_res': mres.tolist()
+                        }, self.args['save_json_path'], indent=2)
 
         pdf = None 
         if self.args['pdf_out']:
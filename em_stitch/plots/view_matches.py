@@ -1,17 +1,15 @@
 import logging
 import os
 
-import cv2
 import numpy as np
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pyplot as plt
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
-import renderapi
 
 from em_stitch.plots.schemas import ViewMatchesSchema
 from em_stitch.lens_correction.utils import maps_from_tform
+from em_stitch.utils import jsongz
+from em_stitch.utils.profiling import profiled
+from em_stitch.utils.transform_sidecar import load_lens_transform
 
 logger = logging.getLogger()
 
@@ -29,6 +27,8 @@ def find_ind(matches, ids):
 
 
 def get_ims_and_coords(m, ddir):
+    import matplotlib.pyplot as plt
+
     pname = os.path.join(ddir, m['pId'] + '.tif')
     qname = os.path.join(ddir, m['qId'] + '.tif')
     pim = plt.imread(pname, 0)
@@ -41,6 +41,9 @@ def get_ims_and_coords(m, ddir):
 
 def plot_ims_and_coords(
         pim, qim, p, q, w, pname=None, qname=None, fignum=1, tform=None):
+    import cv2
+    import matplotlib.pyplot as plt
+
     if tform:
         map1, map2, mask = maps_from_tform(
                 tform, pim.shape[1], pim.shape[0])
@@ -71,7 +74,11 @@ example = {
 class ViewMatches(ArgSchemaParser):
     default_schema = ViewMatchesSchema
 
+    @profiled
     def run(self):
+        from matplotlib.backends.backend_pdf import PdfPages
+        import matplotlib.pyplot as plt
+
         cpath = self.args.get(
                 'collection_path',
                 os.path.join(
@@ -107,17 +114,14 @@ class ViewMatches(ArgSchemaParser):
     def get_transform(self):
         self.tform = None
         if 'transform_file' in self.args:
-            self.tform = renderapi.transform.ThinPlateSplineTransform(
-                    json=jsongz.load(self.args['transform_file']))
+            self.tform = load_lens_transform(self.args['transform_file'])
         else:
             for fbase in self.args['resolved_tiles']:
                 fpath = os.path.join(
                         self.args['data_dir'],
                         fbase)
                 if os.path.isfile(fpath):
-                    resolved = renderapi.resolvedtiles.ResolvedTiles(
-                            json=jsongz.load(fpath))
-                    self.tform = resolved.transforms[0]
+                    self.tform = load_lens_transform(fpath)
                     break
 
 
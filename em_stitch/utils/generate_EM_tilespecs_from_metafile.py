@@ -1,13 +1,14 @@
-import json
 import os
 import pathlib
 
 import numpy
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
 import renderapi
 
+from . import jsongz
+from .metafile import as_metafile
+from .profiling import profiled
 from .schemas import GenerateEMTileSpecsParameters
 
 # this is a modification of https://github.com/AllenInstitute/
@@ -23,6 +24,17 @@ class RenderModuleException(Exception):
 
 class GenerateEMTileSpecsModule(ArgSchemaParser):
     default_schema = GenerateEMTileSpecsParameters
+    # renderapi.transform.AffineModel dataString for a translation
+    affine_datastring = ("1.0000000000 0.0000000000 0.0000000000 "
+                         "1.0000000000 %.10f %.10f")
+
+    def __init__(self, *args, **kwargs):
+        # an already parsed em_stitch.utils.metafile.Metafile
+        # can be shared to avoid reading the metafile again
+        self.metafile = kwargs.pop('metafile', None)
+        self._tilespecs = None
+        self._render_tspecs = None
+        super(GenerateEMTileSpecsModule, self).__init__(*args, **kwargs)
 
     @staticmethod
     def image_coords_from_stage(stage_coords, resX, resY, rotation):
@@ -33,6 +45,56 @@ class GenerateEMTileSpecsModule(ArgSchemaParser):
         return (int(x * cr + y * sr),
                 int(-x * sr + y * cr))
 
+    @staticmethod
+    def image_coords_from_stage_array(stage_coords, resX, resY, rotation):
+        """vectorized image_coords_from_stage
+
+        Parameters
+        ----------
+        stage_coords : numpy.ndarray
+            Nx2 stage coordinates
+        resX : numpy.ndarray
+            N x resolutions
+        resY : numpy.ndarray
+            N y resolutions
+        rotation : numpy.ndarray
+            N rotations [radians]
+
+        Returns
+        -------
+        coords : numpy.ndarray
+            Nx2 integer image coordinates, truncated as by int()
+        """
+        cr = numpy.cos(rotation)
+        sr = numpy.sin(rotation)
+        x = stage_coords[:, 0] / resX
+        y = stage_coords[:, 1] / resY
+        return numpy.vstack((
+            x * cr + y * sr,
+            -x * sr + y * cr)).transpose().astype('int64')
+
+    @classmethod
+    def image_coords_from_imgdata(cls, imgdata):
+        """image coordinates of all tiles, relative to their minimum
+
+        Parameters
+        ----------
+        imgdata : list of dict
+            the 'data' block of a metafile
+
+        Returns
+        -------
+        coords : numpy.ndarray
+            Nx2 integer image coordinates
+        """
+        meta = [img['img_meta'] for img in imgdata]
+        coords = cls.image_coords_from_stage_array(
+            numpy.array([m['stage_pos'] for m in meta], dtype='float64'),
+            numpy.array([m['pixel_size_x_move'] for m in meta]),
+            numpy.array([m['pixel_size_y_move'] for m in meta]),
+            numpy.radians(numpy.array([m['angle'] for m in meta])))
+        return coords - coords.min(axis=0)
+
     @staticmethod
     def tileId_from_basename(fname):
         return os.path.splitext(os.path.basename(fname))[0]
@@ -88,13 +150,8 @@ class GenerateEMTileSpecsModule(ArgSchemaParser):
             minimum_intensity=0, maximum_intensity=255, maskUrl=None):
         roidata = md[0]['metadata']
         imgdata = md[1]['data']
-        img_coords = {img['img_path']: cls.image_coords_from_stage(
-            img['img_meta']['stage_pos'],
-            img['img_meta']['pixel_size_x_move'],
-            img['img_meta']['pixel_size_y_move'],
-            numpy.radians(img['img_meta']['angle'])) for img in imgdata}
+        img_coords = cls.image_coords_from_imgdata(imgdata)
 
-        minX, minY = numpy.min(numpy.array(list(img_coords.values())), axis=0)
         # assume isotropic pixels
         pixelsize = roidata['calibration']['highmag']['x_nm_per_pix']
         
@@ -109,54 +166,111 @@ class GenerateEMTileSpecsModule(ArgSchemaParser):
         tspecs = [
                 cls.ts_from_imgdata_tileId(
                     img, image_directory,
-                    img_coords[img['img_path']][0] - minX,
-                    img_coords[img['img_path']][1] - minY,
+                    img_coords[i, 0],
+                    img_coords[i, 1],
                     cls.tileId_from_basename(img["img_path"]),
                     width=roidata['camera_info']['width'],
                     height=roidata['camera_info']['height'],
                     scopeId=roidata['temca_id'],
                     cameraId=roidata['camera_info']['camera_id'],
-                    pixelsize=pixelsize, **inputs) for img in imgdata]
+                    pixelsize=pixelsize, **inputs)
+                for i, img in enumerate(imgdata)]
+        return tspecs
+
+    @classmethod
+    def tilespec_dicts_from_imgdata(
+            cls, roidata, imgdata, imgdir, z, sectionId,
+            minint=0, maxint=255, maskUrl=None):
+        """json tilespecs for all tiles of a metafile, without
+        constructing a TileSpec per tile. One TileSpec is built as
+        a template and the per-tile values are filled into copies
+        of its dictionary.
+
+        Parameters
+        ----------
+        roidata : dict
+            the 'metadata' block of a metafile
+        imgdata : list of dict
+            the 'data' block of a metafile
+        imgdir : str
+            directory containing the images
+        z : float
+            z value
+        sectionId : str
+            sectionId for all tiles
+
+        Returns
+        -------
+        tilespecs : list of dict
+            same as [TileSpec.to_dict() ...] for the tiles
+        """
+        if len(imgdata) == 0:
+            return []
+        img_coords = cls.image_coords_from_imgdata(imgdata)
+        template = cls.ts_from_imgdata_tileId(
+            imgdata[0], imgdir, 0, 0,
+            cls.tileId_from_basename(imgdata[0]['img_path']),
+            minint=minint, maxint=maxint, maskUrl=maskUrl,
+            width=roidata['camera_info']['width'],
+            height=roidata['camera_info']['height'],
+            z=z, sectionId=sectionId,
+            scopeId=roidata['temca_id'],
+            cameraId=roidata['camera_info']['camera_id'],
+            # assume isotropic pixels
+            pixelsize=roidata['calibration']['highmag']['x_nm_per_pix']
+            ).to_dict()
+        tform = template['transforms']['specList'][0]
+        mipmap = template['mipmapLevels']['0']
+        imgdir = os.path.abspath(imgdir)
+
+        tspecs = []
+        for img, (x, y) in zip(imgdata, img_coords):
+            meta = img['img_meta']
+            d = dict(template)
+            d['tileId'] = cls.tileId_from_basename(img['img_path'])
+            d['layout'] = dict(
+                template['layout'],
+                imageCol=meta['raster_pos'][0],
+                imageRow=meta['raster_pos'][1],
+                stageX=meta['stage_pos'][0],
+                stageY=meta['stage_pos'][1],
+                rotation=meta['angle'])
+            d['mipmapLevels'] = {'0': dict(
+                mipmap,
+                imageUrl=pathlib.Path(os.path.abspath(
+                    os.path.join(imgdir, img['img_path']))).as_uri())}
+            d['transforms'] = {
+                'type': 'list',
+                'specList': [dict(
+                    tform,
+                    dataString=cls.affine_datastring % (x, y))]}
+            tspecs.append(d)
         return tspecs
 
+    @profiled
     def run(self):
-        with open(self.args['metafile'], 'r') as f:
-            meta = json.load(f)
-        roidata = meta[0]['metadata']
-        imgdata = meta[1]['data']
-        img_coords = {img['img_path']: self.image_coords_from_stage(
-            img['img_meta']['stage_pos'],
-            img['img_meta']['pixel_size_x_move'],
-            img['img_meta']['pixel_size_y_move'],
-            numpy.radians(img['img_meta']['angle'])) for img in imgdata}
+        if self.metafile is None:
+            self.metafile = as_metafile(self.args['metafile'])
+        roidata = self.metafile.metadata
+        imgdata = self.metafile.data
 
         # if not imgdata:
         #     raise RenderModuleException(
         #         "No relevant image metadata found for metafile {}".format(
         #             self.args['metafile']))
 
-        minX, minY = numpy.min(numpy.array(list(img_coords.values())), axis=0)
-        # assume isotropic pixels
-        pixelsize = roidata['calibration']['highmag']['x_nm_per_pix']
-
         imgdir = self.args.get(
             'image_directory', os.path.dirname(self.args['metafile']))
+        sectionId = self.args.get('sectionId')
+        if sectionId is None:
+            sectionId = self.sectionId_from_z(self.args['z'])
 
-        self.render_tspecs = [
-                self.ts_from_imgdata(
-                    img, imgdir,
-                    img_coords[img['img_path']][0] - minX,
-                    img_coords[img['img_path']][1] - minY,
-                    minint=self.args['minimum_intensity'],
-                    maxint=self.args['maximum_intensity'],
-                    width=roidata['camera_info']['width'],
-                    height=roidata['camera_info']['height'],
-                    z=self.args['z'],
-                    sectionId=self.args.get('sectionId'),
-                    scopeId=roidata['temca_id'],
-                    cameraId=roidata['camera_info']['camera_id'],
-                    pixelsize=pixelsize,
-                    maskUrl=self.args['maskUrl']) for img in imgdata]
+        self._render_tspecs = None
+        self._tilespecs = self.tilespec_dicts_from_imgdata(
+            roidata, imgdata, imgdir, self.args['z'], sectionId,
+            minint=self.args['minimum_intensity'],
+            maxint=self.args['maximum_intensity'],
+            maskUrl=self.args['maskUrl'])
 
         if 'output_path' in self.args:
             self.args['output_path'] = jsongz.dump(
@@ -166,8 +280,17 @@ class GenerateEMTileSpecsModule(ArgSchemaParser):
 
     @property
     def tilespecs(self):
-        tjs = [t.to_dict() for t in self.render_tspecs]
-        return tjs
+        """list of json tilespecs generated by run()"""
+        return self._tilespecs
+
+    @property
+    def render_tspecs(self):
+        """list of renderapi.tilespec.TileSpec generated by run(),
+        constructed on first access"""
+        if self._render_tspecs is None:
+            self._render_tspecs = [
+                renderapi.tilespec.TileSpec(json=t) for t in self.tilespecs]
+        return self._render_tspecs
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+"""lightweight timing and memory spans for pipeline stages.
+
+    timings = Timings()
+    with timings.span('filter') as span:
+        ...
+        span.annotate(n_matches=len(matches))
+    result['timings'] = timings.to_dict()
+
+Each span records its wall time, process cpu time and the increase in
+the process' peak resident set size. If tracemalloc is tracing (e.g.
+with PYTHONTRACEMALLOC=1) the peak of traced Python allocations
+during the span is recorded as well. Before Python 3.9 the peak
+cannot be reset, so it is the peak since tracing started, an upper
+bound. Spans nest, nested names are joined with '.'.
+"""
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def max_rss_mb():
+    """peak resident set size of this process [MB], or None where it
+    cannot be measured"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux
+    return maxrss / 1024.0
+
+
+class Span(object):
+    """a timed section of code, see :meth:`Timings.span`"""
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+        self.record = {}
+        self._child_peak = 0
+
+    def annotate(self, **kwargs):
+        """add json serializable values to the span's record"""
+        self.record.update(kwargs)
+
+    def __enter__(self):
+        stack = self.timings._stack
+        if stack:
+            self.name = stack[-1].name + '.' + self.name
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # keep the enclosing span's peak before resetting it
+                stack[-1]._child_peak = max(stack[-1]._child_peak, peak)
+            self._traced0 = current
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        stack.append(self)
+        self._rss0 = max_rss_mb()
+        self._cpu0 = time.process_time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall_time = time.perf_counter() - self._t0
+        cpu_time = time.process_time() - self._cpu0
+        rss = max_rss_mb()
+        self.timings._stack.pop()
+        record = {
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'max_rss_delta_mb': (
+                None if rss is None else rss - self._rss0)}
+        if tracemalloc.is_tracing() and hasattr(self, '_traced0'):
+            peak = max(self._child_peak, tracemalloc.get_traced_memory()[1])
+            record['tracemalloc_peak_mb'] = (
+                (peak - self._traced0) / 2.0**20)
+            if self.timings._stack:
+                parent = self.timings._stack[-1]
+                parent._child_peak = max(parent._child_peak, peak)
+        record.update(self.record)
+        self.timings.spans[self.name] = record
+        return False
+
+
+class Timings(object):
+    """collects the spans of a run"""
+    def __init__(self):
+        self.spans = {}
+        self._stack = []
+
+    def span(self, name):
+        """context manager timing a section of code
+
+        Parameters
+        ----------
+        name : str
+            span name, prefixed by the names of enclosing spans
+
+        Returns
+        -------
+        span : Span
+            use :meth:`Span.annotate` to add counts to its record
+        """
+        return Span(self, name)
+
+    def update(self, spans, prefix=None):
+        """add spans recorded elsewhere, e.g. by a submodule
+
+        Parameters
+        ----------
+        spans : dict
+            from :meth:`to_dict`
+        prefix : str
+            prepended to their names, joined with '.'
+        """
+        for name, record in spans.items():
+            if prefix:
+                name = prefix + '.' + name
+            self.spans[name] = record
+
+    def to_dict(self):
+        """spans by name, in the order they completed"""
+        return dict(self.spans)
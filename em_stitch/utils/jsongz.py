@@ -0,0 +1,348 @@
+"""json and json.gz reading and writing for em_stitch artifacts.
+
+A drop-in replacement for :mod:`bigfeta.jsongz`: files written here
+can be read by ``bigfeta.jsongz.load`` and vice versa. It differs in
+that
+
+* a fast json codec (orjson, then ujson) is used when installed,
+  falling back to the standard library :mod:`json` for anything it
+  does not handle, or when extra :py:func:`json.dump` arguments such
+  as ``indent`` are given.
+* the gzip compression level is configurable, and large payloads are
+  deflated in blocks on a thread pool (the same scheme as pigz), which
+  still produces a single standard gzip member.
+* .json.gz files are decompressed incrementally into a single buffer
+  sized from the gzip trailer, which is handed to the json decoder
+  without an intermediate decoded string. Peak memory is the
+  decompressed text plus the decoded object, not the compressed file
+  and the chunks of the decompression as well. Decoding itself is not
+  incremental: the fast decoders only take complete documents, and the
+  decoded objects are several times larger than the text. Metafiles
+  and match collections too large for that are streamed with
+  em_stitch.utils.metafile.
+
+orjson writes non-finite floats as ``null``, so objects holding any
+are written by the standard library, as ``NaN``/``Infinity``.
+"""
+import concurrent.futures
+import gzip
+import json
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+default_compresslevel = 6
+default_threads = None
+default_block_size = 2**20
+
+# deflate history carried between blocks
+_window_size = 2**15
+
+
+def _convert_ext(filepath, compress):
+    b, e = os.path.splitext(filepath)
+    filepath = b + '.json'
+    if compress:
+        filepath += '.gz'
+    return filepath
+
+
+def _check_ext(filepath):
+    b, e = os.path.splitext(filepath)
+    return e == '.gz'
+
+
+def _has_nonfinite(obj):
+    """whether a json serializable object holds a NaN or Inf float"""
+    if isinstance(obj, float):
+        return not np.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_nonfinite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_nonfinite(v) for v in obj)
+    if isinstance(obj, (np.ndarray, np.floating)):
+        return (obj.dtype.kind in 'fc') and not np.all(np.isfinite(obj))
+    return False
+
+
+def _numpy_default(obj):
+    # what orjson.OPT_SERIALIZE_NUMPY handles, for the json fallback
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(
+        "Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+def dumps(obj, encoding='utf-8', *args, **kwargs):
+    """encode obj as json bytes
+
+    Parameters
+    ----------
+    obj : obj
+        object to encode
+    encoding : str
+        encoding of the json text. The fast codecs are only used for
+        utf-8.
+    *args
+        :py:func:`json.dumps` args
+    **kwargs
+        :py:func:`json.dumps` kwargs
+
+    Returns
+    -------
+    data : bytes
+        encoded object
+    """
+    if not args and not kwargs and encoding.lower() in ('utf-8', 'utf8'):
+        if orjson is not None:
+            try:
+                data = orjson.dumps(
+                    obj,
+                    option=(orjson.OPT_SERIALIZE_NUMPY |
+                            orjson.OPT_NON_STR_KEYS))
+            except TypeError:
+                pass
+            else:
+                # non-finite floats became null, only look for them
+                # when there is one
+                if (b'null' not in data) or not _has_nonfinite(obj):
+                    return data
+                return json.dumps(
+                    obj, default=_numpy_default).encode(encoding)
+        elif ujson is not None:
+            try:
+                return ujson.dumps(
+                    obj, ensure_ascii=False,
+                    escape_forward_slashes=False).encode(encoding)
+            except (TypeError, ValueError, OverflowError):
+                pass
+    return json.dumps(obj, *args, **kwargs).encode(encoding)
+
+
+def loads(data, encoding='utf-8', *args, **kwargs):
+    """decode json bytes
+
+    Parameters
+    ----------
+    data : bytes or str
+        json text
+    encoding : str
+        encoding of data if it is bytes
+    *args
+        :py:func:`json.loads` args
+    **kwargs
+        :py:func:`json.loads` kwargs
+
+    Returns
+    -------
+    obj : obj
+        decoded object
+    """
+    if not args and not kwargs and encoding.lower() in ('utf-8', 'utf8'):
+        # fast codecs reject some things json accepts, like NaN
+        if orjson is not None:
+            try:
+                return orjson.loads(data)
+            except ValueError:
+                pass
+        elif ujson is not None:
+            try:
+                return ujson.loads(
+                    bytes(data) if isinstance(data, bytearray) else data)
+            except ValueError:
+                pass
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode(encoding)
+    return json.loads(data, *args, **kwargs)
+
+
+def _deflate_block(data, start, stop, compresslevel, last):
+    if start > 0:
+        # prime with the end of the previous block, as pigz does,
+        # so the compression ratio is close to a single stream
+        c = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+            zdict=data[max(0, start - _window_size):start])
+    else:
+        c = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    block = c.compress(data[start:stop])
+    # a sync flush ends on a byte boundary so the blocks concatenate
+    block += c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return block
+
+
+def gzip_compress(data, compresslevel=None, threads=None, block_size=None):
+    """gzip compress bytes, deflating blocks concurrently
+
+    Parameters
+    ----------
+    data : bytes
+        uncompressed data
+    compresslevel : int
+        gzip compression level 0-9. default is default_compresslevel
+    threads : int
+        number of compression threads. default (None) uses
+        default_threads, or os.cpu_count() if that is also None.
+    block_size : int
+        uncompressed bytes per block. default is default_block_size
+
+    Returns
+    -------
+    gz : bytes
+        a single gzip member readable by :py:mod:`gzip`
+    """
+    compresslevel = (
+        default_compresslevel if compresslevel is None else compresslevel)
+    threads = threads or default_threads or os.cpu_count() or 1
+    block_size = block_size or default_block_size
+
+    data = memoryview(data)
+    starts = list(range(0, len(data), block_size)) or [0]
+    stops = starts[1:] + [len(data)]
+    lasts = [False] * (len(starts) - 1) + [True]
+
+    if (threads > 1) and (len(starts) > 1):
+        # zlib releases the GIL while compressing
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=threads) as executor:
+            blocks = list(executor.map(
+                _deflate_block,
+                [data] * len(starts), starts, stops,
+                [compresslevel] * len(starts), lasts))
+    else:
+        blocks = [
+            _deflate_block(data, start, stop, compresslevel, last)
+            for start, stop, last in zip(starts, stops, lasts)]
+
+    xfl = {9: 2, 1: 4}.get(compresslevel, 0)
+    header = struct.pack(
+        '<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time.time()), xfl, 255)
+    trailer = struct.pack(
+        '<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return b''.join([header] + blocks + [trailer])
+
+
+def dump(obj, filepath, compress=None, encoding='utf-8', *args,
+         compresslevel=None, threads=None, atomic=False, **kwargs):
+    """json or json.gz dump
+
+    Parameters
+    ----------
+    obj : obj
+        object to dump
+    filepath : str
+        path for destination of dump
+    compress : bool or None
+        if None, file compressed or not according to filepath extension
+    encoding : str
+        encoding of the json text
+    *args
+        :py:func:`json.dump` args
+    compresslevel : int
+        keyword only. gzip compression level. default is
+        default_compresslevel
+    threads : int
+        keyword only. number of gzip compression threads. see
+        :func:`gzip_compress`
+    atomic : bool
+        keyword only. write to a temporary file and rename it into
+        place, so that readers never see a partially written file
+    **kwargs
+        :py:func:`json.dump` kwargs
+
+    Returns
+    -------
+    filepath : str
+        potentially modified filepath of dumped object
+        uncompressed are forced to '.json' and compressed to '.gz'
+    """
+    if not compress:
+        compress = _check_ext(filepath)
+    else:
+        filepath = _convert_ext(filepath, compress)
+
+    data = dumps(obj, encoding, *args, **kwargs)
+    if compress:
+        data = gzip_compress(
+            data, compresslevel=compresslevel, threads=threads)
+    if atomic:
+        tmp_path = '%s.%d.tmp' % (filepath, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+    else:
+        with open(filepath, 'wb') as f:
+            f.write(data)
+    return filepath
+
+
+def _read_gzip(filepath, chunk_size=2**20):
+    """decompress a gzip file chunk by chunk into one buffer
+
+    Returns
+    -------
+    data : bytearray
+        the decompressed contents
+    """
+    with open(filepath, 'rb') as raw:
+        # ISIZE, the size mod 2**32 of the last member
+        raw.seek(-4, os.SEEK_END)
+        size = struct.unpack('<I', raw.read(4))[0]
+        raw.seek(0)
+        data = bytearray(size)
+        n = 0
+        with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+            while True:
+                if n < len(data):
+                    with memoryview(data)[n:n + chunk_size] as view:
+                        k = f.readinto(view)
+                else:
+                    # several members, or more than 4 GiB
+                    more = f.read(chunk_size)
+                    data += more
+                    k = len(more)
+                if k == 0:
+                    break
+                n += k
+    del data[n:]
+    return data
+
+
+def load(filepath, encoding='utf-8', *args, **kwargs):
+    """json or json.gz load
+
+    Parameters
+    ----------
+    filepath : str
+        path for source of load
+    encoding : str
+        encoding of the json text
+    *args
+        :py:func:`json.load` args
+    **kwargs
+        :py:func:`json.load` kwargs
+
+    Returns
+    -------
+    obj : dict
+        loaded object
+    """
+    if _check_ext(filepath):
+        data = _read_gzip(filepath)
+    else:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+    return loads(data, encoding, *args, **kwargs)
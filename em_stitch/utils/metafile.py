@@ -0,0 +1,275 @@
+import gzip
+import json
+
+import numpy as np
+
+from . import jsongz
+
+_matcher_array_keys = ['pX', 'pY', 'qX', 'qY']
+
+
+class MetafileStreamException(Exception):
+    pass
+
+
+class _StreamDecoder(object):
+    """incremental json decoding of a text file. Values are decoded one
+    at a time with json.JSONDecoder.raw_decode, reading more of the file
+    only as needed.
+    """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self):
+        # read at least as much as is buffered so that repeated
+        # attempts at decoding a large value stay linear overall
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """next non-whitespace character, or None at end of file"""
+        while True:
+            while (self.pos < len(self.buf)) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return None
+            self._read()
+
+    def expect(self, chars):
+        """consume the next non-whitespace character, one of chars"""
+        c = self.peek()
+        if (c is None) or (c not in chars):
+            raise MetafileStreamException(
+                    "expected one of %r, found %r" % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """decode the next complete json value"""
+        self.peek()
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may be truncated
+                if (end < len(self.buf)) or self.eof:
+                    self.pos = end
+                    return v
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+
+def _matcher_arrays(tile):
+    for m in tile.get('matcher', []):
+        for k in _matcher_array_keys:
+            m[k] = np.asarray(m[k], dtype='float64')
+    return tile
+
+
+def iter_metafile_items(path, matchers_as_arrays=False, chunk_size=2**20):
+    """incrementally parse a metafile, holding at most one tile
+    in memory at a time.
+
+    Parameters
+    ----------
+    path : str
+        path to the metafile
+    matchers_as_arrays : bool
+        convert each matcher block's pX, pY, qX, qY to numpy arrays
+    chunk_size : int
+        number of characters to read from the file at a time
+
+    Yields
+    ------
+    key : str
+        'metadata', 'sharedTransform' or any other top-level block key.
+        For the 'data' block, one item is yielded per tile.
+    value : obj
+        block value, or one tile dict for 'data'
+    """
+    with open(path, 'r') as f:
+        dec = _StreamDecoder(f, chunk_size)
+        dec.expect('[')
+        if dec.peek() == ']':
+            return
+        while True:
+            dec.expect('{')
+            while dec.peek() != '}':
+                key = dec.value()
+                dec.expect(':')
+                if key == 'data':
+                    dec.expect('[')
+                    while dec.peek() != ']':
+                        tile = dec.value()
+                        if matchers_as_arrays:
+                            tile = _matcher_arrays(tile)
+                        yield key, tile
+                        if dec.peek() == ',':
+                            dec.expect(',')
+                    dec.expect(']')
+                else:
+                    yield key, dec.value()
+                if dec.peek() == ',':
+                    dec.expect(',')
+            dec.expect('}')
+            if dec.expect(',]') == ']':
+                break
+
+
+def iter_tiles(path, matchers_as_arrays=True, **kwargs):
+    """incrementally parse the tiles of a metafile
+
+    Parameters
+    ----------
+    path : str
+        path to the metafile
+    matchers_as_arrays : bool
+        convert each matcher block's pX, pY, qX, qY to numpy arrays
+
+    Yields
+    ------
+    tile : dict
+        one element of the metafile 'data' block
+    """
+    for key, value in iter_metafile_items(
+            path, matchers_as_arrays=matchers_as_arrays, **kwargs):
+        if key == 'data':
+            yield value
+
+
+def iter_collection(path, chunk_size=2**20):
+    """incrementally parse the point match collection of a template
+    matches file, holding at most one tile pair in memory at a time.
+
+    Parameters
+    ----------
+    path : str
+        path to the .json or .json.gz template matches, an object with
+        a 'collection' list
+    chunk_size : int
+        number of characters to read from the file at a time
+
+    Yields
+    ------
+    match : dict
+        one element of the 'collection' list
+    """
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rt')
+    else:
+        f = open(path, 'r')
+    with f:
+        dec = _StreamDecoder(f, chunk_size)
+        dec.expect('{')
+        while dec.peek() != '}':
+            key = dec.value()
+            dec.expect(':')
+            if key == 'collection':
+                dec.expect('[')
+                while dec.peek() != ']':
+                    yield dec.value()
+                    if dec.peek() == ',':
+                        dec.expect(',')
+                dec.expect(']')
+            else:
+                dec.value()
+            if dec.peek() == ',':
+                dec.expect(',')
+        dec.expect('}')
+
+
+class Metafile(object):
+    """TEMCA metafile, parsed at most once on first access and shared by
+    all the stages that need it.
+
+    The metafile is a json list of 3 blocks:
+    [{'metadata': {...}}, {'data': [...]}, {'sharedTransform': {...}}]
+    where the last one is optional and each tile in 'data' may hold
+    'matcher' blocks of template matches to its neighbors.
+
+    Parameters
+    ----------
+    path : str
+        path to the metafile
+    skip_matchers : bool
+        parse the metafile incrementally and drop the (large) matcher
+        blocks from the tiles. Use :func:`iter_tiles` to read them.
+    """
+
+    def __init__(self, path, skip_matchers=False):
+        self.path = path
+        self.skip_matchers = skip_matchers
+        self._json = None
+
+    def _parse_without_matchers(self):
+        blocks = [{'metadata': None}, {'data': []}]
+        for key, value in iter_metafile_items(self.path):
+            if key == 'metadata':
+                blocks[0][key] = value
+            elif key == 'data':
+                value.pop('matcher', None)
+                blocks[1][key].append(value)
+            else:
+                blocks.append({key: value})
+        return blocks
+
+    @property
+    def json(self):
+        """the full parsed metafile"""
+        if self._json is None:
+            if self.skip_matchers:
+                self._json = self._parse_without_matchers()
+            else:
+                self._json = jsongz.load(self.path)
+        return self._json
+
+    @property
+    def metadata(self):
+        """acquisition metadata dict"""
+        return self.json[0]['metadata']
+
+    @property
+    def data(self):
+        """list of per-tile dicts"""
+        return self.json[1]['data']
+
+    @property
+    def matchers(self):
+        """list of per-tile lists of matcher blocks.
+        Empty when skip_matchers is set."""
+        return [tile.get('matcher', []) for tile in self.data]
+
+    @property
+    def shared_transform(self):
+        """json dict of the shared (lens correction) transform"""
+        return self.json[2]['sharedTransform']
+
+
+def as_metafile(metafile):
+    """get a Metafile from either a path or an existing Metafile
+
+    Parameters
+    ----------
+    metafile : str or Metafile
+        path to a metafile, or already constructed object
+
+    Returns
+    -------
+    metafile : Metafile
+        metafile object. If passed in, the same object.
+    """
+    if isinstance(metafile, Metafile):
+        return metafile
+    return Metafile(metafile)
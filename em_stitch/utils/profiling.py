@@ -0,0 +1,159 @@
+"""opt-in profiling of em_stitch modules.
+
+Set the environment variable EM_STITCH_PROFILE to profile the run()
+of every em_stitch ArgSchemaParser module decorated with
+:func:`profiled`:
+
+    EM_STITCH_PROFILE=cprofile
+        deterministic profile with :mod:`cProfile`, written as a
+        <output_json>.prof file, see :mod:`pstats` or snakeviz.
+    EM_STITCH_PROFILE=sample
+        statistical profile of the cpu time, sampled every
+        EM_STITCH_PROFILE_INTERVAL seconds (default 0.005), written as
+        collapsed stacks to <output_json>.collapsed for flamegraph.pl
+        or speedscope. Only in the main thread of Unix processes,
+        otherwise cProfile is used.
+
+The profile is written next to the module's output_json, without its
+.json extension, or to its output_dir (or the working directory) if
+it has no output_json. When a profiled module runs another, the outer
+profile covers both. With EM_STITCH_PROFILE unset, run() is called
+directly.
+"""
+import collections
+import cProfile
+import datetime
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+profile_env = 'EM_STITCH_PROFILE'
+interval_env = 'EM_STITCH_PROFILE_INTERVAL'
+default_interval = 0.005
+
+# set while a profile is being recorded in this process
+_active = []
+
+
+def _reset_after_fork():
+    # a forked pool worker inherits the profiler of its parent, but
+    # should profile its own modules
+    if _active:
+        del _active[:]
+        sys.setprofile(None)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class StackSampler(object):
+    """samples the main thread's stack on SIGPROF
+
+    Parameters
+    ----------
+    interval : float
+        cpu seconds between samples
+    """
+    def __init__(self, interval=default_interval):
+        self.interval = interval
+        self.counts = collections.Counter()
+
+    @staticmethod
+    def available():
+        return (
+            hasattr(signal, 'setitimer') and
+            threading.current_thread() is threading.main_thread())
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._handler)
+
+    def dump(self, path):
+        """write collapsed stacks, one '<stack> <count>' per line"""
+        with open(path, 'w') as f:
+            for stack, n in self.counts.most_common():
+                f.write('%s %d\n' % (stack, n))
+
+
+def profile_path(module, ext):
+    """where to write the profile of an ArgSchemaParser module"""
+    output_json = module.args.get('output_json')
+    if output_json:
+        base = output_json
+        for e in ['.gz', '.json']:
+            if base.endswith(e):
+                base = base[:-len(e)]
+    else:
+        base = os.path.join(
+            module.args.get('output_dir') or os.getcwd(),
+            '%s_%s' % (
+                module.__class__.__name__,
+                datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")))
+    return base + ext
+
+
+def profiled(run):
+    """decorator for the run() method of an ArgSchemaParser module,
+    profiling it when EM_STITCH_PROFILE is set"""
+    @functools.wraps(run)
+    def wrapper(self, *args, **kwargs):
+        mode = os.environ.get(profile_env)
+        if (not mode) or _active:
+            return run(self, *args, **kwargs)
+
+        mode = mode.lower()
+        if mode not in ['cprofile', 'sample']:
+            logger.warning(
+                "unknown %s=%s, using cprofile" % (profile_env, mode))
+            mode = 'cprofile'
+        if (mode == 'sample') and not StackSampler.available():
+            logger.warning("cannot sample here, using cprofile")
+            mode = 'cprofile'
+
+        if mode == 'sample':
+            profiler = StackSampler(
+                float(os.environ.get(interval_env, default_interval)))
+            start, stop, dump = profiler.start, profiler.stop, profiler.dump
+            ext = '.collapsed'
+        else:
+            profiler = cProfile.Profile()
+            start, stop, dump = (
+                profiler.enable, profiler.disable, profiler.dump_stats)
+            ext = '.prof'
+
+        _active.append(self)
+        start()
+        try:
+            return run(self, *args, **kwargs)
+        finally:
+            stop()
+            _active.pop()
+            path = profile_path(self, ext)
+            try:
+                dump(path)
+                logger.info("wrote profile of %s to %s" % (
+                    self.__class__.__name__, path))
+            except OSError as e:
+                logger.warning("could not write profile %s: %s" % (
+                    path, e))
+    return wrapper
@@ -0,0 +1,108 @@
+import numpy as np
+
+
+class RasterGrid(object):
+    """2D index of tiles by raster position (col, row), for vectorized
+    lookup of tiles and their neighbors.
+
+    Parameters
+    ----------
+    raster_pos : array-like
+        Nx2 integer (col, row) raster position of each tile
+
+    Attributes
+    ----------
+    index : numpy.ndarray
+        (ncols x nrows) array of tile indices, -1 where there is no tile
+    origin : numpy.ndarray
+        (col, row) of index[0, 0]
+    """
+
+    def __init__(self, raster_pos):
+        rp = np.asarray(raster_pos, dtype='int64').reshape(-1, 2)
+        self.origin = (rp.min(axis=0) if rp.size
+                       else np.zeros(2, dtype='int64'))
+        shape = ((rp - self.origin).max(axis=0) + 1 if rp.size
+                 else np.zeros(2, dtype='int64'))
+        self.index = np.full(shape, -1, dtype='int64')
+        self.index[rp[:, 0] - self.origin[0],
+                   rp[:, 1] - self.origin[1]] = np.arange(rp.shape[0])
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        """grid from metafile tile dicts
+
+        Parameters
+        ----------
+        tiles : list of dict
+            elements of the metafile 'data' block
+
+        Returns
+        -------
+        grid : RasterGrid
+            grid indexing into tiles
+        """
+        return cls([t['img_meta']['raster_pos'] for t in tiles])
+
+    @classmethod
+    def from_tilespecs(cls, tilespecs):
+        """grid from tilespecs with layout imageCol and imageRow
+
+        Parameters
+        ----------
+        tilespecs : list of renderapi.tilespec.TileSpec
+            tilespecs, for example from a montage resolved tiles file
+
+        Returns
+        -------
+        grid : RasterGrid
+            grid indexing into tilespecs
+        """
+        return cls([[t.layout.imageCol, t.layout.imageRow]
+                    for t in tilespecs])
+
+    def lookup(self, col, row):
+        """tile indices at raster positions
+
+        Parameters
+        ----------
+        col : int or numpy.ndarray
+            raster column(s)
+        row : int or numpy.ndarray
+            raster row(s), same shape as col
+
+        Returns
+        -------
+        ind : numpy.ndarray
+            tile indices, -1 where there is no tile or
+            the position is outside the grid
+        """
+        c = np.asarray(col, dtype='int64') - self.origin[0]
+        r = np.asarray(row, dtype='int64') - self.origin[1]
+        valid = ((c >= 0) & (c < self.index.shape[0]) &
+                 (r >= 0) & (r < self.index.shape[1]))
+        ind = np.full(c.shape, -1, dtype='int64')
+        ind[valid] = self.index[c[valid], r[valid]]
+        return ind
+
+    def neighbors(self, col, row, offset):
+        """tile indices of the neighbors at a fixed offset
+
+        Parameters
+        ----------
+        col : int or numpy.ndarray
+            raster column(s)
+        row : int or numpy.ndarray
+            raster row(s), same shape as col
+        offset : tuple of int or numpy.ndarray
+            (col, row) offset of the neighbor, for example (-1, 0) for left,
+            or 2xN offsets, one per col, row
+
+        Returns
+        -------
+        ind : numpy.ndarray
+            neighbor tile indices, -1 where there is no neighbor
+        """
+        return self.lookup(
+                np.asarray(col) + offset[0],
+                np.asarray(row) + offset[1])
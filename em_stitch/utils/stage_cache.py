@@ -0,0 +1,485 @@
+"""content addressed cache of pipeline stage results.
+
+A stage result is keyed by a hash of everything it depends on: the
+contents of its input files, its parameters, the keys of the stages
+it consumes and the em_stitch version. Rerunning a stage with the same
+inputs returns the prior result instead of recomputing it.
+
+Each entry is a directory under the cache directory holding a
+record.json with the json serializable part of the result, and
+copies of the files the stage wrote. When the cache grows beyond
+max_bytes the least recently used entries are removed.
+
+Independently of the cache, a StageManifest in a run's output
+directory records each completed stage with the paths and checksums
+of its files, so that an interrupted run can be resumed from the
+stage it did not complete. It is only written by runs with resume or
+a cache, so set resume from the first run of a directory that may
+need resuming.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from . import jsongz
+from .transform_sidecar import file_checksum
+
+logger = logging.getLogger(__name__)
+
+default_max_bytes = 2**32
+
+record_name = 'record.json'
+
+manifest_name = 'stage_manifest.json'
+
+
+@functools.lru_cache(maxsize=None)
+def em_stitch_version():
+    """installed em_stitch version, or 'unknown'"""
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return 'unknown'
+    try:
+        return version('em_stitch')
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+@functools.lru_cache(maxsize=256)
+def _file_hash(path, size, mtime_ns):
+    return file_checksum(path)
+
+
+def file_hash(path):
+    """sha256 of a file's contents, rehashed only when it changes
+
+    Parameters
+    ----------
+    path : str or None
+        path to file
+
+    Returns
+    -------
+    h : str or None
+        hex digest, or None if path is None
+    """
+    if path is None:
+        return None
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return _file_hash(path, st.st_size, st.st_mtime_ns)
+
+
+def _json_default(obj):
+    # numpy scalars and arrays in stage results
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError(
+        "Object of type %s is not JSON serializable" %
+        obj.__class__.__name__)
+
+
+def stage_key(stage, **inputs):
+    """hash of a stage's inputs
+
+    Parameters
+    ----------
+    stage : str
+        stage name
+    **inputs
+        json serializable parameters, file hashes and keys of
+        upstream stages
+
+    Returns
+    -------
+    key : str
+        '<stage>_<hash>'
+    """
+    h = hashlib.sha256(json.dumps(
+        {'stage': stage,
+         'em_stitch': em_stitch_version(),
+         'inputs': inputs},
+        sort_keys=True, default=str).encode('utf-8'))
+    return '%s_%s' % (stage, h.hexdigest()[:32])
+
+
+def key_stage(key):
+    """stage name of a key from :func:`stage_key`"""
+    return key.rsplit('_', 1)[0]
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(d, f))
+        for d, _, files in os.walk(path) for f in files)
+
+
+class StageCache(object):
+    """cache of stage results in a directory
+
+    Parameters
+    ----------
+    cache_dir : str
+        cache directory, created if needed
+    max_bytes : int
+        size above which least recently used entries are evicted.
+        None for no limit.
+    force : bool
+        ignore existing entries. Results are still stored, replacing
+        them.
+    """
+    def __init__(self, cache_dir, max_bytes=default_max_bytes, force=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.force = force
+        self.hits = []
+        self.misses = []
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, stage, **inputs):
+        """see :func:`stage_key`"""
+        return stage_key(stage, **inputs)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """look up a stage result
+
+        Parameters
+        ----------
+        key : str
+            from :meth:`key`
+
+        Returns
+        -------
+        record : dict or None
+            {'data': obj, 'files': {name: path in cache}}, or None if
+            there is no entry or force is set
+        """
+        path = os.path.join(self.entry_dir(key), record_name)
+        if self.force or not os.path.isfile(path):
+            self.misses.append(key)
+            return None
+        try:
+            record = jsongz.load(path)
+        except ValueError:
+            logger.warning("ignoring corrupt cache entry %s" % key)
+            self.misses.append(key)
+            return None
+        # mark as recently used
+        os.utime(path)
+        record['files'] = {
+            name: os.path.join(self.entry_dir(key), f)
+            for name, f in record['files'].items()}
+        self.hits.append(key)
+        logger.info("cache hit for %s" % key)
+        return record
+
+    def put(self, key, data=None, files=None):
+        """store a stage result
+
+        Parameters
+        ----------
+        key : str
+            from :meth:`key`
+        data : obj
+            json serializable result
+        files : dict
+            name: path of files written by the stage, copied into
+            the cache
+
+        Returns
+        -------
+        record : dict
+            as returned by :meth:`get`
+        """
+        files = {k: v for k, v in (files or {}).items() if v is not None}
+        # build the entry aside and rename it into place
+        tmp_dir = os.path.join(
+            self.cache_dir, '.%s.%s' % (key, uuid.uuid4().hex[:8]))
+        os.makedirs(tmp_dir)
+        basenames = {}
+        for name, path in files.items():
+            # under their own name, so they can be restored as they were
+            basenames[name] = os.path.join(name, os.path.basename(path))
+            os.makedirs(os.path.join(tmp_dir, name))
+            shutil.copyfile(path, os.path.join(tmp_dir, basenames[name]))
+        jsongz.dump(
+            {'key': key, 'data': data, 'files': basenames},
+            os.path.join(tmp_dir, record_name),
+            default=_json_default)
+        entry = self.entry_dir(key)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # another process stored the same result
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+        return {
+            'key': key,
+            'data': data,
+            'files': {
+                name: os.path.join(entry, f)
+                for name, f in basenames.items()}}
+
+    def evict(self):
+        """remove least recently used entries beyond max_bytes
+
+        Returns
+        -------
+        removed : list of str
+            keys of removed entries
+        """
+        if self.max_bytes is None:
+            return []
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            record = os.path.join(e.path, record_name)
+            # entries being written start with '.'
+            if (e.is_dir() and not e.name.startswith('.') and
+                    os.path.isfile(record)):
+                entries.append((
+                    os.path.getmtime(record), e.name, _dir_size(e.path)))
+        total = sum([e[2] for e in entries])
+        removed = []
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.entry_dir(name), ignore_errors=True)
+            total -= size
+            removed.append(name)
+            logger.info("evicted cache entry %s" % name)
+        return removed
+
+    @staticmethod
+    def restore(record, name, dest):
+        """copy a cached file to where the stage would have written it
+
+        Parameters
+        ----------
+        record : dict
+            from :meth:`get`
+        name : str
+            name the file was stored under
+        dest : str
+            destination path, or a directory to restore the file
+            into under its original name
+
+        Returns
+        -------
+        dest : str or None
+            destination path, or None if the record has no such file
+        """
+        if name not in record['files']:
+            return None
+        if os.path.isdir(dest):
+            dest = os.path.join(
+                dest, os.path.basename(record['files'][name]))
+        if os.path.abspath(record['files'][name]) != os.path.abspath(dest):
+            shutil.copyfile(record['files'][name], dest)
+        return dest
+
+
+class StageManifest(object):
+    """record of the completed stages of a run in its output directory
+
+    Parameters
+    ----------
+    output_dir : str
+        output directory of the run
+    """
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, manifest_name)
+        self.stages = {}
+        if os.path.isfile(self.path):
+            try:
+                self.stages = jsongz.load(self.path)['stages']
+            except (ValueError, KeyError):
+                logger.warning("ignoring corrupt manifest %s" % self.path)
+
+    def get(self, key):
+        """look up a completed stage
+
+        Parameters
+        ----------
+        key : str
+            from :func:`stage_key`
+
+        Returns
+        -------
+        record : dict or None
+            {'data': obj, 'files': {name: path}}, or None if the stage
+            was not completed with these inputs, or any of its files
+            is missing or changed
+        """
+        entry = self.stages.get(key_stage(key))
+        if (entry is None) or (entry['key'] != key):
+            return None
+        for name, f in entry['files'].items():
+            if ((not os.path.isfile(f['path'])) or
+                    (file_hash(f['path']) != f['sha256'])):
+                logger.info(
+                    "%s of stage %s changed, not resuming it" % (
+                        f['path'], key_stage(key)))
+                return None
+        return {
+            'key': key,
+            'data': entry['data'],
+            'files': {n: f['path'] for n, f in entry['files'].items()}}
+
+    def put(self, key, data=None, files=None):
+        """record a completed stage
+
+        Parameters
+        ----------
+        key : str
+            from :func:`stage_key`
+        data : obj
+            json serializable result
+        files : dict
+            name: path of files written by the stage
+        """
+        files = {k: v for k, v in (files or {}).items() if v is not None}
+        self.stages[key_stage(key)] = {
+            'key': key,
+            'completed': time.time(),
+            'data': data,
+            'files': {
+                name: {
+                    'path': os.path.abspath(path),
+                    'sha256': file_hash(path)}
+                for name, path in files.items()}}
+        jsongz.dump(
+            {'stages': self.stages}, self.path, atomic=True, indent=2,
+            default=_json_default)
+
+
+class Stages(object):
+    """prior results of a run's stages, from its manifest when resuming
+    and from a stage cache
+
+    Parameters
+    ----------
+    output_dir : str
+        output directory of the run
+    cache : StageCache
+        stage cache, or None
+    resume : bool
+        reuse stages completed by an earlier run in output_dir
+    write_manifest : bool
+        record the completed stages in output_dir. default is to do
+        so if resuming or caching
+    """
+    def __init__(self, output_dir, cache=None, resume=False,
+                 write_manifest=None):
+        self.output_dir = output_dir
+        self.cache = cache
+        self.resume = resume
+        if write_manifest is None:
+            write_manifest = resume or (cache is not None)
+        self.manifest = (
+            StageManifest(output_dir) if (resume or write_manifest)
+            else None)
+        self.write_manifest = write_manifest
+        self.reused = {}
+
+    @property
+    def recording(self):
+        """whether completed stages are recorded anywhere. If not,
+        stages need not write files only kept for reuse"""
+        return self.write_manifest or (self.cache is not None)
+
+    def key(self, stage, files=None, **inputs):
+        """key of a stage
+
+        Parameters
+        ----------
+        stage : str
+            stage name
+        files : dict
+            name: path of input files, hashed by their contents
+        **inputs
+            see :func:`stage_key`
+
+        Returns
+        -------
+        key : str
+            stage key
+        """
+        for name, path in (files or {}).items():
+            inputs[name] = file_hash(path)
+        return stage_key(stage, **inputs)
+
+    def get(self, key):
+        """prior result of a stage, with its files in output_dir
+
+        Returns
+        -------
+        record : dict or None
+            as returned by :meth:`StageCache.get`, with 'source' either
+            'manifest' or 'cache', or None if the stage needs to be run
+        """
+        if self.resume:
+            record = self.manifest.get(key)
+            if record is not None:
+                logger.info("resuming after stage %s" % key_stage(key))
+                self.reused[key_stage(key)] = record['source'] = 'manifest'
+                return record
+        if self.cache is not None:
+            record = self.cache.get(key)
+            if record is not None:
+                record['files'] = {
+                    name: self.cache.restore(record, name, self.output_dir)
+                    for name in record['files']}
+                # the restored files complete this stage of the run
+                if self.write_manifest:
+                    self.manifest.put(
+                        key, record['data'], record['files'])
+                self.reused[key_stage(key)] = record['source'] = 'cache'
+                return record
+        return None
+
+    def put(self, key, data=None, files=None):
+        """record a completed stage"""
+        if self.write_manifest:
+            self.manifest.put(key, data, files)
+        if self.cache is not None:
+            self.cache.put(key, data, files)
+
+
+def cache_from_args(args):
+    """StageCache for a module's cache_dir, cache_max_bytes and
+    force_recompute arguments, or None if cache_dir is not set"""
+    if not args.get('cache_dir'):
+        return None
+    return StageCache(
+        args['cache_dir'],
+        max_bytes=args.get('cache_max_bytes', default_max_bytes),
+        force=args.get('force_recompute', False))
+
+
+def stages_from_args(args, output_dir):
+    """Stages for a module's output directory and its cache_dir,
+    cache_max_bytes, force_recompute and resume arguments.
+    force_recompute also overrides resume, but the recomputed stages
+    are still recorded for later resumes."""
+    cache = cache_from_args(args)
+    return Stages(
+        output_dir,
+        cache=cache,
+        resume=(
+            args.get('resume', False) and
+            not args.get('force_recompute', False)),
+        write_manifest=(
+            args.get('resume', False) or (cache is not None)))
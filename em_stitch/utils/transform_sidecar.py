@@ -0,0 +1,157 @@
+"""binary .npz sidecars for lens correction transforms.
+
+The lens correction solver writes its ThinPlateSplineTransform into
+a resolved tiles json, where the control points and coefficients are
+base64 text. A sidecar holds the same arrays in an uncompressed .npz
+next to the json, so the transform can be rebuilt without parsing it.
+
+The json remains the source of truth. The sidecar records a checksum
+of the json file it was written for, and is ignored when that no
+longer matches.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import renderapi
+
+from . import jsongz
+
+logger = logging.getLogger(__name__)
+
+sidecar_ext = '.tps.npz'
+
+
+def sidecar_path(json_path):
+    """path of the sidecar for a .json or .json.gz file
+
+    Parameters
+    ----------
+    json_path : str
+        path to json file
+
+    Returns
+    -------
+    path : str
+        path with the json extension(s) replaced by sidecar_ext
+    """
+    base = json_path
+    for ext in ['.gz', '.json']:
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    return base + sidecar_ext
+
+
+def file_checksum(path, chunk_size=2**20):
+    """sha256 hex digest of a file's bytes"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_sidecar(tform, json_path, path=None):
+    """write a sidecar for a transform stored in json_path
+
+    Parameters
+    ----------
+    tform : renderapi.transform.ThinPlateSplineTransform
+        the transform, as written to json_path
+    json_path : str
+        json file holding tform, already written
+    path : str
+        destination. default is sidecar_path(json_path)
+
+    Returns
+    -------
+    path : str
+        path of the written sidecar
+    """
+    if path is None:
+        path = sidecar_path(json_path)
+    metadata = {
+        'className': tform.className,
+        'transformId': tform.transformId,
+        'labels': tform.labels,
+        'ndims': tform.ndims,
+        'nLm': tform.nLm,
+        'json_file': os.path.basename(json_path),
+        'json_sha256': file_checksum(json_path)}
+    arrays = {
+        'srcPts': tform.srcPts,
+        'dMtxDat': tform.dMtxDat}
+    if tform.aMtx is not None:
+        arrays['aMtx'] = tform.aMtx
+        arrays['bVec'] = tform.bVec
+    # write then rename so readers never see a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, metadata=np.array(json.dumps(metadata)), **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_sidecar(path, json_path=None):
+    """build a transform from a sidecar
+
+    Parameters
+    ----------
+    path : str
+        path to sidecar
+    json_path : str
+        if given, the json file the sidecar must have been written for
+
+    Returns
+    -------
+    tform : renderapi.transform.ThinPlateSplineTransform or None
+        the transform, or None if json_path is given and its checksum
+        does not match the one recorded in the sidecar
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        metadata = json.loads(str(npz['metadata']))
+        if json_path is not None:
+            if file_checksum(json_path) != metadata['json_sha256']:
+                logger.warning(
+                    "ignoring stale transform sidecar %s" % path)
+                return None
+        tform = renderapi.transform.ThinPlateSplineTransform(
+            transformId=metadata['transformId'],
+            labels=metadata['labels'])
+        tform.className = metadata['className']
+        tform.ndims = metadata['ndims']
+        tform.nLm = metadata['nLm']
+        tform.srcPts = npz['srcPts']
+        tform.dMtxDat = npz['dMtxDat']
+        tform.aMtx = npz['aMtx'] if 'aMtx' in npz else None
+        tform.bVec = npz['bVec'] if 'bVec' in npz else None
+    return tform
+
+
+def load_lens_transform(json_path):
+    """load a lens correction transform, from its sidecar if there is
+    a current one, otherwise from the json
+
+    Parameters
+    ----------
+    json_path : str
+        path to a ThinPlateSplineTransform json, or to a resolved
+        tiles json where it is the first shared transform
+
+    Returns
+    -------
+    tform : renderapi.transform.ThinPlateSplineTransform
+        the transform
+    """
+    path = sidecar_path(json_path)
+    if os.path.isfile(path):
+        tform = read_sidecar(path, json_path=json_path)
+        if tform is not None:
+            return tform
+
+    j = jsongz.load(json_path)
+    if 'transformIdToSpecMap' in j:
+        return renderapi.resolvedtiles.ResolvedTiles(json=j).transforms[0]
+    return renderapi.transform.ThinPlateSplineTransform(json=j)
@@ -1,10 +1,9 @@
-import json
-
-import cv2
 import numpy as np
 
 import renderapi
 
+from .metafile import as_metafile
+
 
 def get_z_from_metafile(metafile):
     offsets = [
@@ -43,15 +42,14 @@ def get_z_from_metafile(metafile):
 
     loads = np.array([i['load'] for i in offsets])
 
-    with open(metafile, 'r') as f:
-        j = json.load(f)
+    metadata = as_metafile(metafile).metadata
     try:
-        tape = int(j[0]['metadata']['media_id'])
+        tape = int(metadata['media_id'])
         offset = offsets[
                 np.argwhere(loads == 'Tape%d' % tape).flatten()[0]]['offset']
     except (ValueError, IndexError):
         offset = 0
-    grid = int(j[0]['metadata']['grid'])
+    grid = int(metadata['grid'])
     return offset + grid
 
 
@@ -88,6 +86,17 @@ def correction_grid(transform, npts=20):
     return src, transform.tform(src)
 
 
+def reset_cv2_rng():
+    """reset the process wide OpenCV random number generator, drawn
+    from by cv2.kmeans in pointmatch_filter, to its initial state.
+    Filtering then gives the same result as in a fresh process, whatever
+    ran earlier in this one.
+    """
+    import cv2
+    # a seed of 0 selects the default initial state
+    cv2.setRNGSeed(0)
+
+
 def pointmatch_filter(
         match, n_clusters=None, ransacReprojThreshold=10,
         n_cluster_pts=15, n_min_ignore=3, model='Affine'):
@@ -122,6 +131,8 @@ def pointmatch_filter(
         labels from kmeans clustering
     """
 
+    import cv2
+
     p = np.array(match['matches']['p']).transpose().astype('float32')
     q = np.array(match['matches']['q']).transpose().astype('float32')
 
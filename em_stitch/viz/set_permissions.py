@@ -7,6 +7,7 @@ import sys
 from argschema import ArgSchemaParser
 
 from .schemas import SetPermissionsSchema
+from ..utils.profiling import profiled
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +55,7 @@ def set_files(mydir, exts, setting):
 class SetPermissions(ArgSchemaParser):
     default_schema = SetPermissionsSchema
 
+    @profiled
     def run(self):
         logger.setLevel(self.args['log_level'])
 
@@ -7,6 +7,7 @@ from em_stitch.viz.schemas import SetUpdateUploadSchema
 from em_stitch.viz.set_permissions import SetPermissions
 from em_stitch.viz.update_urls import UpdateUrls
 from em_stitch.viz.upload_to_render import UploadToRender
+from em_stitch.utils.profiling import profiled
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +63,7 @@ def upload_args(args):
 class SetUpdateUpload(ArgSchemaParser):
     default_schema = SetUpdateUploadSchema
 
+    @profiled
     def run(self):
         logger.setLevel(self.args['log_level'])
 
@@ -6,10 +6,11 @@ import shutil
 from six.moves import urllib
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
 import renderapi
 
 from .schemas import UpdateUrlSchema
+from ..utils import jsongz
+from ..utils.profiling import profiled
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +45,7 @@ def backup(f):
 class UpdateUrls(ArgSchemaParser):
     default_schema = UpdateUrlSchema
 
+    @profiled
     def run(self):
         logger.setLevel(self.args['log_level'])
 
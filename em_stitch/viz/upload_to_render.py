@@ -2,10 +2,11 @@ import logging
 import os
 
 from argschema import ArgSchemaParser
-from bigfeta import jsongz
 import renderapi
 
 from .schemas import UploadToRenderSchema
+from ..utils import jsongz
+from ..utils.profiling import profiled
 
 logger = logging.getLogger(__name__)
 
@@ -83,6 +84,7 @@ def upload_collection_file(render_params, collection, collection_file):
 class UploadToRender(ArgSchemaParser):
     default_schema = UploadToRenderSchema
 
+    @profiled
     def run(self):
         logger.setLevel(self.args['log_level'])
 
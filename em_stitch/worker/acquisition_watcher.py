@@ -0,0 +1,362 @@
+"""watch an acquisition directory and queue montage and lens correction
+jobs for a JobWorker as soon as each section is complete.
+
+A section is a directory holding one _metadata*.json. It becomes a
+lens correction job if it also holds a _template_matches* file, and
+a montage job otherwise. A section is queued once its acquisition
+files have been unchanged for settle_time seconds and all are
+complete json. A section without template matches is only queued as a montage
+once it has been unchanged for montage_settle_time, as the template
+matches of a lens correction section may be written after its
+metafile. Job names are derived from the section path and its files, so
+a section is queued only once, also across restarts of the watcher.
+Each job file carries the cost estimate of the job unless
+estimate_cost is off.
+
+On Linux the directories are watched with inotify. Elsewhere, or if
+inotify is not available, they are rescanned every poll_interval.
+"""
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import hashlib
+import logging
+import os
+import select
+import struct
+import sys
+import time
+import zlib
+
+from argschema import ArgSchemaParser
+
+from em_stitch.worker.cost_estimate import estimate_job_cost
+from em_stitch.worker.job_worker import (
+    count_queued, job_exists, submit_job)
+from em_stitch.worker.schemas import AcquisitionWatcherSchema
+
+logger = logging.getLogger(__name__)
+
+example = {
+        "watch_dir": "/data/em-131fs3/lctest",
+        "spool_dir": "/data/em-131fs3/spool",
+        "settle_time": 10.0,
+        "montage_args": {
+            "solver_templates": ["affine_template.json"]},
+        "log_level": "INFO"
+        }
+
+metafile_pattern = '_metadata*.json'
+lens_matches_pattern = '_template_matches*'
+montage_pattern = '_montage*'
+
+# from sys/inotify.h
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_event = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """minimal inotify interface through ctypes
+
+    Raises
+    ------
+    OSError
+        if inotify is not available
+    """
+    mask = _IN_CREATE | _IN_CLOSE_WRITE | _IN_MOVED_TO
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.paths = {}
+        self.wds = {}
+
+    def add_watch(self, path):
+        if path in self.wds:
+            return
+        wd = self._inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.paths[wd] = path
+        self.wds[path] = wd
+
+    def read(self, timeout):
+        """wait up to timeout seconds for events
+
+        Returns
+        -------
+        events : list of tuple
+            (directory, name, is_dir) for each event. An overflowed
+            event queue is reported as (None, None, False).
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 2**16)
+        except BlockingIOError:
+            return []
+        events = []
+        i = 0
+        while i < len(data):
+            wd, mask, _, n = _event.unpack_from(data, i)
+            name = os.fsdecode(
+                data[i + _event.size:i + _event.size + n].rstrip(b'\0'))
+            i += _event.size + n
+            if mask & _IN_Q_OVERFLOW:
+                events.append((None, None, False))
+            elif mask & _IN_IGNORED:
+                self.wds.pop(self.paths.pop(wd, None), None)
+            elif wd in self.paths:
+                events.append((self.paths[wd], name, bool(mask & _IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def section_files(data_dir):
+    """acquisition files of a section"""
+    files = []
+    for pattern in [metafile_pattern, lens_matches_pattern, montage_pattern]:
+        files += glob.glob(os.path.join(data_dir, pattern))
+    return sorted(files)
+
+
+def files_signature(files):
+    """(name, size, mtime) of each file, changes when any file does"""
+    sig = []
+    for f in files:
+        try:
+            st = os.stat(f)
+        except FileNotFoundError:
+            continue
+        sig.append((os.path.basename(f), st.st_size, st.st_mtime_ns))
+    return tuple(sig)
+
+
+def is_complete(path, tail_size=64):
+    """cheap check that an acquisition file is completely written:
+    a json file ends with its closing bracket, a gzip file with the
+    end of its deflate stream. Nothing is parsed."""
+    if path.endswith('.gz'):
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    # the output is thrown away, 64 kB at a time
+                    d.decompress(chunk, 2**16)
+                    while d.unconsumed_tail:
+                        d.decompress(d.unconsumed_tail, 2**16)
+        except (OSError, zlib.error):
+            return False
+        return d.eof
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(tail_size).lstrip()
+            f.seek(max(0, os.fstat(f.fileno()).st_size - tail_size))
+            tail = f.read().rstrip()
+    except OSError:
+        return False
+    return (head[:1], tail[-1:]) in [(b'[', b']'), (b'{', b'}')]
+
+
+def check_section(data_dir):
+    """check whether a section directory is complete
+
+    Parameters
+    ----------
+    data_dir : str
+        section directory
+
+    Returns
+    -------
+    kind : str or None
+        'lens_correction' or 'montage', or None if the section is not
+        (yet) complete
+    files : list of str
+        acquisition files of the section
+    """
+    files = section_files(data_dir)
+    metafiles = glob.glob(os.path.join(data_dir, metafile_pattern))
+    matches = glob.glob(os.path.join(data_dir, lens_matches_pattern))
+    if (len(metafiles) != 1) or (len(matches) > 1):
+        return None, files
+    for f in files:
+        if ('.json' in os.path.basename(f)) and not is_complete(f):
+            # still being written
+            return None, files
+    return ('lens_correction' if matches else 'montage'), files
+
+
+def job_name(kind, data_dir, files):
+    """job name unique to a section and the state of its files"""
+    h = hashlib.sha1(repr((
+        os.path.abspath(data_dir),
+        files_signature(files))).encode('utf-8'))
+    return '%s_%s_%s' % (
+        kind, os.path.basename(os.path.normpath(data_dir)),
+        h.hexdigest()[:12])
+
+
+class AcquisitionWatcher(ArgSchemaParser):
+    default_schema = AcquisitionWatcherSchema
+
+    def __init__(self, *args, **kwargs):
+        super(AcquisitionWatcher, self).__init__(*args, **kwargs)
+        # section directory: time of its last change
+        self.changed = {}
+        self.signatures = {}
+        self.submitted = []
+
+    def _depth(self, path):
+        rel = os.path.relpath(path, self.args['watch_dir'])
+        return 0 if rel == os.curdir else rel.count(os.sep) + 1
+
+    def scan(self, inotify=None, top=None):
+        """walk the watched tree, watching new directories and marking
+        those whose acquisition files changed"""
+        now = time.time()
+        for d, subdirs, _ in os.walk(top or self.args['watch_dir']):
+            if self._depth(d) >= self.args['max_depth']:
+                subdirs[:] = []
+            if inotify is not None:
+                try:
+                    inotify.add_watch(d)
+                except OSError as e:
+                    logger.warning("could not watch %s: %s" % (d, e))
+            sig = files_signature(section_files(d))
+            if sig and (sig != self.signatures.get(d)):
+                self.signatures[d] = sig
+                self.changed[d] = now
+
+    def handle_events(self, events, inotify):
+        now = time.time()
+        patterns = [metafile_pattern, lens_matches_pattern, montage_pattern]
+        for d, name, is_dir in events:
+            if d is None:
+                logger.warning("inotify queue overflowed, rescanning")
+                self.scan(inotify)
+            elif is_dir:
+                path = os.path.join(d, name)
+                if self._depth(path) <= self.args['max_depth']:
+                    self.scan(inotify, top=path)
+            elif any(fnmatch.fnmatch(name, p) for p in patterns):
+                self.changed[d] = now
+
+    def section_args(self, kind, data_dir):
+        args = dict(
+            self.args['lens_args'] if kind == 'lens_correction'
+            else self.args['montage_args'])
+        args['data_dir'] = data_dir
+        return args
+
+    def estimate(self, kind, args):
+        """cost estimate of a job, None if disabled or if it cannot be
+        estimated"""
+        if not self.args['estimate_cost']:
+            return None
+        try:
+            return estimate_job_cost(
+                kind, args, calibration_file=self.args['calibration_file'])
+        except Exception as e:
+            logger.warning("could not estimate the cost of %s: %s" % (
+                args['data_dir'], e))
+            return None
+
+    def queue_settled(self):
+        """queue jobs for sections that have settled and are complete
+
+        Returns
+        -------
+        n : int
+            number of jobs queued
+        """
+        now = time.time()
+        n = 0
+        for d, t in sorted(self.changed.items(), key=lambda x: x[1]):
+            if (now - t) < self.args['settle_time']:
+                continue
+            kind, files = check_section(d)
+            if (kind == 'montage') and (
+                    (now - t) < self.args['montage_settle_time']):
+                # template matches may still come
+                continue
+            if (
+                    (kind is None) or
+                    (kind == 'montage' and not self.args['submit_montage']) or
+                    (kind == 'lens_correction' and
+                     not self.args['submit_lens'])):
+                # incomplete ones come back when their files change
+                self.changed.pop(d)
+                continue
+            name = job_name(kind, d, files)
+            if job_exists(self.args['spool_dir'], name):
+                self.changed.pop(d)
+                continue
+            if ((self.args['max_queued'] is not None) and
+                    (count_queued(self.args['spool_dir']) >=
+                     self.args['max_queued'])):
+                logger.debug("spool is full, holding back %s" % d)
+                break
+            args = self.section_args(kind, d)
+            submit_job(
+                self.args['spool_dir'], kind, args, name=name,
+                estimate=self.estimate(kind, args))
+            self.changed.pop(d)
+            self.submitted.append({
+                'job': name,
+                'module': kind,
+                'data_dir': d,
+                'latency': now - t})
+            logger.info("queued %s for %s" % (name, d))
+            n += 1
+        return n
+
+    def run(self):
+        logger.setLevel(self.args['log_level'])
+        inotify = None
+        if self.args['use_inotify']:
+            try:
+                inotify = Inotify()
+            except OSError as e:
+                logger.warning("inotify not available, polling: %s" % e)
+
+        try:
+            self.scan(inotify)
+            while True:
+                self.queue_settled()
+                if self.args['exit_when_idle'] and not self.changed:
+                    break
+                if inotify is None:
+                    time.sleep(self.args['poll_interval'])
+                    self.scan()
+                else:
+                    self.handle_events(
+                        inotify.read(self.args['poll_interval']), inotify)
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+        if 'output_json' in self.args:
+            self.output({
+                'n_submitted': len(self.submitted),
+                'jobs': self.submitted}, indent=2)
+
+
+if __name__ == "__main__":
+    watcher = AcquisitionWatcher(input_data=example)
+    watcher.run()
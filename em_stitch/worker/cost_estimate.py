@@ -0,0 +1,355 @@
+"""pre-flight estimate of the resources a lens correction or montage job
+will use, so that batch schedulers can pack jobs before running them.
+
+    python -m em_stitch.worker.cost_estimate \\
+        --data_dir /data/em-131fs3/lctest/T4_6/001738/0 --nvertex 1000
+
+Only counts are read from the section: the tiles of the metafile and
+the point pairs of the template matches (lens correction) or of the
+metafile's matcher blocks (montage). For lens correction the size of
+the matrix A of mesh_and_solve_transform.create_A follows exactly
+from the counts and nvertex. The nonzeros of K = A^T W A + reg and of
+its LU factors, the wall time and the peak resident memory are
+predicted from a calibration table, written by
+benchmarks/bench_calibrate.py from solves of synthetic sections of
+several sizes on the machine the jobs run on. The default table
+ships with em_stitch, record a new one for other hardware.
+
+Counts are taken before any filtering, so the estimates are upper
+bounds of the sizes, and describe one solve per template for montages
+run without cascade or n_parallel_solves.
+"""
+import functools
+import glob
+import os
+
+import numpy as np
+from scipy.optimize import nnls
+
+from argschema import ArgSchemaParser
+
+from em_stitch.utils import jsongz
+from em_stitch.utils.metafile import Metafile, iter_collection, iter_tiles
+from em_stitch.worker.schemas import CostEstimateSchema, default_n_templates
+
+example = {
+        "data_dir": "/data/em-131fs3/lctest/T4_6/001738/0",
+        "nvertex": 1000,
+        "log_level": "INFO"
+        }
+
+default_calibration = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'cost_calibration.json')
+calibration_version = 1
+
+metafile_pattern = '_metadata*.json'
+lens_matches_pattern = '_template_matches*'
+
+# bytes of each nonzero of a sparse factor, float64 value and int32 index
+factor_bytes_per_nonzero = 12
+
+# by job module, (target, model, features) in the order they are
+# predicted. 'power' fits log(target) linearly in the log features,
+# 'linear' fits target as a nonnegative combination of 1 and the
+# features, minimizing relative errors. Features are counts or
+# targets predicted before.
+cost_models = {
+    'lens_correction': [
+        ('nnz_K', 'power', ['nvertex', 'n_point_pairs']),
+        ('nnz_factor', 'power', ['nvertex', 'n_point_pairs']),
+        ('wall_time', 'linear', ['n_point_pairs', 'nnz_factor']),
+        ('peak_memory_mb', 'linear', ['n_point_pairs', 'nnz_factor'])],
+    'montage': [
+        ('wall_time', 'linear', ['n_tiles', 'n_point_pair_solves']),
+        ('peak_memory_mb', 'linear', ['n_tiles', 'n_point_pair_solves'])]}
+
+
+class CostEstimateException(Exception):
+    pass
+
+
+def _one_file(data_dir, pattern):
+    files = glob.glob(os.path.join(data_dir, pattern))
+    if len(files) != 1:
+        raise CostEstimateException(
+            "expected one %s in %s, found %d" % (
+                pattern, data_dir, len(files)))
+    return files[0]
+
+
+def lens_counts(data_dir):
+    """counts of a lens correction section, the template matches
+    streamed one tile pair at a time
+
+    Parameters
+    ----------
+    data_dir : str
+        directory with one _metadata*.json and one _template_matches*
+
+    Returns
+    -------
+    counts : dict
+        'n_tiles', 'n_matches' (tile pairs) and 'n_point_pairs'
+    """
+    metafile = Metafile(
+        _one_file(data_dir, metafile_pattern), skip_matchers=True)
+    counts = {
+        'n_tiles': len(metafile.data), 'n_matches': 0, 'n_point_pairs': 0}
+    for match in iter_collection(
+            _one_file(data_dir, lens_matches_pattern)):
+        counts['n_matches'] += 1
+        counts['n_point_pairs'] += len(match['matches']['p'][0])
+    return counts
+
+
+def montage_counts(metafile):
+    """counts of a montage section, streamed from its metafile
+
+    Parameters
+    ----------
+    metafile : str
+        path of the _metadata*.json
+
+    Returns
+    -------
+    counts : dict
+        'n_tiles', 'n_matches' (matcher blocks with point pairs) and
+        'n_point_pairs'
+    """
+    counts = {'n_tiles': 0, 'n_matches': 0, 'n_point_pairs': 0}
+    for tile in iter_tiles(metafile, matchers_as_arrays=False):
+        counts['n_tiles'] += 1
+        for matcher in tile.get('matcher', []):
+            n = len(matcher.get('pX', []))
+            if (matcher['match_quality'] != -1) and (n > 0):
+                counts['n_matches'] += 1
+                counts['n_point_pairs'] += n
+    return counts
+
+
+def lens_matrix_size(n_tiles, n_point_pairs, nvertex):
+    """size of A as built by mesh_and_solve_transform.create_A: one row
+    per point pair, a translation column per tile and a column per mesh
+    vertex, and 2 tile and 6 barycentric nonzeros per row
+
+    Returns
+    -------
+    size : dict
+        'n_rows', 'n_cols' and 'nnz_A'
+    """
+    return {
+        'n_rows': int(n_point_pairs),
+        'n_cols': int(n_tiles + nvertex),
+        'nnz_A': int(8 * n_point_pairs)}
+
+
+def _design(records, model, features):
+    X = np.array(
+        [[r[f] for f in features] for r in records], dtype='float64')
+    if model == 'power':
+        X = np.log(X)
+    return np.hstack((np.ones((X.shape[0], 1)), X))
+
+
+def fit_model(records, target, model, features):
+    """fit one cost model to calibration records
+
+    Returns
+    -------
+    coefficients : numpy.ndarray
+        intercept and one coefficient per feature
+    """
+    y = np.array([r[target] for r in records], dtype='float64')
+    X = _design(records, model, features)
+    if model == 'power':
+        return np.linalg.lstsq(X, np.log(y), rcond=None)[0]
+    return nnls(X / y[:, np.newaxis], np.ones(y.size))[0]
+
+
+class CostModel(object):
+    """the cost models of one job module, fitted to calibration records
+
+    Parameters
+    ----------
+    records : list of dict
+        counts and measured targets of calibration runs
+    models : list of tuple
+        (target, model, features), see :data:`cost_models`
+    """
+    def __init__(self, records, models):
+        if len(records) < 3:
+            raise CostEstimateException(
+                "need at least 3 calibration records, got %d" % (
+                    len(records)))
+        self.models = models
+        self.coefficients = {
+            target: fit_model(records, target, model, features)
+            for target, model, features in models}
+
+    def predict(self, counts):
+        """predicted targets of a job with these counts"""
+        values = dict(counts)
+        for target, model, features in self.models:
+            c = self.coefficients[target]
+            x = np.array([values[f] for f in features], dtype='float64')
+            if model == 'power':
+                values[target] = float(np.exp(c[0] + c[1:].dot(np.log(x))))
+            else:
+                values[target] = float(c[0] + c[1:].dot(x))
+        return {target: values[target] for target, _, _ in self.models}
+
+
+@functools.lru_cache(maxsize=8)
+def load_calibration(path=None):
+    """cost models of each job module from a calibration table
+
+    Parameters
+    ----------
+    path : str
+        calibration json written by benchmarks/bench_calibrate.py,
+        the one shipped with em_stitch if None
+
+    Returns
+    -------
+    models : dict
+        CostModel by job module
+    """
+    path = path or default_calibration
+    table = jsongz.load(path)
+    if table.get('version') != calibration_version:
+        raise CostEstimateException(
+            "%s has version %s, expected %d" % (
+                path, table.get('version'), calibration_version))
+    return {
+        module: CostModel(table[module], models)
+        for module, models in cost_models.items()}
+
+
+def estimate_lens_cost(data_dir, nvertex=1000, calibration_file=None):
+    """resources of a LensCorrectionSolver job
+
+    Parameters
+    ----------
+    data_dir : str
+        section directory
+    nvertex : int
+        maximum number of mesh vertices of the solve
+    calibration_file : str
+        see :func:`load_calibration`
+
+    Returns
+    -------
+    estimate : dict
+        'module', 'counts', 'matrix' (the exact 'n_rows', 'n_cols' and
+        'nnz_A' and the predicted 'nnz_K' and 'nnz_factor'),
+        'factor_memory_mb', 'wall_time' [s] and 'peak_memory_mb'
+    """
+    counts = lens_counts(data_dir)
+    counts['nvertex'] = int(nvertex)
+    predicted = load_calibration(calibration_file)[
+        'lens_correction'].predict(counts)
+    matrix = lens_matrix_size(
+        counts['n_tiles'], counts['n_point_pairs'], nvertex)
+    matrix['nnz_K'] = int(predicted['nnz_K'])
+    matrix['nnz_factor'] = int(predicted['nnz_factor'])
+    return {
+        'module': 'lens_correction',
+        'counts': counts,
+        'matrix': matrix,
+        'factor_memory_mb': (
+            matrix['nnz_factor'] * factor_bytes_per_nonzero / 2.0**20),
+        'wall_time': predicted['wall_time'],
+        'peak_memory_mb': predicted['peak_memory_mb']}
+
+
+def estimate_montage_cost(metafile, n_templates=default_n_templates,
+                          calibration_file=None):
+    """resources of a MontageSolver job
+
+    Parameters
+    ----------
+    metafile : str
+        path of the section's _metadata*.json
+    n_templates : int
+        number of solver templates
+    calibration_file : str
+        see :func:`load_calibration`
+
+    Returns
+    -------
+    estimate : dict
+        'module', 'counts', 'wall_time' [s] and 'peak_memory_mb'
+    """
+    counts = montage_counts(metafile)
+    counts['n_templates'] = int(n_templates)
+    counts['n_point_pair_solves'] = counts['n_point_pairs'] * n_templates
+    predicted = load_calibration(calibration_file)[
+        'montage'].predict(counts)
+    return {
+        'module': 'montage',
+        'counts': counts,
+        'wall_time': predicted['wall_time'],
+        'peak_memory_mb': predicted['peak_memory_mb']}
+
+
+def estimate_job_cost(module, args, calibration_file=None):
+    """estimate of a job as submitted to a JobWorker
+
+    Parameters
+    ----------
+    module : str
+        job module, see em_stitch.worker.job_worker.job_modules
+    args : dict
+        input_data of the job
+
+    Returns
+    -------
+    estimate : dict or None
+        see :func:`estimate_lens_cost` and :func:`estimate_montage_cost`,
+        None for modules that are not estimated
+    """
+    if module == 'lens_correction':
+        return estimate_lens_cost(
+            args['data_dir'], nvertex=args.get('nvertex', 1000),
+            calibration_file=calibration_file)
+    if module == 'montage':
+        metafile = args.get('metafile') or _one_file(
+            args['data_dir'], metafile_pattern)
+        return estimate_montage_cost(
+            metafile,
+            n_templates=(
+                len(args.get('solver_templates', [])) or
+                default_n_templates),
+            calibration_file=calibration_file)
+    return None
+
+
+class EstimateCost(ArgSchemaParser):
+    default_schema = CostEstimateSchema
+
+    def run(self):
+        module = self.args['module']
+        if module is None:
+            module = 'lens_correction' if glob.glob(os.path.join(
+                self.args['data_dir'], lens_matches_pattern)) else 'montage'
+        if module == 'lens_correction':
+            self.estimate = estimate_lens_cost(
+                self.args['data_dir'], nvertex=self.args['nvertex'],
+                calibration_file=self.args['calibration_file'])
+        else:
+            self.estimate = estimate_montage_cost(
+                _one_file(self.args['data_dir'], metafile_pattern),
+                n_templates=self.args['n_templates'],
+                calibration_file=self.args['calibration_file'])
+        self.logger.info(
+            "%s: %0.1f s, %0.0f MB" % (
+                self.args['data_dir'], self.estimate['wall_time'],
+                self.estimate['peak_memory_mb']))
+
+        if 'output_json' in self.args:
+            self.output(self.estimate, indent=2)
+
+
+if __name__ == '__main__':
+    emod = EstimateCost(input_data=example)
+    emod.run()
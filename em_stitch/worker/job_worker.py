@@ -0,0 +1,393 @@
+"""long running worker that runs em_stitch jobs from a spool directory.
+
+A job is a json file in the spool directory:
+
+    {"module": "montage", "args": {...}}
+
+where "module" is one of job_modules and "args" is the input_data
+for that module's schema. An optional "estimate" holds the resources
+the job is expected to use (see em_stitch.worker.cost_estimate), for
+schedulers that pack jobs onto workers. Producers should write the file under a
+name not ending in .json and rename it into place (see submit_job),
+so the worker never reads a partial job.
+
+The worker claims a job by renaming it into running/, next to a
+<name>.owner record of its host and pid, runs it in this process, and
+then moves it to done/ or failed/ next to a <name>.result.json record.
+Several workers can share a spool. Jobs left in running/ by a worker
+that died (its pid is gone from this host, or it claimed the job more
+than stale_timeout ago) are queued again, up to max_attempts times,
+and then failed.
+Imports, and module level caches like the solver templates in
+em_stitch.montage.montage_solver, stay warm between jobs.
+"""
+import datetime
+import importlib
+import logging
+import os
+import socket
+import time
+import traceback
+import uuid
+
+from argschema import ArgSchemaParser
+
+from em_stitch.utils import jsongz
+from em_stitch.worker.cost_estimate import estimate_job_cost
+from em_stitch.worker.schemas import JobWorkerSchema
+
+logger = logging.getLogger(__name__)
+
+example = {
+        "spool_dir": "/data/em-131fs3/spool",
+        "poll_interval": 0.5,
+        "log_level": "INFO"
+        }
+
+# values of a job's "module" and the class that runs it
+job_modules = {
+    'lens_correction': (
+        'em_stitch.lens_correction.lens_correction_solver.'
+        'LensCorrectionSolver'),
+    'mesh_and_solve': (
+        'em_stitch.lens_correction.mesh_and_solve_transform.'
+        'MeshAndSolveTransform'),
+    'montage': 'em_stitch.montage.montage_solver.MontageSolver',
+    'montage_batch': 'em_stitch.montage.montage_batch.MontageBatchSolver',
+    'set_update_upload': 'em_stitch.viz.set_update_upload.SetUpdateUpload',
+}
+
+
+class JobWorkerException(Exception):
+    pass
+
+
+def get_module_class(name):
+    """ArgSchemaParser class for a job module name
+
+    Parameters
+    ----------
+    name : str
+        key of job_modules
+
+    Returns
+    -------
+    cls : type
+        the ArgSchemaParser subclass
+    """
+    if name not in job_modules:
+        raise JobWorkerException(
+            "unknown job module %s, expected one of %s" % (
+                name, sorted(job_modules)))
+    module, cls = job_modules[name].rsplit('.', 1)
+    return getattr(importlib.import_module(module), cls)
+
+
+def submit_job(spool_dir, module, args, name=None, estimate=None):
+    """atomically write a job into a spool directory
+
+    Parameters
+    ----------
+    spool_dir : str
+        spool directory of a worker
+    module : str
+        key of job_modules
+    args : dict
+        input_data for the module
+    name : str
+        job name. default is a timestamp and a random suffix
+    estimate : dict
+        cost estimate of the job, see
+        em_stitch.worker.cost_estimate.estimate_job_cost
+
+    Returns
+    -------
+    path : str
+        path of the job file
+    """
+    if name is None:
+        name = '%s_%s' % (
+            datetime.datetime.now().strftime("%Y%m%d%H%M%S%f"),
+            uuid.uuid4().hex[:8])
+    job = {'module': module, 'args': args}
+    if estimate is not None:
+        job['estimate'] = estimate
+    return jsongz.dump(
+        job,
+        os.path.join(spool_dir, name + '.json'),
+        atomic=True)
+
+
+def job_exists(spool_dir, name):
+    """whether a job of this name is pending, running or finished"""
+    return any(
+        os.path.isfile(os.path.join(spool_dir, d, name + '.json'))
+        for d in ['', 'running', 'done', 'failed'])
+
+
+def owner_path(path):
+    """owner record of a job in running/"""
+    return path[:-len('.json')] + '.owner'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's process
+        return True
+    return True
+
+
+def count_queued(spool_dir):
+    """number of jobs pending or running in a spool"""
+    n = 0
+    for d in ['', 'running']:
+        path = os.path.join(spool_dir, d)
+        if os.path.isdir(path):
+            n += len([
+                e for e in os.scandir(path)
+                if e.name.endswith('.json') and e.is_file()])
+    return n
+
+
+class JobWorker(ArgSchemaParser):
+    default_schema = JobWorkerSchema
+
+    def spool_subdir(self, name):
+        path = os.path.join(self.args['spool_dir'], name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def warm_up(self):
+        """import the heavy modules now rather than in the first job"""
+        t0 = time.time()
+        for module in self.args['warm_imports']:
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                logger.warning("could not import %s: %s" % (module, e))
+        logger.info("warm up took %0.1f seconds" % (time.time() - t0))
+
+    def pending_jobs(self):
+        """job files waiting in the spool, oldest first"""
+        jobs = []
+        for e in os.scandir(self.args['spool_dir']):
+            if not (e.name.endswith('.json') and e.is_file()):
+                continue
+            try:
+                mtime = e.stat().st_mtime
+            except FileNotFoundError:
+                # claimed by another worker since the listing
+                continue
+            jobs.append((mtime, e.name, e.path))
+        jobs.sort()
+        return [path for _, _, path in jobs]
+
+    def claim(self, path):
+        """move a job into running/
+
+        Returns
+        -------
+        path : str or None
+            new path of the job, or None if another worker claimed it
+        """
+        running = os.path.join(
+            self.spool_subdir('running'), os.path.basename(path))
+        try:
+            os.rename(path, running)
+        except FileNotFoundError:
+            return None
+        jsongz.dump(
+            {
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'claimed': time.time()},
+            owner_path(running), compress=False, atomic=True)
+        return running
+
+    def is_stale(self, path, now):
+        """whether the worker that claimed a job in running/ is gone"""
+        try:
+            owner = jsongz.load(owner_path(path))
+        except (OSError, ValueError):
+            # claimed an instant ago, the record is not written yet
+            owner = {'host': None, 'pid': None,
+                     'claimed': os.stat(path).st_ctime}
+        if (owner['host'] == socket.gethostname()) and (
+                not _pid_alive(owner['pid'])):
+            return True
+        return ((self.args['stale_timeout'] is not None) and
+                (now - owner['claimed'] > self.args['stale_timeout']))
+
+    def recover_jobs(self):
+        """queue again, or fail after max_attempts, the jobs in running/
+        whose worker is gone
+
+        Returns
+        -------
+        n : int
+            number of jobs recovered
+        """
+        now = time.time()
+        n = 0
+        for e in list(os.scandir(self.spool_subdir('running'))):
+            if not (e.name.endswith('.json') and e.is_file()):
+                continue
+            try:
+                if not self.is_stale(e.path, now):
+                    continue
+                # only one worker recovers a job
+                recovering = e.path + '.recovering'
+                os.rename(e.path, recovering)
+            except FileNotFoundError:
+                continue
+            name = e.name[:-len('.json')]
+            job = jsongz.load(recovering)
+            job['attempts'] = job.get('attempts', 1) + 1
+            if job['attempts'] > self.args['max_attempts']:
+                error = "worker gone after %d attempts" % (
+                    self.args['max_attempts'])
+                self.finish(recovering, name, {
+                    'job': name,
+                    'module': job.get('module'),
+                    'status': 'failed',
+                    'error': error,
+                    'traceback': None,
+                    'output_json': None,
+                    'output': None,
+                    'estimate': job.get('estimate'),
+                    'wall_time': None})
+            else:
+                jsongz.dump(
+                    job, os.path.join(self.args['spool_dir'], name + '.json'),
+                    atomic=True)
+                os.remove(recovering)
+                logger.warning("queued job %s again, its worker is gone" % (
+                    name))
+            try:
+                os.remove(owner_path(e.path))
+            except FileNotFoundError:
+                pass
+            n += 1
+        return n
+
+    def finish(self, path, name, result):
+        """move a job to done/ or failed/ next to its result record"""
+        dest = self.spool_subdir('done' if result['status'] == 'ok'
+                                 else 'failed')
+        jsongz.dump(
+            result,
+            os.path.join(dest, name + '.result.json'),
+            atomic=True,
+            indent=2)
+        os.replace(path, os.path.join(dest, name + '.json'))
+        logger.info("job %s %s" % (name, result['status']))
+
+    def estimate(self, job):
+        """cost estimate of a job, None if it cannot be estimated"""
+        try:
+            return estimate_job_cost(
+                job['module'], job['args'],
+                calibration_file=self.args['calibration_file'])
+        except Exception as e:
+            logger.warning("could not estimate the cost of %s job: %s" % (
+                job['module'], e))
+            return None
+
+    def run_job(self, path):
+        """run a claimed job and record its result
+
+        Parameters
+        ----------
+        path : str
+            path of the job file in running/
+
+        Returns
+        -------
+        result : dict
+            the job's result record
+        """
+        name = os.path.basename(path)[:-len('.json')]
+        result = {
+            'job': name,
+            'module': None,
+            'status': 'ok',
+            'error': None,
+            'traceback': None,
+            'output_json': None,
+            'output': None,
+            'estimate': None,
+            'wall_time': None}
+        t0 = time.time()
+        try:
+            job = jsongz.load(path)
+            result['module'] = job['module']
+            cls = get_module_class(job['module'])
+            result['estimate'] = job.get('estimate')
+            if (result['estimate'] is None) and self.args['estimate_cost']:
+                result['estimate'] = self.estimate(job)
+            mod = cls(input_data=job['args'], args=[])
+            mod.run()
+            output_json = mod.args.get('output_json')
+            result['output_json'] = output_json
+            if output_json and os.path.isfile(output_json):
+                result['output'] = jsongz.load(output_json)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = "%s: %s" % (e.__class__.__name__, e)
+            result['traceback'] = traceback.format_exc()
+            logger.error("job %s failed: %s" % (name, result['error']))
+        result['wall_time'] = time.time() - t0
+
+        self.finish(path, name, result)
+        try:
+            os.remove(owner_path(path))
+        except FileNotFoundError:
+            pass
+        logger.info("job %s took %0.1f seconds" % (
+            name, result['wall_time']))
+        return result
+
+    def next_job(self):
+        """claim the oldest pending job, or None if there are none"""
+        for path in self.pending_jobs():
+            claimed = self.claim(path)
+            if claimed is not None:
+                return claimed
+        return None
+
+    def run(self):
+        logger.setLevel(self.args['log_level'])
+        self.warm_up()
+        self.results = []
+        self.n_recovered = self.recover_jobs()
+        while ((self.args['max_jobs'] is None) or
+               (len(self.results) < self.args['max_jobs'])):
+            path = self.next_job()
+            if path is None:
+                # only look for lost jobs while idle
+                n = self.recover_jobs()
+                if n:
+                    self.n_recovered += n
+                    continue
+                if self.args['exit_when_idle']:
+                    break
+                time.sleep(self.args['poll_interval'])
+                continue
+            self.results.append(self.run_job(path))
+
+        if 'output_json' in self.args:
+            self.output({
+                'n_jobs': len(self.results),
+                'n_failed': len(
+                    [r for r in self.results if r['status'] != 'ok']),
+                'n_recovered': self.n_recovered,
+                'jobs': self.results}, indent=2)
+
+
+if __name__ == "__main__":
+    worker = JobWorker(input_data=example)
+    worker.run()
@@ -0,0 +1,206 @@
+import warnings
+
+import marshmallow as mm
+from marshmallow.warnings import ChangedInMarshmallow3Warning
+
+from argschema import ArgSchema
+from argschema.fields import (
+    Boolean, Dict, Float, InputDir, InputFile, Int, List, OutputDir, Str)
+
+warnings.simplefilter(
+        action='ignore',
+        category=ChangedInMarshmallow3Warning)
+
+# heavy modules that the job modules otherwise import on first use
+default_warm_imports = [
+    'cv2',
+    'triangle',
+    'scipy.optimize',
+    'scipy.sparse.linalg',
+    'bigfeta.bigfeta',
+    'em_stitch.lens_correction.lens_correction_solver',
+    'em_stitch.lens_correction.mesh_and_solve_transform',
+    'em_stitch.montage.montage_solver']
+
+# solver templates of a montage estimated without its solver_templates
+default_n_templates = 2
+
+
+class JobWorkerSchema(ArgSchema):
+    spool_dir = OutputDir(
+        required=True,
+        description=("directory watched for job json files. "
+                     "running/, done/ and failed/ are made inside it"))
+    poll_interval = Float(
+        required=False,
+        missing=0.5,
+        default=0.5,
+        description="seconds between checks of an empty spool")
+    max_jobs = Int(
+        required=False,
+        missing=None,
+        default=None,
+        allow_none=True,
+        description="exit after this many jobs. None to run forever")
+    exit_when_idle = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description="exit as soon as the spool is empty")
+    warm_imports = List(
+        Str,
+        required=False,
+        missing=default_warm_imports,
+        default=default_warm_imports,
+        description="modules imported once when the worker starts")
+    stale_timeout = Float(
+        required=False,
+        missing=86400.0,
+        default=86400.0,
+        allow_none=True,
+        description=("seconds after which a job in running/ is taken "
+                     "to be lost by its worker, for workers on other "
+                     "hosts. Lost workers on this host are detected "
+                     "by their pid. None for no timeout"))
+    max_attempts = Int(
+        required=False,
+        missing=2,
+        default=2,
+        validate=mm.validate.Range(min=1),
+        description=("times a job is started before a lost one is "
+                     "failed rather than queued again"))
+    estimate_cost = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description=("add the cost estimate of em_stitch.worker."
+                     "cost_estimate to the results of jobs whose job "
+                     "file has none. It reads the section's counts "
+                     "before each job"))
+    calibration_file = InputFile(
+        required=False,
+        missing=None,
+        default=None,
+        description=("calibration table of the cost estimates. "
+                     "None for the one shipped with em_stitch"))
+
+
+class AcquisitionWatcherSchema(ArgSchema):
+    watch_dir = InputDir(
+        required=True,
+        description="root directory under which sections are acquired")
+    spool_dir = OutputDir(
+        required=True,
+        description="spool directory of the job worker(s) to feed")
+    max_depth = Int(
+        required=False,
+        missing=2,
+        default=2,
+        description=("how many directory levels below watch_dir "
+                     "to look for sections"))
+    settle_time = Float(
+        required=False,
+        missing=10.0,
+        default=10.0,
+        description=("seconds a section's files must be unchanged "
+                     "before it is checked for completeness"))
+    montage_settle_time = Float(
+        required=False,
+        missing=120.0,
+        default=120.0,
+        description=("seconds a section without template matches "
+                     "must be unchanged before it is queued as a "
+                     "montage, so that a lens correction section "
+                     "whose template matches are written late is not "
+                     "taken for one"))
+    poll_interval = Float(
+        required=False,
+        missing=2.0,
+        default=2.0,
+        description=("seconds between directory scans when polling, "
+                     "or between checks of settled sections"))
+    use_inotify = Boolean(
+        required=False,
+        missing=True,
+        default=True,
+        description=("use inotify on Linux, falls back to polling "
+                     "when it is not available"))
+    max_queued = Int(
+        required=False,
+        missing=16,
+        default=16,
+        allow_none=True,
+        description=("hold back new jobs while this many are pending "
+                     "or running in the spool. None for no limit"))
+    submit_montage = Boolean(
+        required=False,
+        missing=True,
+        default=True,
+        description="queue montage jobs")
+    submit_lens = Boolean(
+        required=False,
+        missing=True,
+        default=True,
+        description="queue lens correction jobs")
+    montage_args = Dict(
+        required=False,
+        missing={},
+        default={},
+        description=("MontageSolver args for every montage job. "
+                     "data_dir is set per section"))
+    lens_args = Dict(
+        required=False,
+        missing={},
+        default={},
+        description=("LensCorrectionSolver args for every lens job. "
+                     "data_dir is set per section"))
+    exit_when_idle = Boolean(
+        required=False,
+        missing=False,
+        default=False,
+        description="exit once no section is waiting to be queued")
+    estimate_cost = Boolean(
+        required=False,
+        missing=True,
+        default=True,
+        description=("add the cost estimate of em_stitch.worker."
+                     "cost_estimate to each queued job file"))
+    calibration_file = InputFile(
+        required=False,
+        missing=None,
+        default=None,
+        description=("calibration table of the cost estimates. "
+                     "None for the one shipped with em_stitch"))
+
+
+class CostEstimateSchema(ArgSchema):
+    data_dir = InputDir(
+        required=True,
+        description="section directory, as passed to the job")
+    module = Str(
+        required=False,
+        missing=None,
+        default=None,
+        validate=mm.validate.OneOf(['lens_correction', 'montage']),
+        allow_none=True,
+        description=("job module to estimate. None for lens_correction "
+                     "if the section has template matches, montage "
+                     "otherwise"))
+    nvertex = Int(
+        required=False,
+        missing=1000,
+        default=1000,
+        description="lens correction: maximum number of mesh vertices")
+    n_templates = Int(
+        required=False,
+        missing=default_n_templates,
+        default=default_n_templates,
+        validate=mm.validate.Range(min=1),
+        description="montage: number of solver templates")
+    calibration_file = InputFile(
+        required=False,
+        missing=None,
+        default=None,
+        description=("calibration table written by "
+                     "benchmarks/bench_calibrate.py. None for the one "
+                     "shipped with em_stitch"))
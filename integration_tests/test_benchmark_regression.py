@@ -0,0 +1,110 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks'))
+import regression  # noqa: E402
+
+
+def summary(benchmarks):
+    return {
+        'version': regression.baseline_version,
+        'commit': None,
+        'dependencies': {},
+        'benchmarks': {
+            name: {'median': median, 'peak_memory_mb': memory}
+            for name, (median, memory) in benchmarks.items()}}
+
+
+def statuses(baseline, current, tolerance=0.25, memory_tolerance=0.1,
+             min_delta=0.0, min_memory_delta=0.0):
+    rows = regression.compare(
+        summary(baseline), summary(current), tolerance, memory_tolerance,
+        min_delta, min_memory_delta)
+    return {r['name']: r['status'] for r in rows}
+
+
+def test_summarize():
+    results = {
+        'machine_info': {
+            'node': 'node', 'system': 'Linux',
+            'cpu': {'brand_raw': 'cpu'}},
+        'commit_info': {'id': 'abc'},
+        'benchmarks': [{
+            'fullname': 'benchmarks/bench_lens.py::test_solve[250]',
+            'stats': {'median': 0.123456789, 'iqr': 0.01, 'rounds': 5},
+            'extra_info': {'peak_memory_mb': 12.3456}}, {
+            'fullname': 'benchmarks/bench_lens.py::test_load',
+            'stats': {'median': 1.0, 'iqr': 0.0, 'rounds': 3}}]}
+    s = regression.summarize(results)
+    assert s['version'] == regression.baseline_version
+    assert s['commit'] == 'abc'
+    assert s['machine'] == {'node': 'node', 'cpu': 'cpu', 'system': 'Linux'}
+    assert 'python' in s['dependencies']
+    assert s['benchmarks'] == {
+        'bench_lens.py::test_solve[250]': {
+            'median': 0.1235, 'iqr': 0.01, 'rounds': 5,
+            'peak_memory_mb': 12.35},
+        'bench_lens.py::test_load': {
+            'median': 1.0, 'iqr': 0.0, 'rounds': 3,
+            'peak_memory_mb': None}}
+
+
+def test_compare():
+    assert statuses(
+        {'same': (1.0, 100.0), 'slower': (1.0, 100.0),
+         'faster': (1.0, 100.0), 'memory': (1.0, 100.0),
+         'missing': (1.0, 100.0)},
+        {'same': (1.1, 105.0), 'slower': (1.5, 100.0),
+         'faster': (0.5, 100.0), 'memory': (1.0, 120.0),
+         'new': (1.0, 100.0)}) == {
+        'same': 'ok', 'slower': 'slower', 'faster': 'faster',
+        'memory': 'memory', 'missing': 'missing', 'new': 'new'}
+
+
+@pytest.mark.parametrize('current, min_delta, status', [
+    # exactly the tolerance is not a regression
+    (1.25, 0.0, 'ok'),
+    (1.5, 0.0, 'slower'),
+    (0.75, 0.0, 'ok'),
+    (0.5, 0.0, 'faster'),
+    # nor anything up to min_delta
+    (1.5, 0.5, 'ok'),
+    (1.75, 0.5, 'slower'),
+    (0.5, 0.5, 'ok')])
+def test_compare_time_boundaries(current, min_delta, status):
+    assert statuses(
+        {'b': (1.0, None)}, {'b': (current, None)},
+        min_delta=min_delta) == {'b': status}
+
+
+@pytest.mark.parametrize('baseline, current, min_memory_delta, status', [
+    (100.0, 110.0, 0.0, 'ok'),
+    (100.0, 120.0, 0.0, 'memory'),
+    (100.0, 120.0, 20.0, 'ok'),
+    (100.0, 120.0, 10.0, 'memory'),
+    # not traced in one of the runs
+    (None, 120.0, 0.0, 'ok'),
+    (100.0, None, 0.0, 'ok')])
+def test_compare_memory_boundaries(
+        baseline, current, min_memory_delta, status):
+    assert statuses(
+        {'b': (1.0, baseline)}, {'b': (1.0, current)},
+        min_memory_delta=min_memory_delta) == {'b': status}
+
+
+def test_regressions():
+    rows = regression.compare(
+        summary({'slower': (1.0, None), 'missing': (1.0, None)}),
+        summary({'slower': (2.0, None), 'new': (1.0, None)}),
+        0.25, 0.1, 0.0, 0.0)
+    assert [r['name'] for r in regression.regressions(rows)] == [
+        'missing', 'slower']
+    assert [r['name'] for r in regression.regressions(
+        rows, allow_missing=True)] == ['slower']
+    report = regression.format_report(
+        summary({}), summary({}), rows, allow_missing=True)
+    assert report.endswith('3 benchmarks, 1 regressions\n')
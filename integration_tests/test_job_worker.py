@@ -0,0 +1,282 @@
+from jinja2 import Environment, FileSystemLoader
+import glob
+import json
+import os
+import pytest
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+from em_stitch.utils import jsongz
+from em_stitch.worker.acquisition_watcher import (
+    AcquisitionWatcher, is_complete)
+from em_stitch.worker.cost_estimate import (
+    EstimateCost, estimate_job_cost, estimate_lens_cost)
+from em_stitch.worker.job_worker import JobWorker, submit_job
+
+test_files_dir = os.path.join(os.path.dirname(__file__), 'test_files')
+example_env = Environment(loader=FileSystemLoader(test_files_dir))
+
+
+def montage_args(output_dir):
+    template = example_env.get_template("montage_solver_example.json")
+    return json.loads(template.render(
+        data_dir=os.path.join(test_files_dir, "montage_example"),
+        output_dir=output_dir,
+        template_dir=test_files_dir))
+
+
+def test_job_worker():
+    with TemporaryDirectory() as spool_dir, \
+            TemporaryDirectory() as output_dir:
+        for i in range(2):
+            d = os.path.join(output_dir, str(i))
+            os.makedirs(d)
+            submit_job(spool_dir, 'montage', montage_args(d), name='m%d' % i)
+        submit_job(spool_dir, 'not_a_module', {}, name='bad')
+        # not a complete job file yet
+        with open(os.path.join(spool_dir, 'partial.json.tmp'), 'w') as f:
+            f.write('{"mod')
+
+        worker = JobWorker(input_data={
+            'spool_dir': spool_dir,
+            'exit_when_idle': True,
+            'warm_imports': [],
+            'estimate_cost': True,
+            'output_json': os.path.join(output_dir, 'worker.json')},
+            args=[])
+        worker.run()
+
+        with open(worker.args['output_json'], 'r') as f:
+            j = json.load(f)
+        assert j['n_jobs'] == 3
+        assert j['n_failed'] == 1
+
+        for name in ['m0', 'm1']:
+            with open(os.path.join(
+                    spool_dir, 'done', name + '.result.json'), 'r') as f:
+                r = json.load(f)
+            assert r['status'] == 'ok'
+            assert os.path.isfile(r['output_json'])
+            assert r['output'] is not None
+            assert r['estimate']['module'] == 'montage'
+            assert r['estimate']['counts']['n_templates'] == 2
+            assert os.path.isfile(
+                os.path.join(spool_dir, 'done', name + '.json'))
+
+        with open(os.path.join(
+                spool_dir, 'failed', 'bad.result.json'), 'r') as f:
+            r = json.load(f)
+        assert r['status'] == 'failed'
+        assert 'not_a_module' in r['error']
+
+        assert os.listdir(os.path.join(spool_dir, 'running')) == []
+        assert os.path.isfile(os.path.join(spool_dir, 'partial.json.tmp'))
+
+
+def test_job_worker_recovers_lost_jobs():
+    with TemporaryDirectory() as spool_dir, \
+            TemporaryDirectory() as output_dir:
+        running = os.path.join(spool_dir, 'running')
+        os.makedirs(running)
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        owners = {
+            'lost': dead.pid,
+            'lost_twice': dead.pid,
+            'alive': os.getppid()}
+        for name, pid in owners.items():
+            job = {'module': 'montage', 'args': montage_args(output_dir)}
+            if name == 'lost_twice':
+                job['attempts'] = 2
+            jsongz.dump(job, os.path.join(running, name + '.json'))
+            jsongz.dump(
+                {'host': socket.gethostname(), 'pid': pid,
+                 'claimed': time.time()},
+                os.path.join(running, name + '.owner'), compress=False)
+
+        worker = JobWorker(input_data={
+            'spool_dir': spool_dir,
+            'exit_when_idle': True,
+            'warm_imports': []}, args=[])
+        worker.run()
+        assert worker.n_recovered == 2
+        assert [r['job'] for r in worker.results] == ['lost']
+        assert worker.results[0]['status'] == 'ok'
+        with open(os.path.join(
+                spool_dir, 'failed', 'lost_twice.result.json'), 'r') as f:
+            assert 'worker gone' in json.load(f)['error']
+        assert sorted(os.listdir(running)) == ['alive.json', 'alive.owner']
+
+        # or after the timeout, wherever the worker was
+        worker.args['stale_timeout'] = 0.0
+        assert worker.recover_jobs() == 1
+        assert os.listdir(running) == []
+
+
+def test_pending_jobs_claimed_while_listing(tmpdir, monkeypatch):
+    spool_dir = str(tmpdir)
+    for name in ['a', 'b', 'c']:
+        submit_job(spool_dir, 'montage', {}, name=name)
+    worker = JobWorker(input_data={
+        'spool_dir': spool_dir,
+        'warm_imports': []}, args=[])
+
+    # another worker claims b after the listing, before the sort
+    scandir = os.scandir
+
+    def claiming_scandir(path):
+        entries = list(scandir(path))
+        os.remove(os.path.join(spool_dir, 'b.json'))
+        return iter(entries)
+
+    monkeypatch.setattr(os, 'scandir', claiming_scandir)
+    assert [os.path.basename(p) for p in worker.pending_jobs()] == [
+        'a.json', 'c.json']
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_acquisition_watcher(use_inotify):
+    with TemporaryDirectory() as watch_dir, \
+            TemporaryDirectory() as spool_dir:
+        lens_dir = os.path.join(watch_dir, 'lens', '0')
+        shutil.copytree(os.path.join(test_files_dir, 'lens_example'), lens_dir)
+        montage_dir = os.path.join(watch_dir, 'montage')
+        os.makedirs(montage_dir)
+        for f in glob.glob(os.path.join(
+                test_files_dir, 'montage_example', '_metadata*')):
+            shutil.copy(f, montage_dir)
+        # still being written
+        partial_dir = os.path.join(watch_dir, 'partial')
+        os.makedirs(partial_dir)
+        with open(os.path.join(partial_dir, '_metadata_x.json'), 'w') as f:
+            f.write('[{"metadata": ')
+
+        watcher_args = {
+            'watch_dir': watch_dir,
+            'spool_dir': spool_dir,
+            'settle_time': 0.0,
+            'montage_settle_time': 0.0,
+            'poll_interval': 0.05,
+            'use_inotify': use_inotify,
+            'exit_when_idle': True,
+            'montage_args': {'solver_templates': ['affine_template.json']}}
+        watcher = AcquisitionWatcher(input_data=watcher_args, args=[])
+        watcher.run()
+
+        jobs = {}
+        estimates = {}
+        for p in glob.glob(os.path.join(spool_dir, '*.json')):
+            with open(p, 'r') as f:
+                j = json.load(f)
+            jobs[j['module']] = j['args']
+            estimates[j['module']] = j['estimate']
+        assert jobs['lens_correction'] == {'data_dir': lens_dir}
+        assert jobs['montage'] == {
+            'data_dir': montage_dir,
+            'solver_templates': ['affine_template.json']}
+        assert len(watcher.submitted) == 2
+        assert estimates['lens_correction']['matrix']['n_cols'] == (
+            estimates['lens_correction']['counts']['n_tiles'] + 1000)
+        assert estimates['montage']['counts']['n_templates'] == 1
+
+        # nothing new, nothing queued
+        watcher = AcquisitionWatcher(input_data=watcher_args, args=[])
+        watcher.run()
+        assert len(watcher.submitted) == 0
+
+        # back pressure holds back the completed section
+        with open(os.path.join(partial_dir, '_metadata_x.json'), 'w') as f:
+            f.write('[{"metadata": {}}, {"data": []}]')
+        watcher_args['max_queued'] = 2
+        watcher = AcquisitionWatcher(input_data=watcher_args, args=[])
+        watcher.scan()
+        assert watcher.queue_settled() == 0
+        assert partial_dir in watcher.changed
+        os.remove(glob.glob(os.path.join(spool_dir, 'montage_*.json'))[0])
+        assert watcher.queue_settled() == 1
+
+
+def test_cost_estimate(tmpdir):
+    lens_dir = os.path.join(test_files_dir, 'lens_example')
+    matches = jsongz.load(
+        glob.glob(os.path.join(lens_dir, '_template_matches*'))[0])
+    n_point_pairs = sum(
+        len(m['matches']['p'][0]) for m in matches['collection'])
+
+    small = estimate_lens_cost(lens_dir, nvertex=250)
+    large = estimate_lens_cost(lens_dir, nvertex=2000)
+    assert small['counts']['n_point_pairs'] == n_point_pairs
+    assert small['matrix']['n_rows'] == n_point_pairs
+    assert small['matrix']['nnz_A'] == 8 * n_point_pairs
+    assert large['matrix']['n_cols'] - small['matrix']['n_cols'] == 1750
+    for key in ['nnz_K', 'nnz_factor']:
+        assert 0 < small['matrix'][key] < large['matrix'][key]
+    assert 0 < small['factor_memory_mb'] < large['factor_memory_mb']
+    assert 0 < small['wall_time'] <= large['wall_time']
+    assert 0 < small['peak_memory_mb'] <= large['peak_memory_mb']
+
+    args = json.loads(example_env.get_template(
+        "montage_solver_example.json").render(
+            data_dir=os.path.join(test_files_dir, "montage_example"),
+            output_dir=str(tmpdir),
+            template_dir=test_files_dir))
+    montage = estimate_job_cost('montage', args)
+    assert montage['counts']['n_tiles'] > 0
+    assert montage['counts']['n_point_pair_solves'] == (
+        2 * montage['counts']['n_point_pairs'])
+    assert montage['wall_time'] > 0
+    assert estimate_job_cost('set_update_upload', {}) is None
+
+    output_json = str(tmpdir.join('estimate.json'))
+    emod = EstimateCost(input_data={
+        'data_dir': lens_dir,
+        'nvertex': 250,
+        'output_json': output_json}, args=[])
+    emod.run()
+    with open(output_json, 'r') as f:
+        assert json.load(f) == json.loads(json.dumps(small))
+
+
+def test_acquisition_watcher_late_matches(tmpdir):
+    lens_example = os.path.join(test_files_dir, 'lens_example')
+    watch_dir = tmpdir.mkdir('watch')
+    spool_dir = str(tmpdir.mkdir('spool'))
+    section = watch_dir.mkdir('0')
+    for f in glob.glob(os.path.join(lens_example, '_metadata*')):
+        shutil.copy(f, str(section))
+
+    watcher = AcquisitionWatcher(input_data={
+        'watch_dir': str(watch_dir),
+        'spool_dir': spool_dir,
+        'settle_time': 0.0,
+        'montage_settle_time': 3600.0,
+        'use_inotify': False}, args=[])
+    watcher.scan()
+    # no template matches yet, but it is too early to call it a montage
+    assert watcher.queue_settled() == 0
+    assert str(section) in watcher.changed
+
+    for f in glob.glob(os.path.join(lens_example, '_template_matches*')):
+        shutil.copy(f, str(section))
+    watcher.scan()
+    assert watcher.queue_settled() == 1
+    assert watcher.submitted[0]['module'] == 'lens_correction'
+
+
+def test_is_complete(tmpdir):
+    obj = {'data': list(range(100000))}
+    for compress in [False, True]:
+        path = jsongz.dump(
+            obj, str(tmpdir.join('complete.json')), compress=compress)
+        assert is_complete(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        partial = str(tmpdir.join(
+            'partial' + ('.json.gz' if compress else '.json')))
+        with open(partial, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        assert not is_complete(partial)
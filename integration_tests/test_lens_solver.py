@@ -8,14 +8,21 @@ from em_stitch.lens_correction.lens_correction_solver import (
         LensCorrectionSolver, make_collection_json, one_file,
         LensCorrectionException, tilespec_input_from_metafile)
 from em_stitch.lens_correction.mesh_and_solve_transform import \
-        MeshAndSolveTransform
+        MeshAndSolveTransform, MeshLensCorrectionException, diagnostics_name
+from em_stitch.lens_correction.solve_replay import (
+        SolveReplay, load_system, replay)
+from em_stitch.lens_correction.synthetic import (
+        GenerateSyntheticLensData, distortion_error, load_expected_transform)
 from em_stitch.utils.generate_EM_tilespecs_from_metafile import \
         GenerateEMTileSpecsModule
+from em_stitch.utils.transform_sidecar import (
+        load_lens_transform, sidecar_path)
 from tempfile import TemporaryDirectory
 from marshmallow import ValidationError
 import renderapi
 import glob
 import shutil
+import numpy as np
 
 test_files_dir = os.path.join(os.path.dirname(__file__), 'test_files')
 example_env = Environment(loader=FileSystemLoader(test_files_dir))
@@ -80,6 +87,12 @@ def test_solve_from_file_and_memory(solver_input_args, source):
                     len(tfile.tilespecs) ==
                     len(gentspecs.tilespecs) ==
                     len(solver.resolved.tilespecs))
+            # same transform from the sidecar and from the json
+            assert os.path.isfile(sidecar_path(tspec_path))
+            jtform = tfile.transforms[0].to_dict()
+            assert load_lens_transform(tspec_path).to_dict() == jtform
+            os.remove(sidecar_path(tspec_path))
+            assert load_lens_transform(tspec_path).to_dict() == jtform
         if source == 'memory':
             solver_args['tilespecs'] = gentspecs.tilespecs
             solver_args['matches'] = jsongz.load(cfile)
@@ -115,6 +128,10 @@ def test_solver(solver_input_args, timestamp):
             j = json.load(f)
         for f in j['output'].values():
             assert os.path.isfile(f)
+        for k in ['tilespecs', 'filter_matches', 'mesh_and_solve', 'maps',
+                  'mesh_and_solve.solve_resolvedtiles.mesh']:
+            assert j['timings'][k]['wall_time'] >= 0
+        assert j['timings']['tilespecs']['n_tiles'] > 0
 
 
 def test_multifile_exception(solver_input_args):
@@ -172,3 +189,207 @@ def test_make_collection(solver_input_args, compress):
         m = jsongz.load(cfile)
         n1 = len(m)
         assert n0 == (n1 + 2)
+
+
+def test_solver_cache(solver_input_args):
+    local_args = copy.deepcopy(solver_input_args)
+    with TemporaryDirectory() as cache_dir:
+        local_args['cache_dir'] = cache_dir
+        outputs = []
+        for output_dir, force in [
+                ('first', False), ('second', False), ('forced', True)]:
+            local_args['output_dir'] = os.path.join(cache_dir, output_dir)
+            os.makedirs(local_args['output_dir'])
+            local_args['force_recompute'] = force
+            lcs = LensCorrectionSolver(input_data=local_args, args=[])
+            lcs.run()
+            with open(lcs.args['output_json'], 'r') as f:
+                j = json.load(f)
+            for f in j['output'].values():
+                assert os.path.isfile(f)
+                assert f.startswith(local_args['output_dir'])
+            outputs.append((lcs, j))
+        # all four stages reused by the second run, none by the forced one
+        assert (lcs.solver is not None) and (outputs[1][0].solver is None)
+        assert outputs[0][0].jtform == outputs[1][0].jtform
+        assert (outputs[0][0].map1 == outputs[1][0].map1).all()
+        assert (
+            outputs[0][1]['residual stats'] ==
+            outputs[1][1]['residual stats'])
+
+
+def test_solver_resume(solver_input_args, monkeypatch):
+    local_args = copy.deepcopy(solver_input_args)
+    with TemporaryDirectory() as output_dir:
+        local_args['output_dir'] = output_dir
+        local_args['resume'] = True
+
+        # interrupted while solving
+        def interrupted(self):
+            raise KeyboardInterrupt()
+        with monkeypatch.context() as m:
+            m.setattr(MeshAndSolveTransform, 'run', interrupted)
+            with pytest.raises(KeyboardInterrupt):
+                LensCorrectionSolver(input_data=local_args, args=[]).run()
+        assert os.path.isfile(os.path.join(
+            output_dir, 'stage_manifest.json'))
+
+        lcs = LensCorrectionSolver(input_data=local_args, args=[])
+        lcs.run()
+        assert lcs.stages.reused == {
+            'lens_tilespecs': 'manifest', 'lens_matches': 'manifest'}
+        assert lcs.solver is not None
+
+        lcs = LensCorrectionSolver(input_data=local_args, args=[])
+        lcs.run()
+        assert lcs.stages.reused == {
+            'lens_tilespecs': 'manifest', 'lens_matches': 'manifest',
+            'lens_solve': 'manifest'}
+        with open(lcs.args['output_json'], 'r') as f:
+            j = json.load(f)
+        for f in j['output'].values():
+            assert os.path.isfile(f)
+
+        # changed outputs are not trusted. The same collection is
+        # written again, so the solve remains valid.
+        with open(j['output']['collection'], 'ab') as f:
+            f.write(b' ')
+        lcs = LensCorrectionSolver(input_data=local_args, args=[])
+        lcs.run()
+        assert lcs.stages.reused == {
+            'lens_tilespecs': 'manifest', 'lens_solve': 'manifest'}
+
+
+def test_synthetic_data(solver_input_args):
+    synth_args = {
+        'n_rows': 3,
+        'n_cols': 3,
+        'tile_width': 2048,
+        'tile_height': 2048,
+        'outlier_fraction': 0.05,
+        'match_density': 300.0,
+        'log_level': 'WARNING'}
+    with TemporaryDirectory() as data_dir, TemporaryDirectory() as again:
+        gen = GenerateSyntheticLensData(
+            input_data=dict(synth_args, output_dir=data_dir), args=[])
+        gen.run()
+        assert gen.results['n_tiles'] == 9
+        assert gen.results['n_outliers'] > 0
+
+        # deterministic from the seed
+        gen2 = GenerateSyntheticLensData(
+            input_data=dict(synth_args, output_dir=again), args=[])
+        gen2.run()
+        for k in ['metafile', 'template_matches', 'expected_transform']:
+            with open(gen.results[k], 'rb') as f1, \
+                    open(gen2.results[k], 'rb') as f2:
+                assert f1.read() == f2.read()
+
+        # the matches agree with the ground truth, apart from outliers
+        expected, translations = load_expected_transform(
+            gen.results['expected_transform'])
+        with open(gen.results['template_matches'], 'r') as f:
+            collection = json.load(f)['collection']
+        d = []
+        for m in collection:
+            p = np.array(m['matches']['p']).transpose()
+            q = np.array(m['matches']['q']).transpose()
+            d.append(np.linalg.norm(
+                (expected.tform(p) + translations[m['pId']]) -
+                (expected.tform(q) + translations[m['qId']]), axis=1))
+        d = np.concatenate(d)
+        assert d.size == gen.results['n_point_pairs']
+        assert np.count_nonzero(d > 5) == gen.results['n_outliers']
+
+        local_args = copy.deepcopy(solver_input_args)
+        local_args['data_dir'] = data_dir
+        local_args['output_dir'] = data_dir
+        # the mesh depends on the global random state
+        np.random.seed(0)
+        lcs = LensCorrectionSolver(input_data=local_args, args=[])
+        lcs.run()
+        assert lcs.n_after_filter < lcs.n_from_gpu
+
+        identity = renderapi.transform.AffineModel()
+        recovered = lcs.solver.new_ref_transform
+        assert (
+            distortion_error(expected, recovered, 2048, 2048)['mean'] <
+            0.5 * distortion_error(expected, identity, 2048, 2048)['mean'])
+        assert distortion_error(expected, expected, 2048, 2048)['max'] < 1e-6
+
+
+def test_solve_replay(solver_input_args):
+    local_args = copy.deepcopy(solver_input_args)
+    with TemporaryDirectory() as output_dir:
+        local_args['output_dir'] = output_dir
+        local_args['dump_linear_system'] = True
+        local_args['diagnostics'] = True
+        np.random.seed(0)
+        lcs = LensCorrectionSolver(input_data=local_args, args=[])
+        lcs.run()
+        with open(lcs.args['output_json'], 'r') as f:
+            j = json.load(f)
+        path = j['output']['linear_system']
+        assert os.path.isfile(path)
+
+        # the same residuals from the file alone
+        system = load_system(path)
+        assert system['metadata']['good_solve'] == lcs.args['good_solve']
+        assert len(system['metadata']['tileIds']) == len(
+            lcs.solver.resolved.tilespecs)
+        assert system['mesh_points'].shape[0] == (
+            system['A'].shape[1] - system['lens_dof_start'])
+        solution, errx, erry = replay(system)
+        assert np.round(errx.mean(), 3) == j['residual stats']['x_res_mean']
+        assert np.round(erry.std(), 3) == j['residual stats']['y_res_std']
+
+        # diagnostics, checked against dense linear algebra
+        d = j['diagnostics']
+        A = system['A']
+        assert d['A'] == {'shape': list(A.shape), 'nnz': A.nnz}
+        K = (A.transpose().dot(system['weights']).dot(A) +
+             system['reg']).toarray()
+        eig = np.linalg.eigvalsh(K)
+        assert np.isclose(d['eigenvalues']['max'], eig[-1], rtol=1e-2)
+        assert np.isclose(d['eigenvalues']['min'], eig[0], rtol=1e-2)
+        assert d['condition_number'] > 1.0
+        assert d['fill_in'] >= 1.0
+        assert d['points_per_vertex']['min'] >= 3
+        pairs = d['tile_pairs']
+        assert sum(p['n'] for p in pairs) == A.shape[0]
+        assert [p['rms'] for p in pairs] == sorted(
+            [p['rms'] for p in pairs], reverse=True)
+        assert np.isclose(
+            np.sqrt(sum(p['n'] * p['rms']**2 for p in pairs) / A.shape[0]),
+            np.sqrt(np.mean(errx**2 + erry**2)), rtol=1e-2)
+        tileIds = system['metadata']['tileIds']
+        assert all(
+            (p['pId'] in tileIds) and (p['qId'] in tileIds) for p in pairs)
+
+        replay_args = {
+            'input_file': path,
+            'backends': ['factorized', 'spsolve', 'cg'],
+            'diagnostics': True,
+            'output_json': os.path.join(output_dir, 'replay.json')}
+        sr = SolveReplay(input_data=replay_args, args=[])
+        sr.run()
+        with open(replay_args['output_json'], 'r') as f:
+            replayed = json.load(f)
+        results = replayed['backends']
+        assert results['factorized']['max_difference'] == 0.0
+        assert results['spsolve']['max_difference'] < 1e-6
+        for r in results.values():
+            assert r['good_solve']
+        assert replayed['diagnostics']['tile_pairs'] == pairs
+
+    # kept for the solves that fail
+    with TemporaryDirectory() as output_dir:
+        local_args['output_dir'] = output_dir
+        local_args['dump_linear_system'] = False
+        local_args['good_solve'] = {'error_std': 1e-6}
+        np.random.seed(0)
+        with pytest.raises(MeshLensCorrectionException) as e:
+            LensCorrectionSolver(input_data=local_args, args=[]).run()
+        assert 'condition number' in str(e.value)
+        with open(os.path.join(output_dir, diagnostics_name), 'r') as f:
+            assert json.load(f) == e.value.diagnostics
@@ -4,6 +4,8 @@ from em_stitch.lens_correction.utils import (
         split_inverse_tform,
         remove_weighted_matches,
         estimate_stage_affine)
+from em_stitch.lens_correction.mesh_and_solve_transform import (
+        new_specs_with_tf)
 import renderapi
 import numpy as np
 import copy
@@ -61,6 +63,30 @@ def test_estimate_affine():
     assert np.all(np.isclose(e.M, M))
 
 
+def test_new_specs_with_tf():
+    tspecs = [
+        renderapi.tilespec.TileSpec(
+            tileId=str(i), z=1, width=100, height=100,
+            imageUrl="file:///tile_%d.tif" % i,
+            tforms=[renderapi.transform.AffineModel(B0=i * 90.0)])
+        for i in range(5)]
+    orig = [t.to_dict() for t in tspecs]
+    ref = renderapi.transform.AffineModel(transformId="lens")
+    tforms = [renderapi.transform.AffineModel(B0=i * 100.0)
+              for i in range(5)]
+
+    shallow = new_specs_with_tf(ref, tspecs, tforms)
+    deep = new_specs_with_tf(ref, tspecs, tforms, deep=True)
+
+    assert [t.to_dict() for t in tspecs] == orig
+    assert [t.to_dict() for t in shallow] == [t.to_dict() for t in deep]
+    for t, s in zip(tspecs, shallow):
+        assert s.ip is t.ip
+        assert s.tforms is not t.tforms
+        assert len(s.tforms) == 2
+        assert s.tforms[0].refId == "lens"
+
+
 def test_split_inverse():
     # the function just splits things up
     # so one doesn't run out of memory,
@@ -1,10 +1,18 @@
 from jinja2 import Environment, FileSystemLoader
 import json
+import numpy as np
 import pytest
+import renderapi
 import os
 import copy
+from em_stitch.montage import meta_to_collection
 from em_stitch.montage.montage_solver import (
-        MontageSolver, get_transform)
+        MontageSolver, get_transform, make_raw_tilespecs, make_resolved,
+        montage_filter_matches, stream_filtered_matches)
+from em_stitch.montage.montage_batch import MontageBatchSolver
+from em_stitch.montage.synthetic import GenerateSyntheticMontageData
+from em_stitch.utils import jsongz
+from em_stitch.utils.metafile import Metafile
 from tempfile import TemporaryDirectory
 import glob
 import shutil
@@ -46,10 +54,51 @@ def test_read_from(solver_input_args):
         assert tf0 == tf1 == tf2
 
 
-def test_solver(solver_input_args):
+def test_make_resolved_format(solver_input_args, tmpdir):
+    meta = glob.glob(os.path.join(
+        solver_input_args['data_dir'], '_metadata*.json'))[0]
+    tilespecs, _ = make_raw_tilespecs(meta, str(tmpdir), 'g', False)
+    tform = get_transform(meta, '', {}, 'metafile')
+    rpath = make_resolved(
+        copy.deepcopy(tilespecs), tform, str(tmpdir), False)
+
+    # as written through renderapi objects and json.dump before
+    tspecs = [renderapi.tilespec.TileSpec(json=t) for t in tilespecs]
+    ref = renderapi.transform.ReferenceTransform(refId=tform.transformId)
+    for t in tspecs:
+        t.tforms.insert(0, ref)
+    resolved = renderapi.resolvedtiles.ResolvedTiles(
+        tilespecs=tspecs, transformList=[tform])
+    with open(rpath, 'r') as f:
+        assert f.read() == json.dumps(resolved.to_dict())
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_stream_filtered_matches(solver_input_args, reverse, tmpdir):
+    meta = glob.glob(os.path.join(
+        solver_input_args['data_dir'], '_metadata*.json'))[0]
+    if reverse:
+        # every match then waits for its neighbor later in the file
+        j = jsongz.load(meta)
+        j[1]['data'] = j[1]['data'][::-1]
+        meta = jsongz.dump(
+            j, os.path.join(str(tmpdir), os.path.basename(meta)))
+    thresh = solver_input_args['ransacReprojThreshold']
+
+    matches = meta_to_collection.main(
+        [os.path.dirname(meta)], metafile=Metafile(meta))
+    montage_filter_matches(matches, thresh)
+    streamed = stream_filtered_matches(meta, thresh)
+    assert len(matches) > 0
+    assert streamed == matches
+
+
+@pytest.mark.parametrize("stream_metafile", [True, False])
+def test_solver(solver_input_args, stream_metafile):
     local_args = copy.deepcopy(solver_input_args)
     with TemporaryDirectory() as output_dir:
         local_args['output_dir'] = output_dir
+        local_args['stream_metafile'] = stream_metafile
         ms = MontageSolver(input_data=local_args, args=[])
         ms.run()
         assert os.path.isfile(ms.args['output_json'])
@@ -68,6 +117,70 @@ def test_solver(solver_input_args):
             for k in ['x', 'y', 'mag']:
                 assert ij[k]['mean'] < 2.0
                 assert ij[k]['stdev'] < 2.0
+            for k in ['filter_matches', 'tilespecs', 'solve',
+                      'solve.bigfeta']:
+                assert ij['timings'][k]['wall_time'] >= 0
+
+
+def test_solver_cache(solver_input_args):
+    local_args = copy.deepcopy(solver_input_args)
+    with TemporaryDirectory() as cache_dir:
+        local_args['cache_dir'] = cache_dir
+        results = []
+        for output_dir in ['first', 'second']:
+            local_args['output_dir'] = os.path.join(cache_dir, output_dir)
+            os.makedirs(local_args['output_dir'])
+            ms = MontageSolver(input_data=local_args, args=[])
+            ms.run()
+            with open(ms.args['output_json'], 'r') as f:
+                results.append(json.load(f))
+            for ij in results[-1]:
+                for k in ['output', 'collection']:
+                    assert os.path.isfile(os.path.join(
+                        ms.args['output_dir'], ij[k]))
+        # nothing recomputed, not even the metafile parsed
+        assert ms.metafile is None
+        for r in results:
+            for ij in r:
+                ij.pop('timings')
+        assert results[0] == results[1]
+
+
+def test_solver_resume(solver_input_args):
+    local_args = copy.deepcopy(solver_input_args)
+    with TemporaryDirectory() as output_dir:
+        local_args['output_dir'] = output_dir
+        # nothing kept for resuming unless asked for
+        MontageSolver(input_data=local_args, args=[]).run()
+        assert not os.path.exists(
+            os.path.join(output_dir, 'stage_manifest.json'))
+        assert not os.path.exists(
+            os.path.join(output_dir, 'raw_tilespecs.json.gz'))
+
+        local_args['resume'] = True
+        ms = MontageSolver(input_data=local_args, args=[])
+        ms.run()
+        assert ms.stages.reused == {}
+        manifest = jsongz.load(
+            os.path.join(output_dir, 'stage_manifest.json'))
+        # the tilespecs are in a compressed file, not in the manifest
+        stage = manifest['stages']['montage_tilespecs']
+        assert list(stage['data']) == ['z']
+        assert stage['files']['raw_tilespecs']['path'].endswith('.json.gz')
+
+        ms = MontageSolver(input_data=local_args, args=[])
+        ms.run()
+        assert set(ms.stages.reused.values()) == {'manifest'}
+        assert len(ms.stages.reused) == 3
+        assert ms.metafile is None
+
+        # a missing output is recomputed
+        os.remove(os.path.join(output_dir, ms.results[0]['output']))
+        ms = MontageSolver(input_data=local_args, args=[])
+        ms.run()
+        assert 'montage_solve' not in ms.stages.reused
+        assert os.path.isfile(
+            os.path.join(output_dir, ms.results[0]['output']))
 
 
 def test_solver_no_output_dir(solver_input_args):
@@ -146,3 +259,134 @@ def test_solver_schema_errors(solver_input_args):
         local_args.pop('data_dir')
         with pytest.raises(ValidationError):
             MontageSolver(input_data=local_args, args=[])
+
+        local_args = copy.deepcopy(solver_input_args)
+        local_args['output_dir'] = output_dir
+        local_args['read_transform_from'] = 'ref_file'
+        with pytest.raises(ValidationError):
+            MontageSolver(input_data=local_args, args=[])
+
+
+def test_solver_parallel(solver_input_args):
+    local_args = copy.deepcopy(solver_input_args)
+    with TemporaryDirectory() as output_dir:
+        local_args['output_dir'] = output_dir
+        local_args['n_parallel_solves'] = 0
+        with pytest.raises(ValidationError):
+            MontageSolver(input_data=local_args, args=[])
+        local_args['n_parallel_solves'] = 2
+        ms = MontageSolver(input_data=local_args, args=[])
+        ms.run()
+        with open(ms.args['output_json'], 'r') as f:
+            j = json.load(f)
+        # results come back in template order
+        assert [ij['template'] for ij in j] == \
+            local_args['solver_templates']
+        for ij in j:
+            assert ij['wall_time'] > 0
+            for k in ['x', 'y', 'mag']:
+                assert ij[k]['mean'] < 2.0
+                assert ij[k]['stdev'] < 2.0
+
+
+@pytest.mark.parametrize("error_mean, nexpected", [(2.0, 1), (-1.0, 2)])
+def test_solver_cascade(solver_input_args, error_mean, nexpected):
+    local_args = copy.deepcopy(solver_input_args)
+    with TemporaryDirectory() as output_dir:
+        local_args['output_dir'] = output_dir
+        local_args['cascade'] = True
+        local_args['cascade_criteria'] = {'error_mean': error_mean}
+        ms = MontageSolver(input_data=local_args, args=[])
+        ms.run()
+        with open(ms.args['output_json'], 'r') as f:
+            j = json.load(f)
+        assert len(j) == nexpected
+        accepted = [ij for ij in j if ij['accepted']]
+        if nexpected == 1:
+            assert accepted[0]['cascade']['skipped'] == \
+                local_args['solver_templates'][1:]
+            # the one skipped template costs at least the measured solve
+            assert accepted[0]['cascade']['time_saved_lower_bound'] == \
+                pytest.approx(
+                    accepted[0]['timings']['solve.bigfeta']['wall_time'])
+        else:
+            assert len(accepted) == 0
+
+
+def test_batch_solver(solver_input_args):
+    local_args = copy.deepcopy(solver_input_args)
+    with TemporaryDirectory() as output_dir:
+        # one good section, one without a metafile
+        section = os.path.join(output_dir, 'section')
+        empty = os.path.join(output_dir, 'empty')
+        os.makedirs(empty)
+        shutil.copytree(local_args['data_dir'], section)
+        batch_args = {
+                'data_dirs': [section, empty],
+                'solver_template_dir': local_args['solver_template_dir'],
+                'solver_templates': local_args['solver_templates'],
+                'n_workers': 2,
+                'output_json': os.path.join(output_dir, 'batch.json')}
+        for k, v in [
+                ('read_transform_from', 'ref_file'),
+                ('solver_templates', ['file_does_not_exist.json'])]:
+            with pytest.raises(ValidationError):
+                MontageBatchSolver(
+                    input_data=dict(batch_args, **{k: v}), args=[])
+        mb = MontageBatchSolver(input_data=batch_args, args=[])
+        mb.run()
+        with open(batch_args['output_json'], 'r') as f:
+            j = json.load(f)
+        assert j['n_sections'] == 2
+        assert j['n_failed'] == 1
+        assert [r['data_dir'] for r in j['sections']] == [section, empty]
+        assert j['sections'][0]['status'] == 'ok'
+        assert len(j['sections'][0]['results']) == 2
+        assert j['sections'][1]['status'] == 'failed'
+
+
+def test_synthetic_data(solver_input_args):
+    with TemporaryDirectory() as output_dir:
+        gen_args = {
+                'output_dir': output_dir,
+                'n_rows': 4,
+                'n_cols': 5,
+                'outlier_fraction': 0.1,
+                'bad_edge_fraction': 0.05,
+                'missing_edge_fraction': 0.05,
+                'seed': 3}
+        gen = GenerateSyntheticMontageData(input_data=gen_args, args=[])
+        gen.run()
+        with open(gen.results['metafile'], 'rb') as f:
+            first = f.read()
+        gen.run()
+        with open(gen.results['metafile'], 'rb') as f:
+            assert f.read() == first
+
+        # LEFT and RIGHT blocks of 4 x 4 horizontal neighbors, TOP
+        # blocks of 3 x 5 vertical neighbors
+        assert gen.results['n_tiles'] == 20
+        assert (
+            gen.results['n_edges'] + gen.results['n_missing_edges'] ==
+            2 * 16 + 15)
+        assert 0 < gen.results['n_outliers'] < gen.results['n_point_pairs']
+
+        ms = MontageSolver(input_data={
+                'data_dir': output_dir,
+                'output_dir': output_dir,
+                'solver_template_dir': solver_input_args[
+                    'solver_template_dir'],
+                'solver_templates': ['affine_template.json']}, args=[])
+        ms.run()
+        resolved = renderapi.resolvedtiles.ResolvedTiles(json=jsongz.load(
+            os.path.join(output_dir, ms.results[0]['output'])))
+        expected = jsongz.load(
+            gen.results['expected_positions'])['translations']
+        solved = np.array([
+            t.tforms[-1].tform(np.array([[0.0, 0.0]]))[0]
+            for t in resolved.tilespecs])
+        true = np.array([expected[t.tileId] for t in resolved.tilespecs])
+        # the montage is only determined up to an affine
+        aff = renderapi.transform.AffineModel()
+        aff.estimate(solved, true)
+        assert np.linalg.norm(aff.tform(solved) - true, axis=1).mean() < 2.0
@@ -1,9 +1,26 @@
 from em_stitch.utils.utils import correction_grid
+from em_stitch.utils.raster_grid import RasterGrid
+from em_stitch.utils.generate_EM_tilespecs_from_metafile import (
+        GenerateEMTileSpecsModule)
+from em_stitch.utils.metafile import (
+        Metafile, as_metafile, iter_collection, iter_metafile_items,
+        iter_tiles)
+from em_stitch.utils import jsongz
+from em_stitch.utils.transform_sidecar import (
+        sidecar_path, write_sidecar, read_sidecar, load_lens_transform)
+from em_stitch.utils.instrumentation import Timings
+from em_stitch.utils.stage_cache import StageCache
+from em_stitch.utils.profiling import profiled
+from argschema import ArgSchemaParser
+from bigfeta import jsongz as bigfeta_jsongz
+import gzip
 import json
 import renderapi
 import os
 import glob
 import numpy as np
+import pytest
+import tracemalloc
 
 test_files_dir = os.path.join(os.path.dirname(__file__), 'test_files')
 
@@ -27,3 +44,280 @@ def test_correction_grid():
     delta = dst - src
     mag = np.linalg.norm(delta, axis=1)
     assert mag.size == npts**2
+
+
+def test_metafile_parsed_once():
+    data_dir = os.path.join(test_files_dir, "lens_example")
+    meta = glob.glob(os.path.join(
+        data_dir, '_metadata*.json'))[0]
+    with open(meta, 'r') as f:
+        j = json.load(f)
+
+    mf = Metafile(meta)
+    assert mf._json is None
+    assert mf.metadata == j[0]['metadata']
+    parsed = mf._json
+    assert mf.data == j[1]['data']
+    assert len(mf.matchers) == len(j[1]['data'])
+    assert mf._json is parsed
+    assert as_metafile(mf) is mf
+    assert as_metafile(meta).path == meta
+
+
+@pytest.mark.parametrize("chunk_size", [1, 100, 2**20])
+def test_metafile_stream(chunk_size):
+    data_dir = os.path.join(test_files_dir, "lens_example")
+    meta = glob.glob(os.path.join(
+        data_dir, '_metadata*.json'))[0]
+    with open(meta, 'r') as f:
+        j = json.load(f)
+
+    items = list(iter_metafile_items(meta, chunk_size=chunk_size))
+    assert items[0] == ('metadata', j[0]['metadata'])
+    assert [v for k, v in items if k == 'data'] == j[1]['data']
+
+    mf = Metafile(meta, skip_matchers=True)
+    assert mf.metadata == j[0]['metadata']
+    assert len(mf.data) == len(j[1]['data'])
+    assert all(['matcher' not in t for t in mf.data])
+    assert len(list(iter_tiles(meta))) == len(j[1]['data'])
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("chunk_size", [1, 100, 2**20])
+def test_collection_stream(tmpdir, compress, chunk_size):
+    matches = glob.glob(os.path.join(
+        test_files_dir, "lens_example", '_template_matches*.json'))[0]
+    j = jsongz.load(matches)
+    path = jsongz.dump(
+        j, os.path.join(str(tmpdir), 'matches.json'), compress=compress)
+    assert list(iter_collection(path, chunk_size=chunk_size)) == \
+        j['collection']
+
+
+def test_raster_grid():
+    # 3 cols x 2 rows, missing (2, 1)
+    raster_pos = [[0, 0], [1, 0], [2, 0], [0, 1], [1, 1]]
+    grid = RasterGrid(raster_pos)
+    assert grid.index.shape == (3, 2)
+    for i, (c, r) in enumerate(raster_pos):
+        assert grid.lookup(c, r) == i
+    assert grid.lookup(2, 1) == -1
+    assert grid.lookup(-1, 0) == -1
+    assert grid.lookup(0, 5) == -1
+
+    cols = np.array([0, 1, 2, 0, 1])
+    rows = np.array([0, 0, 0, 1, 1])
+    assert np.all(grid.neighbors(cols, rows, (-1, 0)) ==
+                  [-1, 0, 1, -1, 3])
+    assert np.all(grid.neighbors(cols, rows, (1, 0)) ==
+                  [1, 2, -1, 4, -1])
+    assert np.all(grid.neighbors(cols, rows, (0, -1)) ==
+                  [-1, -1, -1, 0, 1])
+
+    tspecs = [renderapi.tilespec.TileSpec(imageCol=c, imageRow=r)
+              for c, r in raster_pos]
+    assert np.all(RasterGrid.from_tilespecs(tspecs).index == grid.index)
+
+
+def test_tilespec_dicts_match_tilespecs():
+    data_dir = os.path.join(test_files_dir, "lens_example")
+    meta = glob.glob(os.path.join(
+        data_dir, '_metadata*.json'))[0]
+    with open(meta, 'r') as f:
+        j = json.load(f)
+
+    tspecs = GenerateEMTileSpecsModule.ts_from_metadata(
+            j, data_dir, 3.0, sectionId='3.0', maskUrl=meta)
+    tdicts = GenerateEMTileSpecsModule.tilespec_dicts_from_imgdata(
+            j[0]['metadata'], j[1]['data'], data_dir, 3.0, '3.0',
+            maskUrl=meta)
+    # same content and key order as TileSpec.to_dict()
+    assert json.dumps(tdicts) == json.dumps([t.to_dict() for t in tspecs])
+
+    gmod = GenerateEMTileSpecsModule(
+            input_data={'metafile': meta, 'z': 3.0}, args=[])
+    gmod.run()
+    assert gmod.tilespecs is gmod.tilespecs
+    assert gmod.tilespecs == [t.to_dict() for t in gmod.render_tspecs]
+
+
+@pytest.mark.parametrize("compress", [True, False])
+@pytest.mark.parametrize("threads", [1, 3])
+def test_jsongz_compatible(tmpdir, compress, threads):
+    obj = [{
+        'pId': 'tile/%d' % i,
+        'qId': u'tile\u00e9%d' % i,
+        'matches': {
+            'p': np.random.rand(2, 50).tolist(),
+            'q': np.random.rand(2, 50).tolist(),
+            'w': [1.0] * 50}} for i in range(200)]
+    # small blocks so the parallel gzip path is exercised
+    jsongz.default_block_size, block_size = 4096, jsongz.default_block_size
+    try:
+        fpath = jsongz.dump(
+            obj, str(tmpdir.join("ours.json")), compress=compress,
+            threads=threads, compresslevel=1)
+    finally:
+        jsongz.default_block_size = block_size
+    assert fpath.endswith('.gz') == compress
+    assert bigfeta_jsongz.load(fpath) == obj
+    assert jsongz.load(fpath) == obj
+
+    fpath = bigfeta_jsongz.dump(
+        obj, str(tmpdir.join("bigfeta.json")), compress=compress)
+    assert jsongz.load(fpath) == obj
+
+    # non-finite floats are not written as null by the fast codecs
+    obj = {'a': float('nan'), 'b': [float('inf'), None],
+           'c': np.array([1.0, -np.inf]), 'd': None}
+    fpath = jsongz.dump(obj, str(tmpdir.join("nonfinite.json")))
+    with open(fpath, 'r') as f:
+        assert json.load(f)['b'] == [float('inf'), None]
+    j = jsongz.load(fpath)
+    assert np.isnan(j['a'])
+    assert j['c'] == [1.0, -np.inf]
+    assert j['d'] is None
+    assert json.loads(jsongz.dumps({'a': None, 'b': [1.5]})) == {
+        'a': None, 'b': [1.5]}
+
+    # falls back to the standard library for anything extra
+    fpath = jsongz.dump(
+        {'a': float('nan')}, str(tmpdir.join("nan.json")), indent=2)
+    assert np.isnan(jsongz.load(fpath)['a'])
+
+
+@pytest.mark.parametrize("chunk_size", [3, 2**20])
+def test_jsongz_read_gzip(tmpdir, chunk_size):
+    # several gzip members, where the trailer only sizes the last one
+    fpath = str(tmpdir.join("members.json.gz"))
+    with open(fpath, 'wb') as f:
+        f.write(gzip.compress(b'{"a": [1, 2,'))
+        f.write(gzip.compress(b' 3]}'))
+    data = jsongz._read_gzip(fpath, chunk_size=chunk_size)
+    assert data == b'{"a": [1, 2, 3]}'
+    assert jsongz.load(fpath) == {'a': [1, 2, 3]}
+
+    fpath = str(tmpdir.join("empty.json.gz"))
+    with open(fpath, 'wb') as f:
+        f.write(gzip.compress(b''))
+    assert jsongz._read_gzip(fpath, chunk_size=chunk_size) == b''
+
+
+def test_transform_sidecar(tmpdir):
+    tform = renderapi.transform.ThinPlateSplineTransform()
+    tform.estimate(
+        np.random.rand(30, 2) * 1000, np.random.rand(30, 2) * 1000)
+    tform.transformId = "lens"
+    jpath = jsongz.dump(
+        tform.to_dict(), str(tmpdir.join("tform.json")), compress=True)
+    spath = write_sidecar(tform, jpath)
+    assert spath == sidecar_path(jpath) == str(tmpdir.join("tform.tps.npz"))
+
+    assert read_sidecar(spath, json_path=jpath).to_dict() == tform.to_dict()
+    assert load_lens_transform(jpath).to_dict() == tform.to_dict()
+
+    # a changed json makes the sidecar stale, the json wins
+    tform.transformId = "changed"
+    jsongz.dump(tform.to_dict(), jpath)
+    assert read_sidecar(spath, json_path=jpath) is None
+    assert load_lens_transform(jpath).transformId == "changed"
+
+
+def test_stage_cache(tmpdir):
+    cache = StageCache(str(tmpdir.join("cache")), max_bytes=5000)
+    k0 = cache.key('stage', a=1, b=[1, 2])
+    assert k0 == cache.key('stage', b=[1, 2], a=1)
+    assert k0 != cache.key('stage', a=2, b=[1, 2])
+    assert cache.get(k0) is None
+
+    fpath = str(tmpdir.join("artifact.txt"))
+    with open(fpath, 'w') as f:
+        f.write('x' * 2000)
+    cache.put(k0, data={'n': 1}, files={'artifact': fpath})
+    record = cache.get(k0)
+    assert record['data'] == {'n': 1}
+    restored = cache.restore(record, 'artifact', str(tmpdir.mkdir("out")))
+    assert restored == str(tmpdir.join("out", "artifact.txt"))
+    with open(restored, 'r') as f:
+        assert f.read() == 'x' * 2000
+
+    # least recently used entries are evicted beyond max_bytes
+    k1 = cache.key('stage', a=2)
+    k2 = cache.key('stage', a=3)
+    cache.put(k1, files={'artifact': fpath})
+    os.utime(os.path.join(cache.entry_dir(k1), 'record.json'), (0, 0))
+    cache.put(k2, files={'artifact': fpath})
+    assert cache.get(k1) is None
+    assert cache.get(k0) is not None
+    assert cache.get(k2) is not None
+
+    cache.force = True
+    assert cache.get(k0) is None
+
+
+@pytest.mark.parametrize("trace", [True, False])
+def test_timings(trace):
+    if trace:
+        tracemalloc.start()
+    try:
+        timings = Timings()
+        with timings.span('outer') as span:
+            a = np.ones(2**20)
+            with timings.span('inner'):
+                b = np.ones(2**21)
+                del b
+            span.annotate(n=3)
+            del a
+    finally:
+        if trace:
+            tracemalloc.stop()
+    t = timings.to_dict()
+    assert list(t) == ['outer.inner', 'outer']
+    assert t['outer']['n'] == 3
+    assert t['outer']['wall_time'] >= t['outer.inner']['wall_time'] >= 0
+    assert t['outer']['cpu_time'] >= 0
+    if trace:
+        # 8 and 16 MB arrays, the inner one allocated inside the outer
+        assert 15 < t['outer.inner']['tracemalloc_peak_mb'] < 17
+        assert 23 < t['outer']['tracemalloc_peak_mb'] < 26
+    else:
+        assert 'tracemalloc_peak_mb' not in t['outer']
+    json.dumps(t)
+
+
+class ProfiledModule(ArgSchemaParser):
+    @profiled
+    def run(self, inner=None):
+        x = sum(np.ones(1000).sum() for i in range(20000))
+        if inner is not None:
+            inner.run()
+        return x
+
+
+@pytest.mark.parametrize("mode, ext", [
+    (None, None), ('cprofile', '.prof'), ('sample', '.collapsed')])
+def test_profiled(tmpdir, monkeypatch, mode, ext):
+    if mode is None:
+        monkeypatch.delenv('EM_STITCH_PROFILE', raising=False)
+    else:
+        monkeypatch.setenv('EM_STITCH_PROFILE', mode)
+        monkeypatch.setenv('EM_STITCH_PROFILE_INTERVAL', '0.001')
+    outer = ProfiledModule(input_data={
+        'output_json': str(tmpdir.join('outer.json'))}, args=[])
+    inner = ProfiledModule(input_data={
+        'output_json': str(tmpdir.join('inner.json'))}, args=[])
+    assert outer.run(inner=inner) == 20000000.0
+
+    # the outer profile covers the inner module
+    assert sorted(os.listdir(str(tmpdir))) == (
+        [] if mode is None else ['outer' + ext])
+    if mode == 'cprofile':
+        import pstats
+        stats = pstats.Stats(str(tmpdir.join('outer.prof')))
+        assert [k for k in stats.stats if k[2] == 'run']
+    elif mode == 'sample':
+        with open(str(tmpdir.join('outer.collapsed'))) as f:
+            lines = f.read().splitlines()
+        assert lines
+        assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
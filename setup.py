@@ -35,6 +35,7 @@ setup(name='em_stitch',
       author_email='danielk@alleninstitute.org',
       url='https://github.com/AllenInstitute/em_stitch',
       packages=find_packages(),
+      package_data={'em_stitch.worker': ['cost_calibration.json']},
       setup_requires=['setuptools_scm'],
       install_requires=required,
       tests_require=test_required,